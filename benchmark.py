@@ -0,0 +1,263 @@
+''' Benchmarks of the integration backends
+
+Sweeps dimension, sample count, worker count and integrand cost over every backend, timing each
+configuration and measuring its error against the exact integral. Results (and error vs time curves) can
+be saved as a json baseline and later runs compared against one to catch regressions:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+Every run is seeded, so estimates are reproducible and only the timings vary between runs. Pools are
+created and warmed up before timing, so the numbers are steady state throughput. '''
+import argparse
+import collections
+import json
+import math
+import os
+import platform
+import sys
+import time
+import numpy as np
+import integration
+import monte
+import native
+import sampling
+import utils
+
+# scalar fn (x indexable, of length d), vectorized fn ((rows, d) array), native expression source and the
+# exact integral over the unit cube, of one integrand in d dimensions
+Integrand = collections.namedtuple('Integrand', ['scalar', 'vectorized', 'source', 'exact'])
+
+# terms of the expensive integrand
+TERMS = 8
+
+def _cheap(d):
+    source = ' + '.join('x[{}]'.format(i) for i in range(d))
+    return Integrand(lambda x: sum(x), lambda x: np.sum(x, axis=1), source, d / 2)
+
+def _medium(d):
+    source = ' * '.join('cos(x[{}])'.format(i) for i in range(d))
+    return Integrand(lambda x: math.prod(math.cos(v) for v in x), lambda x: np.prod(np.cos(x), axis=1), source, math.sin(1) ** d)
+
+def _expensive(d):
+    # product over dimensions of the mean of cos(k x_i), k = 1 .. TERMS
+    ks = np.arange(1, TERMS + 1)
+    factor = ' + '.join('cos({} * x[{{i}}])'.format(k) for k in ks)
+    source = ' * '.join('(({}) / {})'.format(factor.format(i=i), TERMS) for i in range(d))
+    exact = np.mean(np.sin(ks) / ks) ** d
+
+    scalar = lambda x: math.prod(sum(math.cos(k * v) for k in range(1, TERMS + 1)) / TERMS for v in x)
+    vectorized = lambda x: np.prod(np.mean(np.cos(x[:, :, None] * ks), axis=2), axis=1)
+    return Integrand(scalar, vectorized, source, float(exact))
+
+COSTS = {'cheap': _cheap, 'medium': _medium, 'expensive': _expensive}
+
+def _density(d):
+    ''' Standard normal density in d dimensions, scalar and vectorized, the distribution mcmc backends sample '''
+    norm = (2 * math.pi) ** (-d / 2)
+    scalar = lambda x: norm * math.exp(-sum(v * v for v in x) / 2)
+    vectorized = lambda x: norm * np.exp(-np.sum(x * x, axis=1) / 2)
+    return scalar, vectorized
+
+def _integrate(integrand, d, n, pool, seed):
+    return integration.integrate(integrand.scalar, [(0, 1)] * d, n=n, pool=pool, seed=seed)
+
+def _integrate_vectorized(integrand, d, n, pool, seed):
+    return integration.integrate(integrand.vectorized, [(0, 1)] * d, n=n, vectorized=True, pool=pool, seed=seed)
+
+def _integrate_native(integrand, d, n, pool, seed):
+    # threads in this process stand in for the workers
+    return integration.integrate(native.expression(integrand.source), [(0, 1)] * d, n=n, threads=pool.num_workers, seed=seed)
+
+def _integrate_hypercube(integrand, d, n, pool, seed):
+    return monte.integrate_hypercube(integrand.scalar, [(0, 1)] * d, n=n, pool=pool, seed=seed), None
+
+def _sample_hypercube(integrand, d, n, pool, seed):
+    start = time.time()
+    moments = utils.Moments(*sampling._hypercube_moments(integrand.scalar, [0.0] * d, [1.0] * d, n, False, 1000, seed))
+    return utils.moments_result(moments, 1, start)
+
+def _metropolis_hastings(integrand, d, n, pool, seed):
+    # single chain, every proposal and acceptance a python call, scored like importance_sample
+    np.random.seed(seed)
+    density, _ = _density(d)
+    acceptance = lambda x, x_p: min(1.0, density(x_p) / density(x))
+
+    samples = np.asarray(sampling._metropolis_hastings(np.random.rand(d), lambda x: x + np.random.normal(size=d), acceptance, n, 1000, 1, seed))
+    samples = samples.reshape(n, d)
+    inside = np.all((samples >= 0) & (samples <= 1), axis=1)
+    scores = [integrand.scalar(x) / density(x) if i else 0.0 for x, i in zip(samples, inside)]
+
+    return float(np.mean(scores)), None
+
+def _importance_sample(integrand, d, n, pool, seed):
+    density, _ = _density(d)
+    return integration.importance_sample(integrand.scalar, density, lambda: np.random.rand(d), [(0, 1)] * d, n=n, pool=pool, seed=seed)
+
+def _importance_sample_vectorized(integrand, d, n, pool, seed):
+    _, density = _density(d)
+    return integration.importance_sample(integrand.vectorized, density, lambda: np.random.rand(d), [(0, 1)] * d, n=n, pool=pool,
+                                         vectorized=True, seed=seed)
+
+def _monte_importance_sample(integrand, d, n, pool, seed):
+    density, _ = _density(d)
+    return monte.importance_sample(integrand.scalar, density, lambda: np.random.rand(d), [(0, 1)] * d, n=n, pool=pool, seed=seed), None
+
+# name -> (fn(integrand, d, n, pool, seed) returning an IntegrationResult or (estimate, reported error or None),
+#          whether it runs on the pool's workers)
+BACKENDS = collections.OrderedDict([
+    ('integrate', (_integrate, True)),
+    ('integrate_vectorized', (_integrate_vectorized, True)),
+    ('integrate_native', (_integrate_native, True)),
+    ('integrate_hypercube', (_integrate_hypercube, True)),
+    ('sample_hypercube', (_sample_hypercube, False)),
+    ('metropolis_hastings', (_metropolis_hastings, False)),
+    ('importance_sample', (_importance_sample, True)),
+    ('importance_sample_vectorized', (_importance_sample_vectorized, True)),
+    ('monte_importance_sample', (_monte_importance_sample, True)),
+])
+
+def _key(record):
+    return tuple(record[k] for k in ('backend', 'cost', 'd', 'n', 'workers'))
+
+def measure(backend, cost, d, n, pool, repeat=3, seed=0):
+    ''' Time one configuration, returns a json-able record
+
+    Arguments:
+    backend - name in BACKENDS
+    cost - name in COSTS
+    d, n - dimension and number of samples
+    pool - workers.WorkerPool the backend runs on, serial backends ignore it
+    repeat - number of timed runs, every one seeded with seed + its index '''
+    fn, parallel = BACKENDS[backend]
+    integrand = COSTS[cost](d)
+
+    # untimed small run, so that registering the integrand with the workers isn't measured
+    fn(integrand, d, min(n, 1000), pool, seed)
+
+    times, errors, reported = [], [], []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn(integrand, d, n, pool, seed + i)
+        times.append(time.perf_counter() - start)
+
+        if isinstance(result, tuple):
+            estimate, error = result
+        else:
+            estimate, error = float(result), result.error
+
+        errors.append(abs(float(estimate) - integrand.exact))
+        reported.append(error)
+
+    elapsed = float(np.median(times))
+    return dict(backend=backend, cost=cost, d=d, n=n, workers=pool.num_workers if parallel else 1,
+                times=times, time=elapsed, samples_per_sec=n / elapsed if elapsed > 0 else math.inf,
+                error=float(np.mean(errors)), reported_error=None if None in reported else float(np.mean(reported)))
+
+def sweep(backends=None, costs=None, dims=(1, 3), ns=(10000, 100000), workers=(1, None), repeat=3, seed=0, log=None):
+    ''' Measure every combination of the given backends, costs, dimensions, sample counts and worker counts,
+    returns the list of records. Serial backends are measured once, not once per worker count
+
+    Arguments:
+    backends, costs - names in BACKENDS and COSTS, default all of them
+    dims, ns - dimensions and sample counts
+    workers - worker counts, None for the cpu count
+    repeat, seed - as in measure
+    log - if given, called with every record as it is measured '''
+    backends = backends or list(BACKENDS)
+    costs = costs or list(COSTS)
+    workers = sorted(set(w or os.cpu_count() for w in workers))
+    records = []
+
+    for w in workers:
+        with integration.Integrator(num_workers=w) as pool:
+            for backend in backends:
+                if not BACKENDS[backend][1] and w != workers[0]:
+                    continue
+
+                for cost in costs:
+                    for d in dims:
+                        for n in ns:
+                            records.append(measure(backend, cost, d, n, pool, repeat, seed))
+
+                            if log is not None:
+                                log(records[-1])
+
+    return records
+
+def curves(records):
+    ''' Error vs time curves, one per (backend, cost, d, workers), as lists of (time, error) ordered by time '''
+    grouped = collections.defaultdict(list)
+
+    for r in records:
+        grouped['{backend}/{cost}/d={d}/workers={workers}'.format(**r)].append((r['time'], r['error']))
+
+    return {k: sorted(v) for k, v in grouped.items()}
+
+def environment():
+    ''' What a baseline was measured on, timings are only comparable on the same machine '''
+    return dict(python=sys.version.split()[0], numpy=np.__version__, platform=platform.platform(),
+                machine=platform.machine(), cpus=os.cpu_count(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+def save(path, records):
+    with open(path, 'w') as f:
+        json.dump(dict(environment=environment(), records=records, curves=curves(records)), f, indent=1)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['records']
+
+def compare(baseline, records, tolerance=0.2):
+    ''' Match records against a baseline's by configuration, returns a list of
+    (record, baseline samples/sec, ratio of samples/sec, whether it regressed by more than tolerance) '''
+    previous = {_key(r): r for r in baseline}
+    rows = []
+
+    for r in records:
+        if _key(r) not in previous:
+            continue
+
+        before = previous[_key(r)]['samples_per_sec']
+        ratio = r['samples_per_sec'] / before
+        rows.append((r, before, ratio, ratio < 1 - tolerance))
+
+    return rows
+
+def _format(r):
+    reported = '{:.2e}'.format(r['reported_error']) if r['reported_error'] is not None else '-'
+    return '{backend:<30} {cost:<10} {d:>3} {n:>9} {workers:>3} {time:>9.4f}s {samples_per_sec:>12.0f}/s {error:>10.2e}'.format(**r) + ' {:>10}'.format(reported)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS))
+    parser.add_argument('--costs', nargs='+', choices=list(COSTS))
+    parser.add_argument('--dims', nargs='+', type=int, default=[1, 3])
+    parser.add_argument('--n', nargs='+', type=int, default=[10000, 100000])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, os.cpu_count()])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the records and curves to this json file')
+    parser.add_argument('--compare', help='json baseline to compare samples/sec against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    print('{:<30} {:<10} {:>3} {:>9} {:>3} {:>10} {:>14} {:>10} {:>10}'.format('backend', 'cost', 'd', 'n', 'w', 'time', 'rate', 'error', 'reported'))
+    records = sweep(args.backends, args.costs, args.dims, args.n, args.workers, args.repeat, args.seed, log=lambda r: print(_format(r), flush=True))
+
+    if args.save:
+        save(args.save, records)
+
+    if args.compare:
+        rows = compare(load(args.compare), records, args.tolerance)
+
+        print()
+        for r, before, ratio, regressed in rows:
+            print('{} {:>7.2f}x{}'.format(_format(r), ratio, '  REGRESSION' if regressed else ''))
+
+        if any(regressed for r, before, ratio, regressed in rows):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
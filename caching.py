@@ -0,0 +1,291 @@
+import collections
+import copy
+import functools
+import hashlib
+import inspect
+import numbers
+import os
+import pickle
+import sys
+import threading
+import types
+import numpy as np
+import utils
+import native
+import integration
+
+# arguments that say how much accuracy (or which resources) to spend, not what is being integrated,
+# a cached result answers any request that differs from it only in these
+_ACCURACY = ('n', 'rtol', 'atol', 'max_n', 'max_time', 'ess')
+_RESOURCES = ('pool', 'threads', 'profile', 'resume', 'stop')
+
+def fingerprint(obj):
+    ''' Stable sha256 hex digest of obj, the same across processes and restarts (for the same python version)
+
+    Functions are fingerprinted by their code, defaults, closure values and the globals they refer to, not by
+    their names or where they were defined, so two identical lambdas match. Modules and classes go by their
+    qualified names, arrays by their dtype, shape and bytes, other objects by their type and attributes.
+    Raises ValueError if obj holds something that can't be fingerprinted '''
+    h = hashlib.sha256()
+    _feed(h, obj, set())
+    return h.hexdigest()
+
+def _put(h, tag, data=b''):
+    h.update(tag.encode() + b'%d:' % len(data) + data)
+
+def _qualname(obj):
+    return '{}.{}'.format(getattr(obj, '__module__', None), getattr(obj, '__qualname__', getattr(obj, '__name__', None)))
+
+def _global_names(code):
+    # names a code object (or any function defined in it) may look up as globals
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+def _feed(h, obj, seen):
+    if obj is None or isinstance(obj, (bool, numbers.Number, str, bytes)):
+        _put(h, type(obj).__name__, repr(obj).encode())
+    elif isinstance(obj, np.ndarray):
+        _put(h, 'ndarray', '{}{}'.format(obj.dtype.str, obj.shape).encode())
+        _put(h, 'data', np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (tuple, list)):
+        _put(h, type(obj).__name__, str(len(obj)).encode())
+        for item in obj:
+            _feed(h, item, seen)
+    elif isinstance(obj, (set, frozenset)):
+        # set order depends on string hashing, which is randomized per process
+        _put(h, type(obj).__name__, ''.join(sorted(fingerprint(item) for item in obj)).encode())
+    elif isinstance(obj, dict):
+        _put(h, 'dict', str(len(obj)).encode())
+        for key in sorted(obj, key=fingerprint):
+            _feed(h, key, seen)
+            _feed(h, obj[key], seen)
+    elif isinstance(obj, (types.ModuleType, type, types.BuiltinFunctionType)):
+        _put(h, type(obj).__name__, (obj.__name__ if isinstance(obj, types.ModuleType) else _qualname(obj)).encode())
+    elif isinstance(obj, np.random.SeedSequence):
+        _put(h, 'SeedSequence')
+        _feed(h, (obj.entropy, obj.spawn_key, obj.n_children_spawned), seen)
+    elif isinstance(obj, native.NativeIntegrand):
+        _put(h, 'NativeIntegrand')
+        _feed(h, (obj.code, obj.consts, obj.address, obj.source), seen)
+    elif isinstance(obj, types.CodeType):
+        _put(h, 'code', obj.co_code)
+        _feed(h, (obj.co_argcount, obj.co_kwonlyargcount, obj.co_flags, obj.co_names, obj.co_varnames, obj.co_consts), seen)
+    elif id(obj) in seen:
+        # recursive functions and self referencing objects
+        _put(h, 'cycle')
+    elif isinstance(obj, types.FunctionType):
+        seen.add(id(obj))
+        _put(h, 'function')
+        _feed(h, (obj.__code__, obj.__defaults__, obj.__kwdefaults__), seen)
+        _feed(h, [cell.cell_contents for cell in obj.__closure__ or ()], seen)
+
+        names = sorted(name for name in _global_names(obj.__code__) if name in obj.__globals__)
+        _feed(h, [(name, obj.__globals__[name]) for name in names], seen)
+    elif isinstance(obj, types.MethodType):
+        seen.add(id(obj))
+        _put(h, 'method')
+        _feed(h, (obj.__func__, obj.__self__), seen)
+    elif isinstance(obj, functools.partial):
+        seen.add(id(obj))
+        _put(h, 'partial')
+        _feed(h, (obj.func, obj.args, obj.keywords), seen)
+    elif hasattr(obj, '__dict__'):
+        seen.add(id(obj))
+        _put(h, 'object', _qualname(type(obj)).encode())
+        _feed(h, vars(obj), seen)
+
+        if callable(obj):
+            _feed(h, type(obj).__call__, seen)
+    else:
+        try:
+            data = pickle.dumps(obj, protocol=4)
+        except Exception as e:
+            raise ValueError('can\'t fingerprint {!r}'.format(obj)) from e
+
+        _put(h, 'pickle', data)
+
+def _normalize_limits(limits):
+    # 1 and 1.0 are the same bound
+    return [tuple(float(v) if isinstance(v, numbers.Real) else v for v in lim) for lim in limits]
+
+class ResultCache(object):
+    ''' Memoizes integration.integrate and integration.importance_sample results
+
+    Results are keyed by the fingerprints of the functions, the normalized limits and every other argument except
+    the accuracy ones (n, rtol, atol, max_n, max_time, ess) and the resources (pool, threads, profile). The most
+    accurate result of every key is kept and answers any request it satisfies: at least n samples when sampling a
+    fixed n, otherwise an error within max(atol, rtol * |estimate|) and at least ess effective samples, or a spent
+    max_n budget. 'uniform' and importance sampling results that fall short are resumed (see integrate's resume)
+    rather than thrown away, so only the missing samples are taken, other methods start over.
+
+    Integrands that can't be fingerprinted (see fingerprint) are integrated without caching. With seed=None
+    a hit returns the result of an earlier run instead of a fresh independent one.
+
+    Arguments:
+    max_entries - number of keys kept in memory, the least recently used is evicted first
+    path - directory to also keep results in as one pickle per key, so they survive restarts and can be shared
+           between processes. None to only cache in memory
+    max_bytes - size the directory is kept under by removing its least recently used files, None for no bound '''
+
+    def __init__(self, max_entries=128, path=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.resumed = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def integrate(self, fn, limits, *args, **kwargs):
+        ''' integration.integrate(fn, limits, *args, **kwargs), answered from the cache when possible '''
+        call = inspect.signature(integration.integrate).bind(fn, limits, *args, **kwargs)
+        call.apply_defaults()
+        request = call.arguments
+
+        if request['method'] == 'cubature' and request['rtol'] is None and request['atol'] is None:
+            # cubature refines until this by default
+            request['rtol'] = integration.CUBATURE_RTOL
+
+        return self._cached('integrate', integration.integrate, request)
+
+    def importance_sample(self, integrate_fn, dist_fn, init_fn, limits, *args, **kwargs):
+        ''' integration.importance_sample(integrate_fn, dist_fn, init_fn, limits, *args, **kwargs), answered from the
+        cache when possible '''
+        call = inspect.signature(integration.importance_sample).bind(integrate_fn, dist_fn, init_fn, limits, *args, **kwargs)
+        call.apply_defaults()
+        return self._cached('importance_sample', integration.importance_sample, call.arguments)
+
+    def key(self, name, request):
+        ''' Cache key of a request, the bound arguments of the named integration function '''
+        what = {k: v for k, v in request.items() if k not in _ACCURACY + _RESOURCES}
+        what['limits'] = _normalize_limits(what['limits'])
+        return fingerprint((name, sys.version_info[:2], what))
+
+    def get(self, key):
+        ''' Cached (result, n it answers requests for) of key, or None '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.path is None:
+            return None
+
+        try:
+            with open(self._file(key), 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(self._file(key))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, result, n):
+        ''' Keep result (answering requests for up to n samples) for key, unless a more accurate one is already kept '''
+        old = self.get(key)
+        if old is not None and old[0].n > result.n:
+            return
+
+        # a copy, so the caller's result keeps its profile and the cached one doesn't
+        entry = (copy.copy(result), n)
+        self._remember(key, entry)
+
+        if self.path is not None:
+            self._write(key, entry)
+
+    def clear(self):
+        ''' Forget every result, including those on disk '''
+        with self._lock:
+            self._entries.clear()
+
+        for name in self._files():
+            os.remove(os.path.join(self.path, name))
+
+    def _cached(self, name, integrate_fn, request):
+        try:
+            key = self.key(name, request)
+        except ValueError:
+            self.misses += 1
+            return integrate_fn(**request)
+
+        entry = self.get(key)
+
+        if entry is not None and self._satisfies(entry, request):
+            self.hits += 1
+            return entry[0]
+
+        cached = entry[0] if entry is not None else None
+        if getattr(cached, 'state', None) is not None:
+            # carry on sampling from the cached result, its samples count towards the request's
+            self.resumed += 1
+            result = integrate_fn(**dict(request, resume=cached))
+        else:
+            self.misses += 1
+            result = integrate_fn(**request)
+
+        # a stop or max_time can end a run short of its n, it then only answers requests for the samples it took
+        short = request['stop'] is not None or request['max_time'] is not None
+        self.put(key, result, result.n if short else request['n'])
+        return result
+
+    def _satisfies(self, entry, request):
+        result, n = entry
+        rtol, atol, ess = request['rtol'], request['atol'], request.get('ess')
+
+        if rtol is None and atol is None and ess is None:
+            return max(result.n, n) >= request['n']
+
+        max_n = 100 * request['n'] if request['max_n'] is None else request['max_n']
+        return result.n >= max_n or utils.should_stop(result, rtol, atol, ess=ess)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def _files(self):
+        if self.path is None:
+            return []
+
+        return [name for name in os.listdir(self.path) if name.endswith('.pkl')]
+
+    def _write(self, key, entry):
+        utils.dump_atomic(self._file(key), entry)
+
+        if self.max_bytes is not None:
+            self._shrink()
+
+    def _shrink(self):
+        # least recently used (read or written) first
+        files = []
+        for name in self._files():
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        files.sort()
+        total = sum(size for mtime, size, name in files)
+
+        for mtime, size, name in files[:-1]:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,178 @@
+import collections
+import heapq
+import itertools
+import math
+import time
+import numpy as np
+import utils
+import profiling
+
+# scalar integrands are spread over the pool once a batch has at least this many nodes
+POOL_MIN_POINTS = 4096
+
+# most nodes evaluated in one batch
+BATCH_POINTS = 4096
+
+# gauss kronrod 15 point rule on [-1, 1], the odd nodes (and 0) are those of the embedded 7 point gauss rule
+KRONROD_NODES = np.array([0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                          0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                          0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                          0.207784955007898467600689403773245, 0.0])
+KRONROD_WEIGHTS = np.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                            0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                            0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                            0.204432940075298892414161999234649, 0.209482141084727828012999174891714])
+GAUSS_WEIGHTS = np.array([0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+                          0.381830050505118944950369775488975, 0.417959183673469387755102040816327])
+
+# (nodes in [-1, 1]^d, weights of the high degree rule, weights of the embedded low degree rule), weights sum to 1
+Rule = collections.namedtuple('Rule', ['nodes', 'high', 'low'])
+
+def gauss_kronrod():
+    ''' 1 dimensional gauss kronrod 7-15 rule '''
+    nodes = np.concatenate((-KRONROD_NODES[:-1], KRONROD_NODES[::-1]))
+    high = np.concatenate((KRONROD_WEIGHTS[:-1], KRONROD_WEIGHTS[::-1])) / 2
+
+    low = np.zeros(15)
+    gauss = np.concatenate((GAUSS_WEIGHTS[:-1], GAUSS_WEIGHTS[::-1])) / 2
+    low[1::2] = gauss
+
+    return Rule(nodes[:, None], high, low)
+
+def genz_malik(d):
+    ''' Genz malik degree 7 rule with its embedded degree 5 rule, for d >= 2. Nodes are ordered center, then
+    +-l2 and +-l3 along every axis (used to pick the split dimension, see _split_dims), then the rest '''
+    l2, l3, l4, l5 = math.sqrt(9 / 70), math.sqrt(9 / 10), math.sqrt(9 / 10), math.sqrt(9 / 19)
+    eye = np.eye(d)
+
+    nodes = [np.zeros((1, d))]
+    for l in (l2, l3):
+        nodes.append(np.concatenate([np.stack((l * eye[i], -l * eye[i])) for i in range(d)]))
+
+    pairs = [s * l4 * eye[i] + t * l4 * eye[j] for i, j in itertools.combinations(range(d), 2) for s in (1, -1) for t in (1, -1)]
+    nodes.append(np.array(pairs).reshape(-1, d))
+    nodes.append(l5 * np.array(list(itertools.product((1, -1), repeat=d)), dtype=float))
+
+    counts = [1, 2 * d, 2 * d, 2 * d * (d - 1), 2 ** d]
+    high = [(12824 - 9120 * d + 400 * d * d) / 19683, 980 / 6561, (1820 - 400 * d) / 19683, 200 / 19683, 6859 / 19683 / 2 ** d]
+    low = [(729 - 950 * d + 50 * d * d) / 729, 245 / 486, (265 - 100 * d) / 1458, 25 / 729, 0]
+
+    return Rule(np.concatenate(nodes), np.repeat(high, counts), np.repeat(low, counts))
+
+def rule(d):
+    return gauss_kronrod() if d == 1 else genz_malik(d)
+
+def _split_dims(rule, vals, widths):
+    ''' Dimension to bisect every region along, the one whose fourth difference is largest (genz malik),
+    vals is (regions, nodes), widths is (regions, d) '''
+    regions, d = widths.shape
+
+    if d == 1:
+        return np.zeros(regions, dtype=int)
+
+    center = vals[:, :1]
+    l2 = vals[:, 1:1 + 2 * d].reshape(regions, d, 2).sum(axis=2)
+    l3 = vals[:, 1 + 2 * d:1 + 4 * d].reshape(regions, d, 2).sum(axis=2)
+    diff = np.abs(l2 - 2 * center - (1 / 7) * (l3 - 2 * center))
+
+    # ties (e.g. separable or constant integrands) go to the widest dimension
+    close = diff >= np.max(diff, axis=1, keepdims=True) * (1 - 1e-9)
+    return np.argmax(np.where(close, widths, -1), axis=1)
+
+def evaluate(fn, points, vectorized=False, limits=None, direct=False, profile=False):
+    ''' Worker task: values of fn (masked by limits, see utils.limit_wrapper) at the (k, d) points '''
+    fn, probe = profiling.probe(fn, limits, vectorized, direct, profile)
+    return profiling.report(_values(fn, points, vectorized), probe)
+
+def _values(fn, points, vectorized):
+    return np.asarray(fn(points) if vectorized else [fn(p) for p in points], dtype=float)
+
+def integrate(fn, lows, highs, vectorized=False, limits=None, direct=False, pool=None, scale=1, rtol=None, atol=None, max_n=None, max_time=None, profile=None, stop=None):
+    ''' Adaptive cubature of the mean of fn over the [lows, highs] cube, returns (mean, error of the mean, evaluations)
+
+    Regions are kept in a priority queue by their error. Every step bisects the regions holding the largest errors
+    (at least half of the total, up to BATCH_POINTS nodes) and evaluates all of their children's nodes at once:
+    in one call if vectorized, otherwise split over the pool when there are enough of them.
+
+    Arguments:
+    fn, lows, highs, vectorized, limits, direct - as in integration._hypercube_process_wrapper
+    pool - workers.WorkerPool for scalar fns, None to evaluate everything in this process
+    scale - what the mean will be multiplied by, so that rtol and atol apply to the integral
+    rtol, atol - stop once the error is below max(atol, rtol * |integral|)
+    max_n - budget of fn evaluations, never exceeded (ValueError if it doesn't cover a single rule)
+    max_time - time budget in seconds
+    profile - profiling.Profile the pool's jobs report to, if any
+    stop - callable handed (mean, error, evaluations) after every step, which are returned once it returns True '''
+    start = time.time()
+    max_n = math.inf if max_n is None else max_n
+    lows, highs = np.asarray(lows, dtype=float), np.asarray(highs, dtype=float)
+    d = len(lows)
+    r = rule(d)
+    masked = utils.limit_wrapper(fn, limits, vectorized, direct) if limits is not None else fn
+
+    if len(r.nodes) > max_n:
+        raise ValueError('max_n={} is less than the {} evaluations of a single rule in {} dimensions'.format(max_n, len(r.nodes), d))
+
+    def values(u):
+        # u are points in the unit cube
+        points = lows + (highs - lows) * u
+
+        if vectorized or pool is None or len(points) < POOL_MIN_POINTS:
+            return _values(masked, points, vectorized)
+
+        jobs = [((chunk,), dict(vectorized=vectorized, limits=limits, direct=direct)) for chunk in np.array_split(points, pool.num_workers)]
+        return np.concatenate(profiling.run(pool, evaluate, (fn,), jobs, profile))
+
+    def rules(lo, hi):
+        # (estimates, errors, split dims) of the (regions, d) regions [lo, hi] of the unit cube
+        widths = hi - lo
+        u = (lo + hi)[:, None, :] / 2 + widths[:, None, :] / 2 * r.nodes[None, :, :]
+        vals = values(u.reshape(-1, d)).reshape(len(lo), len(r.nodes))
+        volume = np.prod(widths, axis=1)
+
+        high, low = volume * (vals @ r.high), volume * (vals @ r.low)
+        return high, np.abs(high - low), _split_dims(r, vals, widths)
+
+    counter = itertools.count()
+    lo, hi = np.zeros((1, d)), np.ones((1, d))
+    estimates, errors, dims = rules(lo, hi)
+    evaluations = len(r.nodes)
+
+    # max heap of (-error, tiebreak, estimate, lo, hi, split dim)
+    heap = [(-errors[0], next(counter), estimates[0], lo[0], hi[0], dims[0])]
+    per_region = 2 * len(r.nodes)
+
+    while True:
+        mean = math.fsum(e[2] for e in heap)
+        error = math.fsum(-e[0] for e in heap)
+        tolerance = max((atol or 0) / abs(scale) if scale else 0, (rtol or 0) * abs(mean))
+
+        if error <= tolerance or evaluations + per_region > max_n or (max_time is not None and time.time() - start > max_time):
+            return mean, error, evaluations
+
+        if stop is not None and stop(mean, error, evaluations):
+            return mean, error, evaluations
+
+        # largest errors first, until they hold half of the total or the batch is full
+        batch, held = [], 0
+        budget = min(BATCH_POINTS, max_n - evaluations) // per_region
+        while heap and len(batch) < max(budget, 1) and held < error / 2:
+            batch.append(heapq.heappop(heap))
+            held += -batch[-1][0]
+
+        # bisect every region along its split dimension
+        lo = np.array([e[3] for e in batch])
+        hi = np.array([e[4] for e in batch])
+        split = np.array([e[5] for e in batch])
+        rows = np.arange(len(batch))
+        mid = (lo[rows, split] + hi[rows, split]) / 2
+
+        left_hi, right_lo = hi.copy(), lo.copy()
+        left_hi[rows, split], right_lo[rows, split] = mid, mid
+
+        children_lo, children_hi = np.concatenate((lo, right_lo)), np.concatenate((left_hi, hi))
+        estimates, errors, dims = rules(children_lo, children_hi)
+        evaluations += len(children_lo) * len(r.nodes)
+
+        for i in range(len(children_lo)):
+            heapq.heappush(heap, (-errors[i], next(counter), estimates[i], children_lo[i], children_hi[i], dims[i]))
@@ -1,132 +1,676 @@
 import numpy as np
+import functools
+import itertools
+import threading
 import math
-from pathos import multiprocessing
 import sys
 import os
 import numbers
+import time
 import utils
 import sampling
+import workers
+import vegas
+import miser
+import cubature
+import native
+import profiling
 
-def _hypercube_process_wrapper(fn, lows, highs, n=1000):
-    ''' Sample uniformly across a hypercube
+# methods integrate can sample with
+METHODS = ('uniform', 'sobol', 'halton', 'vegas', 'miser', 'cubature')
 
-    Arguments:
-    fn - actual function f: R^n -> R, should take np.array as sole argument
-    lows, highs 
-    n - number of samples to take '''
+# relative error cubature refines to when neither rtol nor atol is given
+CUBATURE_RTOL = 1e-8
 
-    # want deterministic seeding for unittesting
-    if 'UNITTESTING' not in os.environ:
-        np.random.seed()
+# rounds a fixed n is taken in by default when checkpointing, so a killed run has saved states to restart from
+CHECKPOINT_ROUNDS = 10
 
-    return sampling._sample_hypercube(fn, lows, highs, n) 
+# minimum number of independently scrambled replicates for quasi monte carlo, their spread gives the error
+QMC_REPLICATES = 8
 
-def integrate(fn, limits, cube=None, n=1000):
-    ''' Integrate a given function in a bounded interval
+# samples mcmc chains hand back at a time, bounds the memory a chain needs whatever n is
+BLOCK_SIZE = 10000
+
+# longest autocorrelation lag effective sample sizes account for
+MAX_LAG = 200
+
+def _hypercube_process_wrapper(fn, lows, highs, n=1000, vectorized=False, chunk_size=1000, limits=None, direct=False, seed=None, profile=False, antithetic=False):
+    ''' Sample uniformly across a hypercube, returns utils.Moments of the sampled values
 
     Arguments:
     fn - actual function f: R^n -> R, should take np.array as sole argument
-    limits - list of tuples representing intervals [a(x), b(x)] for each dimension
-    cube - if limits are not simple real numbers, provide a hypercube of form [(a, b), (c, d), ... ] s.t. it contains the domain of integration 
-    n - number of samples to take '''
-    is_hypercube = cube == None
+    lows, highs 
+    n - number of samples to take
+    vectorized - if True, fn takes a (chunk_size, d) np.array and returns a (chunk_size,) np.array
+    chunk_size - number of points handed to fn per call in vectorized mode
+    limits - if given, raw limits (see utils.limit_wrapper) that fn is masked by
+    direct - if True, the cube is the unit cube and fn is sampled through the limits instead (see utils.direct_wrapper)
+    seed - this job's spawned np.random.SeedSequence (see utils.seed_job)
+    profile - if True, return (moments, profiling.Job) timing the job
+    antithetic - if True, every sample is the average of fn at a point and its mirror image (see utils.antithetic_wrapper) '''
+    words = utils.seed_job(seed)
+    fn, probe = profiling.probe(fn, limits, vectorized, direct, profile)
+    fn = utils.antithetic_wrapper(fn, lows, highs, vectorized) if antithetic else fn
+
+    return profiling.report(utils.Moments(*sampling._hypercube_moments(fn, lows, highs, n, vectorized, chunk_size, words)), probe)
+
+def _qmc_process_wrapper(fn, lows, highs, n, method, seed, vectorized=False, chunk_size=1000, limits=None, direct=False, profile=False):
+    ''' Sample one randomized replicate of a low discrepancy sequence across a hypercube, returns utils.Moments
+
+    Arguments:
+    fn, lows, highs, n, vectorized, chunk_size, limits, direct, profile - as in _hypercube_process_wrapper
+    method - 'sobol' or 'halton'
+    seed - this replicate's spawned np.random.SeedSequence, which its scramble comes from '''
+    seed = utils.seed_job(seed)
+    fn, probe = profiling.probe(fn, limits, vectorized, direct, profile)
 
-    num_cores = multiprocessing.cpu_count()
-    # change n to something that is easily split up by processes
-    # makes process code a little cleaner
-    samples_per_core = n // num_cores
-    rectified_n = samples_per_core * num_cores
+    return profiling.report(utils.Moments(*sampling._qmc_moments(fn, lows, highs, n, method, seed, vectorized, chunk_size)), probe)
 
-    c = 1 / rectified_n
+def _domain(limits, cube, direct):
+    ''' Where to sample for limits (see integrate), returns (lows, highs, scale of the mean, raw limits to mask or
+    sample through or None for hypercubes, direct) '''
+    if direct is None:
+        direct = cube == None and utils.has_limit_fns(limits)
 
-    lows = []
-    highs = []
+    if direct:
+        # the whole domain is the image of the unit cube, the jacobian takes care of volume and sign
+        cube = [(0, 1)] * len(limits)
+
+    is_hypercube = cube == None
 
     # if is hypercube, this means limits are some hypercube, so just set
     if is_hypercube:
         cube = limits
 
     lows, highs, volume = utils.get_cube_info(cube)
-    c *= volume
+    c = volume
 
-    if not is_hypercube:
-        limits = utils.build_limit_fns(limits)
+    if is_hypercube:
+        limits = None
+    else:
         # exotic domains
         # get unsigned volume (mc part signs it according to integration rules and limits)
         c = abs(c)
-        fn = utils.fn_limit_wrapper(fn, limits)
 
-    # launch some processes to sample
+    return lows, highs, c, limits, direct
 
-    p = multiprocessing.Pool(num_cores)
+def integrate(fn, limits, cube=None, n=1000, vectorized=False, chunk_size=1000, pool=None, rtol=None, atol=None, max_n=None, max_time=None, method='uniform', iterations=10, direct=None, threads=None, seed=None, profile=None, resume=None, antithetic=False, control_variates=None, stop=None, rounds=None, checkpoint=None):
+    ''' Integrate a given function in a bounded interval, returns a utils.IntegrationResult
+
+    Arguments:
+    fn - actual function f: R^n -> R, should take np.array as sole argument,
+         or a native.NativeIntegrand, which is sampled on threads in this process (without the gil)
+         when method is 'uniform' and limits are real numbers
+    limits - list of tuples representing intervals [a(x), b(x)] for each dimension
+    cube - if limits are not simple real numbers, provide a hypercube of form [(a, b), (c, d), ... ] s.t. it contains the domain of integration 
+           (samples outside the domain are wasted, leave it out to sample the domain directly)
+    n - number of samples to take
+    vectorized - if True, fn takes a (chunk_size, d) np.array of points and returns a (chunk_size,) np.array of values,
+                 function limits likewise take the (chunk_size, d) array, e.g. lambda x: 1 - x[:, 0]
+    chunk_size - number of points handed to fn per call in vectorized mode
+    pool - workers.WorkerPool (e.g. an Integrator) or remote.RemotePool to sample on, defaults to a shared pool
+    rtol, atol - if either is given, keep sampling rounds of n until the standard error is below max(atol, rtol * |estimate|)
+    max_n - sample budget for rtol/atol mode, defaults to 100 * n
+    max_time - time budget in seconds for rtol/atol mode
+    method - 'uniform' for pseudo random samples, 'sobol' or 'halton' for randomized quasi monte carlo
+             (n is split across independently scrambled replicates, whose spread gives the error),
+             'vegas' for importance sampling on an adaptive grid (n is split across iterations, which need at
+             least 2 * vegas.BINS samples each, ValueError otherwise),
+             'miser' for recursive stratified sampling, sub-regions run as separate tasks on the pool,
+             'cubature' for deterministic adaptive cubature (gauss kronrod in 1d, genz malik above, best for a
+             few dimensions and smooth integrands), which refines until rtol/atol (rtol defaults to CUBATURE_RTOL)
+             or spends max_n evaluations. Function limits are integrated iteratively (see direct) unless direct=False
+    iterations - number of vegas iterations, in rtol/atol mode more follow until the target is met
+    direct - sample the iterated limits directly with x_i = a_i(x) + u_i * (b_i - a_i(x)) instead of rejecting
+             samples of the cube, the limits of dimension i may then only depend on x[:i].
+             Defaults to True when limits has functions and no cube is given
+    threads - number of threads for native integrands, defaults to cpu count
+    seed - int (or np.random.SeedSequence) making the run reproducible, every job gets its own independent
+           stream spawned from it, so more workers mean more independent samples. None for fresh entropy
+    profile - True to attach a profiling.Profile of where the time went to the result as result.profile, or a callable
+              that is also handed the result (profile attached) after every round of sampling
+    resume - result of an earlier 'uniform' run of the same integral to add more samples to, its samples are kept
+             (and count towards n, or max_n with rtol/atol) and its seed carries on, so no stream is repeated.
+             'uniform' results carry what this needs as result.state (a utils.RunState). ValueError if it was of a
+             different fn, limits, cube or options (see utils.run_fingerprint) or a seed other than its own is given
+    antithetic - 'uniform' only, if True every one of the n samples is the average of fn at a point and at its mirror
+                 image lows + highs - x in the cube (so fn is called 2n times), which cancels much of the variance
+                 of near monotone integrands
+    control_variates - 'uniform' only, list of (g, exact integral of g over the domain) of cheap functions (taking the
+                       same points as fn) that resemble fn. They are evaluated at the same points and the regression
+                       optimal multiple of their error is taken off of the estimate (see utils.control_variate_result)
+    stop - callable handed the result of every round of sampling (every step for cubature), which is returned as it is
+           once stop returns True, e.g. to cancel a run from another thread (see integrate_async)
+    rounds - without rtol/atol the n samples are taken in this many rounds (except for vegas and cubature), every one
+             handed to stop and checkpointed. Defaults to CHECKPOINT_ROUNDS with a checkpoint, otherwise 1
+    checkpoint - 'uniform' only, path of a file the run's state is saved to after every round (replacing the last, see rounds).
+                 If the file exists the run resumes from it as from resume, so a killed run can be restarted (or
+                 a finished one extended by asking for more samples) without redoing the samples already taken.
+                 A file saved by a different run raises ValueError rather than being merged into this one '''
+    start = time.time()
+    given_seed, seed = seed, utils.seed_sequence(seed)
+    profile = profiling.begin(profile)
+
+    assert method in METHODS, 'method must be one of {}'.format(METHODS)
+    assert method == 'uniform' or not (antithetic or control_variates or checkpoint), 'antithetic, control variates and checkpoints need uniform sampling'
+
+    if method == 'vegas' and n // iterations < 2 * vegas.BINS:
+        # fewer samples than bins leave the grid (and every iteration's error) to a handful of points
+        raise ValueError('vegas needs at least {} samples per iteration, n={} is split across {} iterations'.format(
+            2 * vegas.BINS, n, iterations))
+
+    if method == 'cubature' and direct is None:
+        # masking by the limits would put discontinuities in the integrand, which the rules converge slowly on
+        direct = utils.has_limit_fns(limits)
+
+    raw_limits = limits
+    lows, highs, c, limits, direct = _domain(limits, cube, direct)
+    native_path = isinstance(fn, native.NativeIntegrand) and method == 'uniform' and limits is None and not (antithetic or control_variates)
+    batched = vectorized or isinstance(fn, native.NativeIntegrand)
+    # native integrands are sampled on threads here and cubature evaluates batched integrands in this process,
+    # neither needs the pool started for them
+    uses_pool = not native_path and not (method == 'cubature' and batched)
+
+    if uses_pool:
+        with profiling.phase(profile, 'pool'):
+            pool = pool or workers.default_pool()
+    else:
+        pool = None
+    num_cores = pool.num_workers if pool is not None else 1
+
+    if max_n is None:
+        max_n = 100 * n
+
+    adaptive = rtol is not None or atol is not None or method == 'vegas'
+    total = n
+    if rounds is None:
+        rounds = CHECKPOINT_ROUNDS if checkpoint is not None else 1
+    if not adaptive:
+        n = -(-n // max(rounds, 1))
+
+    replicates = max(QMC_REPLICATES, num_cores)
+    threads = threads or os.cpu_count()
+    grid = vegas.uniform_grid(len(lows))
+
+    moments = []
+    taken = 0
+
+    fns = (fn,) + tuple(g for g, exact in control_variates or ())
+    exacts = [exact for g, exact in control_variates or ()]
+    # only uniform runs leave a state to resume from
+    run = utils.run_fingerprint(fns, raw_limits, cube, method, antithetic, exacts) if method == 'uniform' else None
+
+    state = utils.load_checkpoint(checkpoint) if checkpoint is not None and resume is None else getattr(resume, 'state', None)
+    assert resume is None or state is not None, 'only uniform results can be resumed'
+
+    if state is not None:
+        assert method == 'uniform' and isinstance(state, utils.RunState), 'only uniform runs can be resumed'
+        assert isinstance(state.moments, utils.Moments) != bool(control_variates), 'runs resume with control variates only if they were run with them'
+        utils.check_resumable(state, run, given_seed)
+        seed = utils.resumed_seed(state)
+        moments.append(state.moments)
+        taken = state.moments[0]
+
+    if uses_pool:
+        profiling.register(profile, pool, fns)
+
+    if method == 'cubature':
+        rtol = CUBATURE_RTOL if rtol is None and atol is None else rtol
+        step = None if stop is None else lambda mean, error, evaluations: stop(
+            utils.IntegrationResult(c * mean, abs(c) * error, evaluations, evaluations, time.time() - start))
+        mean, error, evaluations = cubature.integrate(fn, lows, highs, batched, limits, direct, pool, c, rtol, atol, max_n, max_time, profile, step)
+
+        result = utils.IntegrationResult(c * mean, abs(c) * error, evaluations, evaluations, time.time() - start)
+        profiling.end_round(profile, result)
+        return result
+
+    for round_number in itertools.count(1):
+        # every one of the round's samples is taken, an uneven split gives the first workers one more
+        size = n if adaptive else max(min(n, total - taken), 0)
+        shares = utils.split_samples(size, num_cores)
+
+        if native_path:
+            # no python in the hot loop, so threads in this process beat forked workers
+            words = seed.spawn(1)[0].generate_state(4).tolist()
+            with profiling.phase(profile, 'native'):
+                moments.append(utils.Moments(*fn.moments(lows, highs, size, threads, words)))
+            moments = [utils.merge_moments(moments)]
+            result = utils.moments_result(moments[0], c, start)
+            result.state = utils.run_state(moments[0], seed, run)
+        elif method == 'vegas':
+            # every worker samples through the same grid, which is then refined from all of their samples
+            jobs = [((grid, lows, highs, k, vectorized, chunk_size, limits, direct), dict(seed=s))
+                    for k, s in zip(utils.split_samples(n // iterations, num_cores), seed.spawn(num_cores)) if k]
+            results = profiling.run(pool, vegas.iteration, (fn,), jobs, profile)
+
+            moments.append(utils.merge_moments([m for m, w in results]))
+            if results:
+                grid = vegas.refine_grid(grid, sum(w for m, w in results))
+            result = vegas.combine_iterations(moments, c, start)
+        elif method == 'miser':
+            # every round is a whole independent stratified run, rounds are combined by their errors
+            mean, var, points = miser.sample(pool, fn, lows, highs, size, vectorized, limits, direct, seed=seed, profile=profile)
+            moments.append(utils.IntegrationResult(c * mean, abs(c) * math.sqrt(var), points, points, time.time() - start))
+            result = utils.combine_results(moments, start)
+        elif control_variates:
+            # fn and the control variates at the same points, their coefficients are fit to the sums of all jobs so far
+            job = dict(lows=lows, highs=highs, vectorized=vectorized, chunk_size=chunk_size, limits=limits, direct=direct, antithetic=antithetic)
+            jobs = [((), dict(job, n=k, seed=s)) for k, s in zip(shares, seed.spawn(num_cores)) if k]
+            sums = moments + profiling.run(pool, _many_process_wrapper, fns, jobs, profile)
+            moments = [tuple(sum(s) for s in zip(*sums))]
+            result = utils.control_variate_result(*moments[0], exacts, c, start)
+            result.state = utils.run_state(moments[0], seed, run)
+        elif method == 'uniform':
+            # sample on the workers, fn is masked by the (raw) limits over there
+            jobs = [((lows, highs, k, vectorized, chunk_size, limits, direct), dict(seed=s, antithetic=antithetic))
+                    for k, s in zip(shares, seed.spawn(num_cores)) if k]
+            moments = [utils.merge_moments(moments + profiling.run(pool, _hypercube_process_wrapper, (fn,), jobs, profile))]
+            result = utils.moments_result(moments[0], c, start)
+            result.state = utils.run_state(moments[0], seed, run)
+        else:
+            # every replicate gets its own scramble, the pool balances them across workers
+            jobs = [((lows, highs, k, method, s, vectorized, chunk_size, limits, direct), None)
+                    for k, s in zip(utils.split_samples(size, replicates), seed.spawn(replicates)) if k]
+            moments += profiling.run(pool, _qmc_process_wrapper, (fn,), jobs, profile)
+            result = utils.replicates_result(moments, c, start)
 
-    results = [p.apply_async(_hypercube_process_wrapper, args=(fn, lows, highs, samples_per_core)) for i in range(num_cores)] 
-    p.close()
-    p.join()
+        taken = result.n
+        profiling.end_round(profile, result)
 
-    return sum([r.get() for r in results]) * c
+        if checkpoint is not None:
+            utils.dump_atomic(checkpoint, result.state)
 
-# def metropolis_hastings(fn, init_fn, proposal_fn, proposal_density, n, burn_in=1000, skip=1):
+        if stop is not None and stop(result):
+            return result
 
-    # def acceptance(x, x_p):
-        # return min(1, (fn(x_p) / fn(x)) * (proposal_density(x, x_p)/ proposal_density(x_p, x)))
+        if not adaptive and (taken >= total or round_number >= rounds):
+            return result
 
-    # # pick initial state - user must care to pick prior s.t. always state with non-zero density
-    # x = init_fn()
+        # vegas always runs its first iterations, whatever their error
+        if adaptive and (method != 'vegas' or len(moments) >= iterations) and utils.should_stop(result, rtol, atol, max_n, max_time):
+            return result
 
-    # for i in range(n * skip + burn_in):
-        # x_p = proposal_fn(x)
+def _many_process_wrapper(*fns, lows, highs, n, params=None, vectorized=False, chunk_size=1000, limits=None, direct=False, seed=None, profile=False, antithetic=False):
+    ''' Sample every fn at the same uniform points of a hypercube, returns (n, (m,) sums, (m, m) sums of products)
 
-        # a = acceptance(x, x_p)
+    Arguments:
+    fns - integrands, or with params the single fn(x, p)
+    params - parameters to evaluate fn with, one integrand per parameter
+    lows, highs, n, vectorized, chunk_size, limits, direct, seed, profile, antithetic - as in _hypercube_process_wrapper '''
+    utils.seed_job(seed)
 
-        # if np.random.rand() < a:
-            # x = x_p
+    if params is not None:
+        fn = fns[0]
+        fns = [lambda x, p=p: fn(x, p) for p in params]
 
-        # if i >= burn_in and (i - burn_in) % skip == 0:
-            # yield x
+    probe = profiling.Probe() if profile else None
+    if probe is not None:
+        fns = [probe.wrap(f, limits, vectorized, direct) for f in fns]
+    elif limits is not None:
+        fns = [utils.limit_wrapper(f, limits, vectorized, direct) for f in fns]
 
-def _mcmc_process_wrapper(score_fn, *args, **kwargs):
-    s = sampling._metropolis_hastings(*args, **kwargs)
-    return sum(np.apply_along_axis(score_fn, 1, s))
+    if antithetic:
+        fns = [utils.antithetic_wrapper(f, lows, highs, vectorized) for f in fns]
 
-def importance_sample(integrate_fn, dist_fn, init_fn, limits, n=10000, proposal_fn=None, proposal_density=None, burn_in=1000, skip=1):
+    lows = np.asarray(lows, dtype=float)
+    highs = np.asarray(highs, dtype=float)
+    m = len(fns)
 
-    num_cores = multiprocessing.cpu_count()
-    # change n to something that is easily split up by processes
-    # makes process code a little cleaner
-    samples_per_core = n // num_cores
-    rectified_n = samples_per_core * num_cores
+    total = np.zeros(m)
+    cross = np.zeros((m, m))
 
-    d = len(limits)
+    for done in range(0, n, chunk_size):
+        rows = min(chunk_size, n - done)
+        points = lows + (highs - lows) * np.random.uniform(size=(rows, len(lows)))
 
-    # default proposal and densities are unit gaussian
-    if proposal_fn == None:
-        # multivar normal runs like 10x slower than normal for some reason, so if d == 1, hardcode univariate distribution
-        cov = np.diag(np.ones(d))
-        if d > 1:
-            proposal_fn = lambda x: np.random.multivariate_normal(x, cov)
+        if vectorized:
+            vals = np.column_stack([f(points) for f in fns])
         else:
-            proposal_fn = lambda x: np.random.normal(x)
+            vals = np.array([[f(p) for f in fns] for p in points], dtype=float)
+
+        total += vals.sum(axis=0)
+        cross += vals.T @ vals
+
+    return profiling.report((n, total, cross), probe)
+
+def integrate_many(fns, limits, cube=None, n=1000, params=None, vectorized=False, chunk_size=1000, pool=None, rtol=None, atol=None, max_n=None, max_time=None, direct=None, seed=None, profile=None):
+    ''' Integrate several functions over the same domain from the same uniform samples, every chunk of points is
+    drawn once and handed to all of them. Returns utils.IntegrationResults, one result per integrand
+
+    Arguments:
+    fns - list of functions to integrate, each as fn in integrate, or with params a single fn(x, p)
+    params - sequence of parameters, fn is integrated once per parameter
+    limits, cube, n, vectorized, chunk_size, pool, max_n, max_time, direct, seed, profile - as in integrate
+    rtol, atol - as in integrate, sampling stops once every integrand meets them '''
+    start = time.time()
+    seed = utils.seed_sequence(seed)
+    profile = profiling.begin(profile)
+
+    with profiling.phase(profile, 'pool'):
+        pool = pool or workers.default_pool()
+    num_cores = pool.num_workers
+
+    fns = (fns,) if params is not None else tuple(fns)
+    params = list(params) if params is not None else None
+
+    lows, highs, c, limits, direct = _domain(limits, cube, direct)
+
+    if max_n is None:
+        max_n = 100 * n
+
+    job = dict(lows=lows, highs=highs, params=params, vectorized=vectorized, chunk_size=chunk_size, limits=limits, direct=direct)
+    sums = []
+    profiling.register(profile, pool, fns)
+
+    while True:
+        jobs = [((), dict(job, n=k, seed=s)) for k, s in zip(utils.split_samples(n, num_cores), seed.spawn(num_cores)) if k]
+        sums += profiling.run(pool, _many_process_wrapper, fns, jobs, profile)
+        results = utils.shared_results(*[sum(s) for s in zip(*sums)], c, start)
+        profiling.end_round(profile, results)
+
+        if all(utils.should_stop(r, rtol, atol, max_n, max_time) for r in results):
+            return results
+
+def _chains(dist_fn, proposal_fn, proposal_density, initial_xs, n, burn_in, skip, walk, batched, seed, block=None):
+    initial_xs = np.atleast_2d(np.asarray(initial_xs, dtype=float))
+    d = initial_xs.shape[1]
+    scale, cov = walk or (1.0, np.eye(d))
+
+    return sampling._MetropolisHastings(initial_xs, dist_fn, n, burn_in, skip, block or BLOCK_SIZE, proposal_fn, proposal_density,
+                                        batched, seed, scale, cov, utils.target_acceptance(d))
+
+def metropolis_hastings(dist_fn, init_fn, n, proposal_fn=None, proposal_density=None, burn_in=1000, skip=1, vectorized=False, chains=64, block=None, seed=None):
+    ''' Stream samples of dist_fn from metropolis hastings chains run in this process, returns an iterator over
+    (samples (rows, d), densities (rows,)) blocks of at most block rows. The iterator's states(), acceptance(),
+    scale() and covariance() tell where the chains (and the default random walk) are
+
+    Arguments:
+    dist_fn, init_fn, n, proposal_fn, proposal_density, burn_in, skip, vectorized, chains, seed - as in importance_sample,
+        in vectorized mode the samples interleave the chains
+    block - samples per block, defaults to BLOCK_SIZE '''
+    initial_xs = [init_fn() for i in range(chains)] if vectorized else [init_fn()]
+    # this runs in the caller's process, whose numpy random state is left alone
+    words = utils.seed_words(seed)
+    return _chains(dist_fn, proposal_fn, proposal_density, initial_xs, n, burn_in, skip, None, vectorized, words, block)
+
+def _fold_blocks(chains, integrate_fn, batched, stats):
+    ''' utils.Moments of the importance weighted scores of every block the chains hand out, also fed to
+    stats (a sampling._ChainStats), only one block is ever in memory '''
+    moments = utils.Moments(0, 0, 0)
+
+    # the sampler kept the density of every sample, so dist_fn needn't be called again
+    for samples, densities in chains:
+        values = integrate_fn(samples) if batched else np.array([integrate_fn(x) for x in samples], dtype=float)
+        scores = values / densities
+
+        moments = utils.merge_moments([moments, utils.array_moments(scores)])
+        stats.add(scores)
+
+    return moments
 
-        proposal_density = lambda x, x_p: (1 / math.pow(2 * math.pi, d/2)) * math.exp(-((x_p - x).T @ (x_p - x) / 2))
+def _run_chains(integrate_fn, dist_fn, proposal_fn, proposal_density, initial_xs, n, burn_in, skip, walk, stats, batched, seed):
+    initial_xs = np.atleast_2d(np.asarray(initial_xs, dtype=float))
+
+    chains = _chains(dist_fn, proposal_fn, proposal_density, initial_xs, n, burn_in, skip, walk, batched, utils.seed_job(seed))
+    stats = sampling._ChainStats(len(initial_xs), MAX_LAG, n, stats)
+    moments = _fold_blocks(chains, integrate_fn, batched, stats)
+    walk = (chains.scale(), chains.covariance()) if proposal_fn is None else None
+
+    return utils.ChainReport(moments, chains.states(), walk, stats.state(), stats.halves(), chains.acceptance(), stats.ess())
+
+def _mcmc_process_wrapper(integrate_fn, dist_fn, proposal_fn, proposal_density, limits, initial_x, n, burn_in=1000, skip=1, walk=None, stats=None, seed=None, profile=False):
+    ''' Run one chain, returns a utils.ChainReport of it, states being the final state
+
+    Arguments:
+    integrate_fn, dist_fn - as in importance_sample
+    proposal_fn, proposal_density - as in importance_sample, None for the adaptive random walk
+    limits - raw limits (see utils.limit_wrapper) integrate_fn is masked by
+    initial_x - starting state of the chain
+    n, burn_in, skip - as in importance_sample, n is per chain
+    walk - (scale, cov) to continue the random walk with, None to start from a unit gaussian
+    stats - diagnostics state of the previous round to continue, None for a new chain
+    seed, profile - as in _hypercube_process_wrapper '''
+    integrate_fn, probe = profiling.probe(integrate_fn, limits, profile=profile)
+
+    report = _run_chains(integrate_fn, dist_fn, proposal_fn, proposal_density, [initial_x], n, burn_in, skip, walk, stats, False, seed)
+    return profiling.report(report._replace(states=report.states[0].reshape(np.shape(initial_x))), probe)
+
+def _mcmc_ensemble_process_wrapper(integrate_fn, dist_fn, proposal_fn, proposal_density, limits, initial_xs, n, burn_in=1000, skip=1, walk=None, stats=None, seed=None, profile=False):
+    ''' Run an ensemble of chains with batched calls, returns a utils.ChainReport of them
+
+    Arguments:
+    integrate_fn, dist_fn, proposal_fn, proposal_density - as in importance_sample with vectorized=True,
+                                                           None proposal for the adaptive random walk
+    limits - raw limits (see utils.limit_wrapper) integrate_fn is masked by
+    initial_xs - (chains, d) starting states
+    n, burn_in, skip - as in importance_sample, n is for the whole ensemble
+    walk, stats, seed, profile - as in _mcmc_process_wrapper, the walk adapted on the states of all chains '''
+    integrate_fn, probe = profiling.probe(integrate_fn, limits, vectorized=True, profile=profile)
+
+    report = _run_chains(integrate_fn, dist_fn, proposal_fn, proposal_density, initial_xs, n, burn_in, skip, walk, stats, True, seed)
+    return profiling.report(report, probe)
+
+def importance_sample(integrate_fn, dist_fn, init_fn, limits, n=10000, proposal_fn=None, proposal_density=None, burn_in=1000, skip=1, pool=None, rtol=None, atol=None, max_n=None, max_time=None, vectorized=False, chains=64, ess=None, seed=None, profile=None, stop=None, rounds=None, resume=None, checkpoint=None):
+    ''' Integrate a given function with importance sampling, drawing from dist_fn with metropolis hastings
+    returns a utils.MCMCResult, whose error accounts for the autocorrelation of the chains
+
+    Arguments:
+    integrate_fn - function to integrate f: R^n -> R, should take np.array as sole argument
+    dist_fn - normalized density the chain samples from, must be non-zero on the domain
+    init_fn - returns an initial state (np.array) with non-zero density
+    limits - list of tuples representing intervals [a(x), b(x)] for each dimension
+    n - number of samples to take
+    proposal_fn, proposal_density - proposal x -> x_p and its density q(x, x_p) (None for symmetric proposals),
+                                    defaults to a gaussian random walk run natively, which tunes its step size and
+                                    covariance towards utils.target_acceptance during burn in
+    burn_in - number of steps discarded at the start of every chain
+    skip - keep every skip-th state of the chain
+    pool - workers.WorkerPool (e.g. an Integrator) or remote.RemotePool to sample on, defaults to a shared pool
+    rtol, atol - if either is given, keep extending the chains by n samples until the standard error is below max(atol, rtol * |estimate|)
+    max_n - sample budget for rtol/atol mode, defaults to 100 * n
+    max_time - time budget in seconds for rtol/atol mode
+    vectorized - if True, every worker runs an ensemble of chains that advance together, integrate_fn, dist_fn,
+                 proposal_fn and proposal_density (None for symmetric) then take (chains, d) arrays of states and
+                 return (chains,) arrays (proposal_fn a (chains, d) array). Function limits likewise take the
+                 (chains, d) array
+    chains - number of chains per worker in vectorized mode, init_fn is called once per chain
+    ess - if given, keep extending the chains until the estimate rests on at least this many effective samples
+          (and rtol/atol are met), later rounds being sized by how fast the effective samples have come so far
+    seed - as in integrate, chains keep their own streams from round to round
+    profile - as in integrate, the profile also has the acceptance rate of every round
+    stop, rounds - as in integrate
+    resume, checkpoint - as in integrate, every chain carries on from its last state with its tuned random walk
+                         (result.state is a utils.MCMCState) '''
+    start = time.time()
+    given_seed, seed = seed, utils.seed_sequence(seed)
+    profile = profiling.begin(profile)
+
+    with profiling.phase(profile, 'pool'):
+        pool = pool or workers.default_pool()
+    num_cores = pool.num_workers
+
+    if max_n is None:
+        max_n = 100 * n
+
+    adaptive = rtol is not None or atol is not None or ess is not None
+    total = n
+    if rounds is None:
+        rounds = CHECKPOINT_ROUNDS if checkpoint is not None else 1
+    if not adaptive:
+        n = -(-n // max(rounds, 1))
+
+    target = _mcmc_ensemble_process_wrapper if vectorized else _mcmc_process_wrapper
+    fns = (integrate_fn, dist_fn, proposal_fn, proposal_density)
+    run = utils.run_fingerprint(fns, limits, None, 'mcmc', vectorized, chains if vectorized else 1, skip)
+
+    state = utils.load_checkpoint(checkpoint) if checkpoint is not None and resume is None else getattr(resume, 'state', None)
+    assert resume is None or state is not None, 'only importance sampling results can be resumed'
+
+    if state is not None:
+        assert isinstance(state, utils.MCMCState), 'only importance sampling runs can be resumed'
+        utils.check_resumable(state, run, given_seed)
+        # every job keeps its chains, however many workers there are now
+        seed = utils.resumed_seed(state)
+        result = _chains_result(state, start)
+
+        if (utils.should_stop(result, rtol, atol, max_n, max_time, ess) if adaptive else result.n >= total):
+            return result
+
+        states, walks, stats, segments = list(state.states), list(state.walks), list(state.stats), [list(s) for s in state.segments]
+        moments = state.moments
+    else:
+        if vectorized:
+            states = [np.array([init_fn() for i in range(chains)], dtype=float).reshape(chains, -1) for j in range(num_cores)]
+        else:
+            states = [init_fn()] * num_cores
+
+        moments = utils.Moments(0, 0, 0)
+        walks, stats = [None] * num_cores, [None] * num_cores
+        # per job, the halves of every round of its chains, for split R-hat
+        segments = [[] for j in range(num_cores)]
+        result = None
+
+    # launch some chains to sample
+    jobs_n = len(states)
+    profiling.register(profile, pool, fns)
+    # shortest ess driven round worth running, the chains' autocorrelations need some length to be estimated
+    min_round = MAX_LAG * (chains if vectorized else 1) * jobs_n
+
+    for round_number in itertools.count(1):
+        if result is None:
+            shares = utils.split_samples(n, jobs_n)
+        elif ess is not None and 0 < result.n_eff < ess:
+            # effective samples come about linearly in chain length, so aim straight for the target (with some margin)
+            needed = 1.1 * (ess * result.n / result.n_eff - result.n)
+            shares = utils.split_samples(max(int(min(needed, max_n - result.n)), min_round), jobs_n)
+        elif adaptive:
+            shares = utils.split_samples(n, jobs_n)
+        else:
+            # at least a sample for both halves of every chain
+            shares = utils.split_samples(max(min(n, total - result.n), 2 * (chains if vectorized else 1) * jobs_n), jobs_n)
+
+        # chains that have sampled carry on, with their tuned random walk, from where they stopped, so only those that
+        # haven't yet (a job whose share was 0) still burn in
+        jobs = [((limits, x, k), dict(burn_in=0 if _sampled(g) else burn_in, skip=skip, walk=w, stats=s, seed=c))
+                for x, k, g, w, s, c in zip(states, shares, segments, walks, stats, seed.spawn(jobs_n))]
+        reports = profiling.run(pool, target, fns, jobs, profile)
+
+        moments = utils.merge_moments([moments] + [r.moments for r in reports])
+        for segment, r in zip(segments, reports):
+            segment.append(r.halves)
+
+        states = [r.states for r in reports]
+        walks = [r.walk for r in reports]
+        stats = [r.stats for r in reports]
+
+        state = utils.MCMCState(moments, seed.entropy, seed.spawn_key, seed.n_children_spawned, states, walks, stats, segments,
+                                [r.ess for r in reports], [r.acceptance for r in reports], run)
+        result = _chains_result(state, start)
+
+        if checkpoint is not None:
+            utils.dump_atomic(checkpoint, state)
+
+        if profile is not None:
+            profile.acceptance.append(result.acceptance)
+        profiling.end_round(profile, result)
+
+        if stop is not None and stop(result):
+            return result
+
+        if (utils.should_stop(result, rtol, atol, max_n, max_time, ess) if adaptive else result.n >= total or round_number >= rounds):
+            return result
+
+def _sampled(segment):
+    # whether a job's chains have kept any samples, from the (chains, 2, 3) halves of its rounds so far
+    return any(np.sum(np.asarray(halves)[..., 0]) > 0 for halves in segment)
+
+def _chains_result(state, start):
+    ''' MCMCResult of the chains of an MCMCState, carrying it as result.state '''
+    # chains are independent, so their effective sample sizes add up
+    n_eff = sum(float(np.sum(e)) for e in state.ess)
+    acceptance = float(np.mean(state.acceptance))
+    r_hat = utils.split_r_hat([chain for segment in state.segments for chain in np.stack(segment, axis=1)])
+
+    result = utils.moments_result(state.moments, 1, start, n_eff)
+    result = utils.MCMCResult(result, result.error, result.n, result.n_eff, result.time, acceptance, r_hat)
+    result.state = state
+    return result
+
+async def _run_async(call, kwargs, deadline):
+    ''' Run call(**kwargs, stop=...) on the shared driver threads (see workers.default_executor) and await it
+
+    Once deadline seconds have passed the latest round's result is returned (waiting for the first round if none has
+    finished yet). Once the run is cancelled or returns no further rounds are dispatched, the one running finishes
+    on the pool in the background. '''
+    # only needed by services embedding us, not worth importing for every short lived process
+    import asyncio
+
+    latest = []
+    stopped = threading.Event()
+    user_stop = kwargs.pop('stop', None)
+
+    def stop(result):
+        latest[:] = [result]
+        return stopped.is_set() or (user_stop is not None and bool(user_stop(result)))
+
+    future = asyncio.wrap_future(workers.default_executor().submit(functools.partial(call, stop=stop, **kwargs)))
+
+    try:
+        if deadline is None:
+            return await future
+
+        done, pending = await asyncio.wait({future}, timeout=max(deadline, 0))
+        if done:
+            return future.result()
+
+        stopped.set()
+        return latest[0] if latest else await future
+    finally:
+        stopped.set()
+
+async def integrate_async(fn, limits, deadline=None, rounds=10, **kwargs):
+    ''' integrate without blocking the event loop, returns a utils.IntegrationResult
+
+    The sampling rounds are driven from a shared thread and the jobs run on the pool as usual. Cancelling the
+    awaiting task stops any further rounds from being dispatched.
+
+    Arguments:
+    fn, limits, kwargs - as in integrate
+    deadline - seconds after which the estimate (and error) of the rounds finished so far is returned
+    rounds - as in integrate, a fixed n is taken in rounds by default so a deadline has partial results to return '''
+    return await _run_async(integrate, dict(kwargs, fn=fn, limits=limits, rounds=rounds), deadline)
+
+async def importance_sample_async(integrate_fn, dist_fn, init_fn, limits, deadline=None, rounds=10, **kwargs):
+    ''' importance_sample without blocking the event loop, returns a utils.MCMCResult
+
+    Arguments:
+    integrate_fn, dist_fn, init_fn, limits, kwargs - as in importance_sample
+    deadline, rounds - as in integrate_async, later rounds extend the same chains '''
+    kwargs = dict(kwargs, integrate_fn=integrate_fn, dist_fn=dist_fn, init_fn=init_fn, limits=limits, rounds=rounds)
+    return await _run_async(importance_sample, kwargs, deadline)
 
+def warmup(num_workers=None):
+    ''' Start the shared pool and its workers ahead of the first integration, see workers.warmup '''
+    return workers.warmup(num_workers)
 
-    limits = utils.build_limit_fns(limits)
-    integrate_fn = utils.fn_limit_wrapper(integrate_fn, limits)
+class Integrator(workers.WorkerPool):
+    ''' Owns a long lived pool of workers that integrate and importance_sample run on
 
-    def acceptance_fn(x, x_p):
-        return min(1, (dist_fn(x_p) / dist_fn(x)) * (proposal_density(x, x_p)/ proposal_density(x_p, x)))
+    with Integrator(num_workers=4) as integrator:
+        integrator.integrate(lambda x: x[0] * x[0], [(-1, 1)], n=100000)
+    '''
 
-    def score_fn(x):
-        return integrate_fn(x) / dist_fn(x) 
+    def integrate(self, *args, **kwargs):
+        return integrate(*args, pool=self, **kwargs)
 
-    initial_x = init_fn()
+    def integrate_many(self, *args, **kwargs):
+        return integrate_many(*args, pool=self, **kwargs)
 
-    # launch some processes to sample
-    p = multiprocessing.Pool(num_cores)
+    def importance_sample(self, *args, **kwargs):
+        return importance_sample(*args, pool=self, **kwargs)
 
-    results = [p.apply_async(_mcmc_process_wrapper, args=(score_fn, initial_x, proposal_fn, acceptance_fn, samples_per_core, burn_in, skip)) for i in range(num_cores)] 
-    p.close()
-    p.join()
+    async def integrate_async(self, *args, **kwargs):
+        return await integrate_async(*args, pool=self, **kwargs)
 
-    return sum([r.get() for r in results]) / rectified_n
+    async def importance_sample_async(self, *args, **kwargs):
+        return await importance_sample_async(*args, pool=self, **kwargs)
@@ -0,0 +1,151 @@
+import numpy as np
+import utils
+import profiling
+
+# fraction of a region's samples spent exploring where to bisect it
+EXPLORE_FRACTION = 0.1
+
+# fewest samples to estimate a (half) region's variance with
+MIN_POINTS = 15
+
+# regions with fewer samples than this are sampled plainly instead of bisected
+MIN_BISECT = 4 * MIN_POINTS
+
+def _evaluate(fn, lows, highs, u, vectorized):
+    ''' Values of fn at points u of the unit cube, mapped onto the [lows, highs] cube '''
+    points = lows + (highs - lows) * u
+    return np.asarray(fn(points) if vectorized else [fn(p) for p in points], dtype=float)
+
+def _uniform(lo, hi, n):
+    return lo + (hi - lo) * np.random.uniform(size=(n, len(lo)))
+
+def _choose_split(u, vals, lo, hi):
+    ''' Dimension whose midpoint bisection leaves the least spread, returns (dim, std of left half, std of right half),
+    dim is None if no dimension has enough samples on both sides '''
+    mids = (lo + hi) / 2
+    best = (None, 0, 0)
+
+    for i in range(len(lo)):
+        left = u[:, i] < mids[i]
+
+        if left.sum() < 2 or (~left).sum() < 2:
+            continue
+
+        sl, sr = np.std(vals[left]), np.std(vals[~left])
+
+        if best[0] is None or sl + sr < best[1] + best[2]:
+            best = (i, sl, sr)
+
+    return best
+
+def _halves(lo, hi, dim):
+    mid = (lo[dim] + hi[dim]) / 2
+    left_hi, right_lo = hi.copy(), lo.copy()
+    left_hi[dim], right_lo[dim] = mid, mid
+    return (lo, left_hi), (right_lo, hi)
+
+def _allocate(n, sl, sr):
+    ''' Split n samples between the halves in proportion to their spread '''
+    fraction = sl / (sl + sr) if sl + sr > 0 else 0.5
+    n_left = int(round(n * fraction))
+    return min(max(n_left, MIN_POINTS), n - MIN_POINTS)
+
+def _plain(fn, lows, highs, lo, hi, n, vectorized):
+    if n == 0:
+        return 0.0, np.inf
+
+    vals = _evaluate(fn, lows, highs, _uniform(lo, hi, n), vectorized)
+    var = np.var(vals, ddof=1) / n if n > 1 else 0.0
+    return np.mean(vals), var
+
+def _miser(fn, lows, highs, lo, hi, n, vectorized):
+    ''' Recursive stratified estimate of the mean of fn over the sub-cube [lo, hi] of the unit cube,
+    returns (mean, variance of the mean) '''
+    if n < MIN_BISECT:
+        return _plain(fn, lows, highs, lo, hi, n, vectorized)
+
+    n_explore = max(int(n * EXPLORE_FRACTION), MIN_POINTS)
+    u = _uniform(lo, hi, n_explore)
+    dim, sl, sr = _choose_split(u, _evaluate(fn, lows, highs, u, vectorized), lo, hi)
+
+    if dim is None:
+        return _plain(fn, lows, highs, lo, hi, n - n_explore, vectorized)
+
+    n_rest = n - n_explore
+    n_left = _allocate(n_rest, sl, sr)
+    left, right = _halves(lo, hi, dim)
+
+    mean_l, var_l = _miser(fn, lows, highs, left[0], left[1], n_left, vectorized)
+    mean_r, var_r = _miser(fn, lows, highs, right[0], right[1], n_rest - n_left, vectorized)
+
+    return (mean_l + mean_r) / 2, (var_l + var_r) / 4
+
+def _prepare(fn, lows, highs, limits, vectorized, direct, seed, profile):
+    utils.seed_job(seed)
+    fn, probe = profiling.probe(fn, limits, vectorized, direct, profile)
+
+    return fn, np.asarray(lows, dtype=float), np.asarray(highs, dtype=float), probe
+
+def explore(fn, lows, highs, lo, hi, n, vectorized=False, limits=None, direct=False, seed=None, profile=False):
+    ''' Worker task: sample n points of the sub-cube [lo, hi] and pick how to bisect it, returns (dim, std left, std right) '''
+    fn, lows, highs, probe = _prepare(fn, lows, highs, limits, vectorized, direct, seed, profile)
+    u = _uniform(lo, hi, n)
+    return profiling.report(_choose_split(u, _evaluate(fn, lows, highs, u, vectorized), lo, hi), probe)
+
+def region(fn, lows, highs, lo, hi, n, vectorized=False, limits=None, direct=False, seed=None, profile=False):
+    ''' Worker task: recursive stratified sampling of the sub-cube [lo, hi], returns (mean, variance of the mean) '''
+    fn, lows, highs, probe = _prepare(fn, lows, highs, limits, vectorized, direct, seed, profile)
+    return profiling.report(_miser(fn, lows, highs, lo, hi, n, vectorized), probe)
+
+def sample(pool, fn, lows, highs, n, vectorized=False, limits=None, direct=False, tasks_per_worker=4, seed=None, profile=None):
+    ''' Recursive stratified estimate of the mean of fn over the [lows, highs] cube
+
+    The top of the recursion is run here, bisecting regions (exploring them on the pool) until there are
+    about tasks_per_worker regions per worker, every region is then finished as its own task on the pool.
+    Every task samples from its own stream spawned from seed (see utils.seed_sequence), and reports to
+    profile (a profiling.Profile) if given.
+    Returns (mean, variance of the mean, samples taken) '''
+    seed = utils.seed_sequence(seed)
+    d = len(lows)
+    args = (lows, highs)
+    kwds = dict(vectorized=vectorized, limits=limits, direct=direct)
+
+    # (lo, hi, samples, volume fraction) of every region left to split or sample
+    frontier = [(np.zeros(d), np.ones(d), n, 1.0)]
+    leaves = []
+    taken = 0
+
+    while frontier and len(frontier) + len(leaves) < tasks_per_worker * pool.num_workers:
+        splittable = [r for r in frontier if r[2] >= 2 * MIN_BISECT]
+        leaves += [r for r in frontier if r[2] < 2 * MIN_BISECT]
+
+        if not splittable:
+            frontier = []
+            break
+
+        explores = [max(int(r[2] * EXPLORE_FRACTION), MIN_POINTS) for r in splittable]
+        jobs = [(args + (lo, hi, m), dict(kwds, seed=s)) for (lo, hi, k, v), m, s in zip(splittable, explores, seed.spawn(len(splittable)))]
+        splits = profiling.run(pool, explore, (fn,), jobs, profile)
+        taken += sum(explores)
+
+        frontier = []
+        for (lo, hi, k, v), m, (dim, sl, sr) in zip(splittable, explores, splits):
+            if dim is None:
+                leaves.append((lo, hi, k - m, v))
+                continue
+
+            n_left = _allocate(k - m, sl, sr)
+            left, right = _halves(lo, hi, dim)
+            frontier += [(left[0], left[1], n_left, v / 2), (right[0], right[1], k - m - n_left, v / 2)]
+
+    leaves += frontier
+
+    jobs = [(args + (lo, hi, k), dict(kwds, seed=s)) for (lo, hi, k, v), s in zip(leaves, seed.spawn(len(leaves)))]
+    results = profiling.run(pool, region, (fn,), jobs, profile)
+    taken += sum(k for lo, hi, k, v in leaves)
+
+    # leaves are independent, weight them by their share of the cube
+    mean = sum(v * leaf_mean for (lo, hi, k, v), (leaf_mean, leaf_var) in zip(leaves, results))
+    var = sum(v * v * leaf_var for (lo, hi, k, v), (leaf_mean, leaf_var) in zip(leaves, results))
+
+    return mean, var, taken
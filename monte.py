@@ -1,56 +1,63 @@
 import numpy as np
 import math
-from pathos import multiprocessing
 import sys
-import os
 import numbers
 import utils
+import workers
 
-def _hypercube_sample(fn, lows, highs, n=1000):
+def _hypercube_sample(fn, lows, highs, n=1000, vectorized=False, chunk_size=1000, limits=None, seed=None):
     ''' Sample uniformly across a hypercube
 
     Arguments:
     fn - actual function f: R^n -> R, should take np.array as sole argument
     lows, highs 
-    n - number of samples to take '''
+    n - number of samples to take
+    vectorized - if True, fn takes a (chunk_size, d) np.array and returns a (chunk_size,) np.array
+    chunk_size - number of points drawn at once (and handed to fn per call in vectorized mode)
+    limits - if given, raw limits (see utils.limit_wrapper) that fn is masked by
+    seed - this job's spawned np.random.SeedSequence (see utils.seed_job) '''
+    utils.seed_job(seed)
 
-    # want deterministic seeding for unittesting
-    if 'UNITTESTING' not in os.environ:
-        np.random.seed()
-        
-    CHUNK_SIZE = 1000
+    if limits is not None:
+        fn = utils.limit_wrapper(fn, limits, vectorized)
+
+    # evaluate a whole chunk with one call instead of one call per point
+    score = (lambda points: np.sum(fn(points))) if vectorized else (lambda points: sum(map(fn, points)))
 
     count = 0
 
     # max out the n count so it doesnt allocate a ton of memory and die
-    num_chunks = n // CHUNK_SIZE
+    num_chunks = n // chunk_size
 
     for i in range(num_chunks):
-        points = np.random.uniform(lows, highs, size=(CHUNK_SIZE, len(highs)))
-        count += sum(map(fn, points))
+        points = np.random.uniform(lows, highs, size=(chunk_size, len(highs)))
+        count += score(points)
 
-    points = np.random.uniform(lows, highs, size=(n % CHUNK_SIZE, len(highs)))
-    count += sum(map(fn, points))
+    points = np.random.uniform(lows, highs, size=(n % chunk_size, len(highs)))
+    count += score(points)
 
     return count
 
-def integrate_hypercube(fn, limits, cube=None, n=1000):
+def integrate_hypercube(fn, limits, cube=None, n=1000, vectorized=False, chunk_size=1000, pool=None, seed=None):
     ''' Integrate a given function in a bounded interval
 
     Arguments:
     fn - actual function f: R^n -> R, should take np.array as sole argument
     limits - list of tuples representing intervals [a(x), b(x)] for each dimension
     cube - if limits are not simple real numbers, provide a hypercube of form [(a, b), (c, d), ... ] s.t. it contains the domain of integration 
-    n - number of samples to take '''
+    n - number of samples to take
+    vectorized - if True, fn takes a (chunk_size, d) np.array of points and returns a (chunk_size,) np.array of values,
+                 function limits likewise take the (chunk_size, d) array, e.g. lambda x: 1 - x[:, 0]
+    chunk_size - number of points drawn at once (and handed to fn per call in vectorized mode)
+    pool - workers.WorkerPool to sample on, defaults to a shared pool
+    seed - int or np.random.SeedSequence for reproducible runs, every job gets its own spawned stream '''
     is_hypercube = cube == None
 
-    num_cores = multiprocessing.cpu_count()
-    # change n to something that is easily split up by processes
-    # makes process code a little cleaner
-    samples_per_core = n // num_cores
-    rectified_n = samples_per_core * num_cores
 
-    c = 1 / rectified_n
+    pool = pool or workers.default_pool()
+    num_cores = pool.num_workers
+
+    c = 1 / n
 
     lows = []
     highs = []
@@ -62,81 +69,76 @@ def integrate_hypercube(fn, limits, cube=None, n=1000):
     lows, highs, volume = utils.get_cube_info(cube)
     c *= volume
 
-    if not is_hypercube:
-        limits = utils.build_limit_fns(limits)
+    if is_hypercube:
+        limits = None
+    else:
         # exotic domains
         # get unsigned volume (mc part signs it according to integration rules and limits)
         c = abs(c)
-        fn = utils.fn_limit_wrapper(fn, limits)
-
-    # launch some processes to sample
 
-    p = multiprocessing.Pool(num_cores)
+    # sample on the workers, fn is masked by the (raw) limits over there
+    # every one of the n samples is taken, an uneven split gives the first workers one more
+    shares = utils.split_samples(n, num_cores)
+    jobs = [((lows, highs, k, vectorized, chunk_size, limits), dict(seed=s)) for k, s in zip(shares, utils.seed_sequence(seed).spawn(num_cores))]
+    results = pool.run(_hypercube_sample, (fn,), jobs)
 
-    results = [p.apply_async(_hypercube_sample, args=(fn, lows, highs, samples_per_core)) for i in range(num_cores)] 
-    p.close()
-    p.join()
-
-    return sum([r.get() for r in results]) * c
+    return sum(results) * c
 
 def metropolis_hastings(fn, init_fn, proposal_fn, proposal_density, n, burn_in=1000, skip=1):
+    ''' Chain of states drawn from fn with metropolis hastings
 
-    def acceptance(x, x_p):
-        return min(1, (fn(x_p) / fn(x)) * (proposal_density(x, x_p)/ proposal_density(x_p, x)))
+    proposal_fn None uses a gaussian random walk whose step size is tuned towards utils.target_acceptance
+    during burn in, it is symmetric so proposal_density isn't needed '''
 
     # pick initial state - user must care to pick prior s.t. always state with non-zero density
     x = init_fn()
+    p = fn(x)
+
+    scale, target = 1.0, utils.target_acceptance(np.size(x))
 
     for i in range(n * skip + burn_in):
-        x_p = proposal_fn(x)
+        if proposal_fn is None:
+            x_p = x + scale * np.random.normal(size=np.shape(x))
+            ratio = 1
+        else:
+            x_p = proposal_fn(x)
+            ratio = proposal_density(x, x_p) / proposal_density(x_p, x)
 
-        a = acceptance(x, x_p)
+        p_p = fn(x_p)
+        a = min(1, (p_p / p) * ratio)
 
         if np.random.rand() < a:
-            x = x_p
+            x, p = x_p, p_p
+
+        # robbins monro step on the log scale, burn in only so the kept chain has a fixed kernel
+        if proposal_fn is None and i < burn_in:
+            scale *= math.exp((a - target) / (i + 1) ** 0.6)
 
         if i >= burn_in and (i - burn_in) % skip == 0:
             yield x
 
-def _mcmc_in_process(integrate_fn, proportional_fn, *args, **kwargs):
-    if 'UNITTESTING' not in os.environ:
-        np.random.seed()
+def _mcmc_in_process(integrate_fn, proportional_fn, init_fn, proposal_fn, proposal_density, limits, *args, seed=None, **kwargs):
+    utils.seed_job(seed)
 
-    simulated = metropolis_hastings(proportional_fn, *args, **kwargs)
+    integrate_fn = utils.fn_limit_wrapper(integrate_fn, limits)
+
+    simulated = metropolis_hastings(proportional_fn, init_fn, proposal_fn, proposal_density, *args, **kwargs)
 
     samples = (integrate_fn(s)/proportional_fn(s) for s in simulated)
 
     return sum(samples)
 
-def importance_sample(integrate_fn, proportional_fn, init_fn, limits, n=10000, proposal_fn=None, proposal_density=None, burn_in=1000, skip=1):
-
-    num_cores = multiprocessing.cpu_count()
-    # change n to something that is easily split up by processes
-    # makes process code a little cleaner
-    samples_per_core = n // num_cores
-    rectified_n = samples_per_core * num_cores
-
-    d = len(limits)
+def importance_sample(integrate_fn, proportional_fn, init_fn, limits, n=10000, proposal_fn=None, proposal_density=None, burn_in=1000, skip=1, pool=None, seed=None):
 
-    # default proposal and densities are unit gaussian
-    if proposal_fn == None:
-        # multivar normal runs like 10x slower than normal for some reason, so if d == 1, hardcode univariate distribution
-        cov = np.diag(np.ones(d))
-        if d > 1:
-            proposal_fn = lambda x: np.random.multivariate_normal(x, cov)
-        else:
-            proposal_fn = lambda x: np.random.normal(x)
-
-        proposal_density = lambda x, x_p: (1 / math.pow(2 * math.pi, d/2)) * math.exp(-((x_p - x).T @ (x_p - x) / 2))
+    pool = pool or workers.default_pool()
+    num_cores = pool.num_workers
+    shares = utils.split_samples(n, num_cores)
 
     limits = utils.build_limit_fns(limits)
-    integrate_fn = utils.fn_limit_wrapper(integrate_fn, limits)
-
-    # launch some processes to sample
-    p = multiprocessing.Pool(num_cores)
 
-    results = [p.apply_async(_mcmc_in_process, args=(integrate_fn, proportional_fn, init_fn, proposal_fn, proposal_density, samples_per_core), kwds=dict(burn_in=burn_in, skip=skip)) for i in range(num_cores)] 
-    p.close()
-    p.join()
+    # launch some chains to sample
+    fns = (integrate_fn, proportional_fn, init_fn, proposal_fn, proposal_density)
+    jobs = [((limits, k), dict(burn_in=burn_in, skip=skip, seed=s)) for k, s in zip(shares, utils.seed_sequence(seed).spawn(num_cores))]
+    results = pool.run(_mcmc_in_process, fns, jobs)
 
-    return sum([r.get() for r in results]) / rectified_n
+    return sum(results) / n
@@ -0,0 +1,97 @@
+import ast
+import ctypes
+import math
+import numpy as np
+import sampling
+
+# opcodes of the bytecode run by sampling.cpp, keep in sync with enum Op there
+CONST, VAR, ADD, SUB, MUL, DIV, POW, NEG = range(8)
+
+FUNCTIONS = {name: op for op, name in enumerate(['sin', 'cos', 'tan', 'exp', 'log', 'sqrt', 'abs', 'tanh', 'atan'], NEG + 1)}
+
+BINARY = {ast.Add: ADD, ast.Sub: SUB, ast.Mult: MUL, ast.Div: DIV, ast.Pow: POW}
+
+NAMES = {'pi': math.pi, 'e': math.e}
+
+# c signature of function pointer integrands: double f(const double *x, unsigned int d)
+CFUNCTYPE = ctypes.CFUNCTYPE(ctypes.c_double, ctypes.POINTER(ctypes.c_double), ctypes.c_uint)
+
+class NativeIntegrand(object):
+    ''' Integrand the sampling extension can evaluate without calling back into python, so it can release
+    the gil and sample on threads. Build one with expression or function_pointer.
+
+    Still callable from python, on a single point or a (chunk, d) array of points, so it works with every
+    integrate method, but only uniform sampling of hypercubes gets the threaded native path. '''
+
+    def __init__(self, code=(), consts=(), address=0, source=None, keep_alive=None):
+        self.code = list(code)
+        self.consts = list(consts)
+        self.address = address
+        self.source = source
+        # ctypes object owning the function pointer, mustn't be collected while we're in use
+        self._keep_alive = keep_alive
+
+    def __getstate__(self):
+        # ctypes objects can't be pickled, forked workers share the address anyway
+        state = self.__dict__.copy()
+        state['_keep_alive'] = None
+        return state
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        vals = sampling._native_eval(self.code, self.consts, self.address, np.atleast_2d(x))
+        return vals if x.ndim == 2 else vals[0]
+
+    def moments(self, lows, highs, n, threads, seed):
+        ''' Sample uniformly over the [lows, highs] cube on threads, returns (count, sum, sum of squares)
+
+        seed - list of 32 bit seed words (e.g. from np.random.SeedSequence.generate_state), None for fresh entropy,
+               every thread extends it with its index for a stream of its own '''
+        return sampling._native_moments(self.code, self.consts, self.address, lows, highs, n, threads, seed)
+
+    def __repr__(self):
+        return 'NativeIntegrand({})'.format(self.source or hex(self.address))
+
+def _compile(node, code, consts):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        code += [CONST, len(consts)]
+        consts.append(float(node.value))
+    elif isinstance(node, ast.Name) and node.id in NAMES:
+        code += [CONST, len(consts)]
+        consts.append(NAMES[node.id])
+    elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'x':
+        index = node.slice
+        assert isinstance(index, ast.Constant) and isinstance(index.value, int) and index.value >= 0, 'x can only be indexed by non-negative integer constants'
+        code += [VAR, index.value]
+    elif isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+        _compile(node.left, code, consts)
+        _compile(node.right, code, consts)
+        code += [BINARY[type(node.op)], 0]
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        _compile(node.operand, code, consts)
+        if isinstance(node.op, ast.USub):
+            code += [NEG, 0]
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and len(node.args) == 1 and not node.keywords:
+        _compile(node.args[0], code, consts)
+        code += [FUNCTIONS[node.func.id], 0]
+    else:
+        raise ValueError('unsupported in native expressions: {}'.format(ast.dump(node)))
+
+def expression(source):
+    ''' Compile an arithmetic expression of x into a NativeIntegrand, e.g. expression('x[0] * exp(-x[1] ** 2)')
+
+    Supports numbers, pi, e, x[i], + - * / ** and the functions in FUNCTIONS. '''
+    code, consts = [], []
+    _compile(ast.parse(source, mode='eval').body, code, consts)
+    return NativeIntegrand(code, consts, source=source)
+
+def function_pointer(fn):
+    ''' NativeIntegrand from a compiled c function double f(const double *x, unsigned int d), given as a ctypes
+    function (e.g. from ctypes.CDLL) or its raw address (e.g. a numba cfunc's .address).
+
+    The address is only valid in this process and processes forked from it. A ctypes callback wrapping a
+    python function works, but takes the gil on every call. '''
+    if isinstance(fn, int):
+        return NativeIntegrand(address=fn)
+
+    return NativeIntegrand(address=ctypes.cast(fn, ctypes.c_void_p).value, keep_alive=fn)
@@ -0,0 +1,177 @@
+import collections
+import contextlib
+import os
+import time
+import utils
+
+# what a worker reports back about one profiled job
+# pid - worker process the job ran on
+# points - points fn was sampled at (once per integrand for integrate_many, once per chain sample for mcmc)
+# inside - points inside the limits, which fn itself was evaluated at
+# seconds - wall time of the whole job
+# integrand - seconds spent in fn
+# limits - seconds spent masking fn by the limits, fn's own time excluded
+Job = collections.namedtuple('Job', ['pid', 'points', 'inside', 'seconds', 'integrand', 'limits'])
+
+class Probe(object):
+    ''' Worker side of a profiled job: times the integrands and their limit masking and counts the points they see '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.points = self.inside = 0
+        self.integrand = self.masked = 0.0
+
+    def wrap(self, fn, limits, vectorized=False, direct=False):
+        ''' fn masked by limits as utils.limit_wrapper would, with every call timed '''
+        def timed_fn(x):
+            start = time.perf_counter()
+            value = fn(x)
+            self.integrand += time.perf_counter() - start
+            self.inside += len(x) if vectorized else 1
+            return value
+
+        masked = utils.limit_wrapper(timed_fn, limits, vectorized, direct) if limits is not None else timed_fn
+
+        def masked_fn(x):
+            start = time.perf_counter()
+            value = masked(x)
+            self.masked += time.perf_counter() - start
+            self.points += len(x) if vectorized else 1
+            return value
+
+        return masked_fn
+
+    def job(self):
+        return Job(os.getpid(), self.points, self.inside, time.perf_counter() - self.start, self.integrand, self.masked - self.integrand)
+
+def probe(fn, limits, vectorized=False, direct=False, profile=False):
+    ''' Worker side: fn masked by limits (see utils.limit_wrapper) ready to be sampled, and the Probe timing it
+    if profile, otherwise None. Hand the job's result to report before returning it '''
+    if not profile:
+        return (utils.limit_wrapper(fn, limits, vectorized, direct) if limits is not None else fn), None
+
+    p = Probe()
+    return p.wrap(fn, limits, vectorized, direct), p
+
+def report(result, probe):
+    ''' What a job returns: its result, paired with the Job the probe recorded when profiling '''
+    return result if probe is None else (result, probe.job())
+
+class Profile(object):
+    ''' Where a run spent its time, attached to the result as result.profile
+
+    phases - seconds per phase in the calling process: 'pool' getting the worker pool, 'serialize' pickling the
+             functions for the workers, 'workers' waiting on the slowest job of every round, 'dispatch' the rest
+             of every round on the pool (shipping jobs and results between processes, unpickling newly
+             registered functions on the workers, idle workers),
+             'native' sampling native integrands on threads, 'parent' everything else (merging results, setting up)
+    jobs - Job of every job run on the pool
+    acceptance - mcmc acceptance rate of every round
+    rounds - number of rounds of sampling so far '''
+
+    def __init__(self, callback=None):
+        self.phases = collections.OrderedDict()
+        self.jobs = []
+        self.acceptance = []
+        self.rounds = 0
+        self._callback = callback
+        self._start = time.perf_counter()
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    @property
+    def workers(self):
+        ''' Per worker pid, dict of its jobs, points, seconds and rate (points per second) '''
+        totals = collections.OrderedDict()
+
+        for j in self.jobs:
+            t = totals.setdefault(j.pid, dict(jobs=0, points=0, seconds=0.0))
+            t['jobs'] += 1
+            t['points'] += j.points
+            t['seconds'] += j.seconds
+
+        for t in totals.values():
+            t['rate'] = t['points'] / t['seconds'] if t['seconds'] > 0 else float('inf')
+
+        return totals
+
+    @property
+    def rejected(self):
+        ''' Fraction of the sampled points that fell outside the limits, None before any were sampled '''
+        points = sum(j.points for j in self.jobs)
+        return 1 - sum(j.inside for j in self.jobs) / points if points else None
+
+    @property
+    def breakdown(self):
+        ''' Seconds summed over all jobs spent in the integrand, in masking it by the limits, and in the sampler
+        itself (drawing points, rngs, mcmc proposals and densities, accumulating moments) '''
+        integrand = sum(j.integrand for j in self.jobs)
+        limits = sum(j.limits for j in self.jobs)
+        sampler = sum(j.seconds for j in self.jobs) - integrand - limits
+        return collections.OrderedDict([('integrand', integrand), ('limits', limits), ('sampler', sampler)])
+
+    def __repr__(self):
+        phases = ', '.join('{}={:.4f}s'.format(k, v) for k, v in self.phases.items())
+        return 'Profile(rounds={}, jobs={}, phases=({}), rejected={}, acceptance={})'.format(
+            self.rounds, len(self.jobs), phases, self.rejected, self.acceptance[-1] if self.acceptance else None)
+
+def begin(profile):
+    ''' Profile for a run from its profile argument: None unless profile is True or a callback '''
+    if not profile:
+        return None
+
+    return Profile(profile if callable(profile) else None)
+
+@contextlib.contextmanager
+def phase(profile, name):
+    ''' Time the body as the named phase of profile, does nothing if profile is None '''
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+def register(profile, pool, fns):
+    ''' Serialize fns for the pool's workers up front when profiling, so it is timed on its own '''
+    if profile is not None:
+        with phase(profile, 'serialize'):
+            pool.register(fns)
+
+def run(pool, target, fns, jobs, profile):
+    ''' pool.run(target, fns, jobs), when profiling the jobs are asked to report (see probe) and timed '''
+    if profile is None:
+        return pool.run(target, fns, jobs)
+
+    start = time.perf_counter()
+    results = pool.run(target, fns, [(args, dict(kwds or {}, profile=True)) for args, kwds in jobs])
+    wall = time.perf_counter() - start
+
+    done = [j for r, j in results]
+    slowest = max([j.seconds for j in done] + [0])
+    profile.jobs += done
+    profile.add('workers', min(slowest, wall))
+    profile.add('dispatch', max(wall - slowest, 0))
+
+    return [r for r, j in results]
+
+def end_round(profile, result):
+    ''' End of a round of sampling: attach profile to result and hand it to the callback '''
+    if profile is None:
+        return
+
+    profile.rounds += 1
+    profile.phases['parent'] = 0.0
+    profile.phases['parent'] = max(profile.elapsed - sum(profile.phases.values()), 0)
+    result.profile = profile
+
+    if profile._callback is not None:
+        profile._callback(result)
@@ -0,0 +1,280 @@
+import argparse
+import collections
+import ipaddress
+import os
+import queue
+import socket
+import threading
+import traceback
+from concurrent import futures
+from multiprocessing import connection, reduction
+import workers
+
+class _Job(futures.Future):
+    ''' Pending result of RemotePool.submit, get() as for a pool's AsyncResult '''
+
+    def get(self, timeout=None):
+        return self.result(timeout)
+
+def _start(job):
+    # jobs handed back by a lost worker are running already, False if cancelled
+    return job.running() or job.set_running_or_notify_cancel()
+
+class _Worker(object):
+    def __init__(self, address, conn):
+        self.address = address
+        self.conn = conn
+        # registration keys this worker has been sent the fns of, as many as it remembers
+        self.keys = collections.OrderedDict()
+
+    def sent(self, key):
+        self.keys[key] = True
+        self.keys.move_to_end(key)
+
+        if len(self.keys) > workers.MAX_REGISTERED:
+            self.keys.popitem(last=False)
+
+class RemotePool(object):
+    ''' Pool of remote worker processes (see serve) reached over tcp or unix sockets, usable wherever a
+    workers.WorkerPool is, e.g. integrate(..., pool=RemotePool([('node1', 5000), ('node2', 5000)]))
+
+    Every job is sent, with its target and args, to the next idle worker, which streams its result (a job's
+    accumulators, e.g. utils.Moments) back as it finishes. Integrands are serialized once per run (see
+    workers.serialize) and sent to a worker only the first time one of its jobs needs them. A worker that drops its connection (or takes longer than timeout)
+    is dropped and its job is handed to another one, since jobs carry their own seeds the result is the same as if
+    it had never been lost. Exceptions raised by a job are raised by get/run as with a local pool, as are jobs or
+    results that can't be (un)pickled on this side, and anything else that leaves a connection in an unknown state
+    (its worker is then dropped).
+
+    Jobs are unpickled on the workers, which therefore must only be reachable by trusted clients (see authkey).
+
+    Arguments:
+    addresses - (host, port) tuples for tcp, paths for unix sockets, of running workers
+    authkey - bytes shared with the workers, which every connection is authenticated with
+    timeout - seconds a job may take before its worker is considered lost, None to wait for as long as it takes
+    jobs_per_worker - num_workers is this many per connected worker, so callers split their work into more, smaller
+                      jobs, which balance across uneven nodes and lose less to a lost worker '''
+
+    def __init__(self, addresses, authkey=None, timeout=None, jobs_per_worker=1):
+        self.timeout = timeout
+        self.jobs_per_worker = jobs_per_worker
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # fns serialized by register for the next run of them
+        self._next = None
+
+        self._workers = [_Worker(a, connection.Client(a, authkey=authkey)) for a in addresses]
+        self._alive = len(self._workers)
+        self._threads = [threading.Thread(target=self._dispatch, args=(w,), daemon=True) for w in self._workers]
+
+        for t in self._threads:
+            t.start()
+
+    @property
+    def num_workers(self):
+        return max(self._alive, 1) * self.jobs_per_worker
+
+    def register(self, fns):
+        ''' Serialize fns for the workers now rather than in the next run of them '''
+        fns = tuple(fns)
+        key, payload = workers.serialize(fns)
+
+        with self._lock:
+            self._next = (fns, key, payload)
+
+    def _register(self, fns):
+        with self._lock:
+            if self._next is not None and len(self._next[0]) == len(fns) and all(a is b for a, b in zip(self._next[0], fns)):
+                fns, key, payload = self._next
+                self._next = None
+                return key, payload
+
+        # by value with the globals they use, the workers don't share the client's __main__ as forked ones do
+        return workers.serialize(fns)
+
+    def _submit(self, target, key, payload, args, kwds):
+        job = _Job()
+        self._queue.put((job, (target, key, payload, args, kwds or {})))
+
+        if self._alive == 0:
+            self._fail_pending()
+
+        return job
+
+    def submit(self, target, fns, args=(), kwds=None):
+        ''' Run target(*fns, *args, **kwds) on some worker, returns a future whose get() waits for the result '''
+        key, payload = self._register(tuple(fns))
+        return self._submit(target, key, payload, args, kwds)
+
+    def run(self, target, fns, jobs):
+        ''' Run one job per (args, kwds) in jobs and wait for all of them, returns list of results '''
+        key, payload = self._register(tuple(fns))
+        results = [self._submit(target, key, payload, args, kwds) for args, kwds in jobs]
+        return [r.get() for r in results]
+
+    def _dispatch(self, worker):
+        # one thread per worker, feeding it a job at a time
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            job, call = item
+            if not _start(job):
+                continue
+
+            try:
+                status, value = self._call(worker, call)
+            except (OSError, EOFError, TimeoutError):
+                # lost, someone else takes the job
+                self._queue.put(item)
+                self._lose(worker)
+                return
+            except Exception as e:
+                # who knows what is left on the connection, the job fails and the worker is no longer used
+                job.set_exception(e)
+                self._lose(worker)
+                return
+
+            if status == 'result':
+                job.set_result(value)
+            else:
+                job.set_exception(value)
+
+    def _call(self, worker, call):
+        target, key, payload, args, kwds = call
+        reply = self._exchange(worker, ('job', target, key, None if key in worker.keys else payload, args, kwds))
+
+        if reply[0] == 'missing':
+            # the worker forgot the fns (or was restarted at the same address)
+            reply = self._exchange(worker, ('job', target, key, payload, args, kwds))
+
+        worker.sent(key)
+        return reply
+
+    def _exchange(self, worker, message):
+        # pickled and unpickled here rather than by send and recv, so that a job or reply that can't be fails that
+        # job alone and leaves the connection as it was
+        try:
+            data = reduction.ForkingPickler.dumps(message)
+        except Exception as e:
+            return ('error', e)
+
+        worker.conn.send_bytes(data)
+
+        if self.timeout is not None and not worker.conn.poll(self.timeout):
+            raise TimeoutError('worker at {} timed out'.format(worker.address))
+
+        data = worker.conn.recv_bytes()
+        try:
+            return reduction.ForkingPickler.loads(data)
+        except Exception as e:
+            return ('error', e)
+
+    def _lose(self, worker):
+        try:
+            worker.conn.close()
+        except OSError:
+            pass
+
+        with self._lock:
+            self._alive -= 1
+
+        if self._alive == 0:
+            self._fail_pending()
+
+    def _fail_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if item is not None and _start(item[0]):
+                item[0].set_exception(ConnectionError('no remote workers left'))
+
+    def close(self):
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        for w in self._workers:
+            w.conn.close()
+
+    def terminate(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _serve_client(conn):
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        kind, target, key, payload, args, kwds = message
+
+        if payload is None and key not in workers._registered:
+            conn.send(('missing', None))
+            continue
+
+        try:
+            reply = ('result', workers._run_registered(target, key, payload, args, kwds))
+        except Exception as e:
+            reply = ('error', e)
+
+        try:
+            conn.send(reply)
+        except Exception:
+            # an unpicklable result or exception
+            conn.send(('error', RuntimeError(traceback.format_exc())))
+
+def _loopback(host):
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (OSError, ValueError):
+        return False
+
+def serve(address, authkey=None):
+    ''' Run a worker for RemotePool clients at address ((host, port) or a unix socket path), serving one client at a
+    time until killed. The address is printed once listening, with port 0 picking a free port.
+    Anyone who can connect can run code on the worker, so tcp addresses other than loopback ones need an authkey
+    (ValueError otherwise) '''
+    if isinstance(address, tuple) and authkey is None and not _loopback(address[0]):
+        raise ValueError('refusing to serve {}:{} without an authkey, anyone reaching it could run code here'.format(*address))
+
+    with connection.Listener(address, authkey=authkey) as listener:
+        print(listener.address, flush=True)
+
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, connection.AuthenticationError):
+                continue
+
+            with conn:
+                _serve_client(conn)
+
+def parse_address(text):
+    ''' (host, port) for 'host:port', otherwise the text as a unix socket path '''
+    host, sep, port = text.rpartition(':')
+    return (host, int(port)) if sep and port.isdigit() else text
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Remote sampling worker for remote.RemotePool')
+    parser.add_argument('address', help='host:port to listen on (port 0 for any free one), or a unix socket path')
+    parser.add_argument('--authkey', default=os.environ.get('INTEGRATION_AUTHKEY'),
+                        help='key clients must authenticate with, defaults to $INTEGRATION_AUTHKEY')
+    args = parser.parse_args(argv)
+    try:
+        serve(parse_address(args.address), args.authkey.encode() if args.authkey else None)
+    except ValueError as e:
+        parser.error('{}, pass --authkey or set $INTEGRATION_AUTHKEY'.format(e))
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,10 @@
 #include <pybind11/numpy.h>
 #include <stdlib.h>
 #include <random>
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+#include <string>
 #include <thread>
 #include <future>
 
@@ -10,38 +14,538 @@ namespace py = pybind11;
 
 typedef unsigned int uint;
 
-double _sample_hypercube(py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned int n) {
-    std::random_device rd;
-    unsigned int seed = getenv("UNITTESTING") == NULL ? rd() : 0;
-    std::mt19937 gen(seed);
-    std::vector<std::uniform_real_distribution<double>> uniform_dists;
-    double count = 0;
+// running count, sum and sum of squares of sampled values, mergeable across workers
+struct Moments {
+    unsigned long long n = 0;
+    double total = 0;
+    double total_sq = 0;
+
+    void add(double v) {
+        n++;
+        total += v;
+        total_sq += v * v;
+    }
+};
+
+typedef std::vector<uint32_t> Seed;
+
+// seed words from python: None for fresh entropy, an int, or a sequence of 32 bit words
+// (e.g. numpy's SeedSequence.generate_state) so that spawned streams keep all of their entropy
+Seed seed_words(py::object seed) {
+    if (seed.is_none()) {
+        std::random_device rd;
+        return Seed{rd(), rd(), rd(), rd()};
+    }
+
+    if (py::isinstance<py::int_>(seed)) {
+        unsigned long long value = seed.cast<unsigned long long>();
+        return Seed{(uint32_t)value, (uint32_t)(value >> 32)};
+    }
+
+    return seed.cast<Seed>();
+}
+
+std::mt19937 make_generator(const Seed &seed) {
+    std::seed_seq seq(seed.begin(), seed.end());
+    return std::mt19937(seq);
+}
+
+// fn's values at the first rows of the (chunk, dim) array xs, added to m. In vectorized mode fn gets those rows as
+// one array and must return one value per row, otherwise it is called with every row as a 1d array, as under every
+// other method
+void add_values(Moments &m, py::function fn, py::array_t<double> &xs, uint rows, uint chunk, bool vectorized) {
+    py::object batch = rows == chunk ? (py::object)xs : xs[py::slice(0, rows, 1)];
+
+    if (vectorized) {
+        py::array_t<double, py::array::forcecast> ys = fn(batch);
+        auto vals = ys.unchecked<1>();
+
+        if ((uint)vals.shape(0) != rows) {
+            throw std::invalid_argument("vectorized fn must return one value per point");
+        }
+
+        for (py::ssize_t j = 0; j < vals.shape(0); j++) {
+            m.add(vals(j));
+        }
+    } else {
+        for (uint j = 0; j < rows; j++) {
+            m.add(fn(xs[py::int_(j)]).cast<double>());
+        }
+    }
+}
+
+// uniform samples of fn over the [lows, highs] cube, exactly n of them. Points are drawn chunk rows at a time into
+// one contiguous (chunk, dim) numpy array, reused for every chunk, which is handed to fn whole (only its first rows
+// for a last, partial chunk) in vectorized mode and one row (a 1d array) at a time otherwise
+Moments hypercube_moments(py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned long long n, bool vectorized, unsigned int chunk, const Seed &seed) {
+    std::mt19937 gen = make_generator(seed);
+    std::uniform_real_distribution<double> unit(0.0, 1.0);
+    Moments m;
+    py::ssize_t dim = highs.size();
+    chunk = (uint)std::max(std::min((unsigned long long)chunk, n), 1ull);
+
+    py::array_t<double> xs({(py::ssize_t)chunk, dim});
+    double *buf = xs.mutable_data();
+
+    for (unsigned long long done = 0; done < n; done += chunk) {
+        uint rows = (uint)std::min((unsigned long long)chunk, n - done);
+
+        for (uint j = 0; j < rows; j++) {
+            for (py::ssize_t i = 0; i < dim; i++) {
+                // scale by hand so that lows > highs still works
+                buf[j * dim + i] = lows[i] + (highs[i] - lows[i]) * unit(gen);
+            }
+        }
+
+        add_values(m, fn, xs, rows, chunk, vectorized);
+    }
+
+    return m;
+}
+
+double _sample_hypercube(py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned long long n, py::object seed) {
+    return hypercube_moments(fn, lows, highs, n, false, 1000, seed_words(seed)).total;
+}
+
+double _sample_hypercube_vectorized(py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned long long n, unsigned int chunk, py::object seed) {
+    return hypercube_moments(fn, lows, highs, n, true, chunk, seed_words(seed)).total;
+}
+
+py::tuple _hypercube_moments(py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned long long n, bool vectorized, unsigned int chunk, py::object seed) {
+    Moments m = hypercube_moments(fn, lows, highs, n, vectorized, chunk, seed_words(seed));
+    return py::make_tuple(m.n, m.total, m.total_sq);
+}
+
+// low discrepancy sequences for quasi monte carlo, both randomized so that
+// independently seeded replicates give an unbiased estimate and an error bar
+
+// primitive polynomial degree, coefficients and initial direction numbers
+// for dimensions 2.. (Joe & Kuo, new-joe-kuo-6.21201), dimension 1 is the van der corput sequence
+struct SobolPoly {
+    uint s;
+    uint a;
+    uint m[7];
+};
+
+static const SobolPoly SOBOL_POLYS[] = {
+    {1, 0, {1}},
+    {2, 1, {1, 3}},
+    {3, 1, {1, 3, 1}},
+    {3, 2, {1, 1, 1}},
+    {4, 1, {1, 1, 3, 3}},
+    {4, 4, {1, 3, 5, 13}},
+    {5, 2, {1, 1, 5, 5, 17}},
+    {5, 4, {1, 1, 5, 5, 5}},
+    {5, 7, {1, 1, 7, 11, 19}},
+    {5, 11, {1, 1, 5, 1, 1}},
+    {5, 13, {1, 1, 1, 3, 11}},
+    {5, 14, {1, 3, 5, 5, 31}},
+    {6, 1, {1, 3, 3, 9, 7, 49}},
+    {6, 13, {1, 1, 1, 15, 21, 21}},
+    {6, 16, {1, 3, 1, 13, 27, 49}},
+    {6, 19, {1, 1, 1, 15, 7, 5}},
+    {6, 22, {1, 3, 1, 15, 13, 25}},
+    {6, 25, {1, 1, 5, 5, 19, 61}},
+    {7, 1, {1, 3, 7, 11, 23, 15, 103}},
+    {7, 4, {1, 3, 7, 13, 13, 15, 69}},
+};
+
+static const uint SOBOL_BITS = 32;
+static const uint SOBOL_MAX_DIM = 1 + sizeof(SOBOL_POLYS) / sizeof(SOBOL_POLYS[0]);
+
+// sobol points with a random linear matrix scramble and a random digital shift per dimension
+class Sobol {
+    uint dim;
+    unsigned long long index = 0;
+    std::vector<std::vector<uint32_t>> v;
+    std::vector<uint32_t> x;
+
+public:
+    Sobol(uint dim, std::mt19937 &gen, bool scramble = true) : dim(dim), v(dim, std::vector<uint32_t>(SOBOL_BITS)), x(dim) {
+        if (dim > SOBOL_MAX_DIM) {
+            throw std::invalid_argument("sobol sequence supports at most " + std::to_string(SOBOL_MAX_DIM) + " dimensions");
+        }
+
+        for (uint k = 0; k < SOBOL_BITS; k++) {
+            v[0][k] = 1u << (SOBOL_BITS - 1 - k);
+        }
+
+        for (uint j = 1; j < dim; j++) {
+            const SobolPoly &p = SOBOL_POLYS[j - 1];
+
+            for (uint k = 0; k < SOBOL_BITS; k++) {
+                if (k < p.s) {
+                    v[j][k] = p.m[k] << (SOBOL_BITS - 1 - k);
+                } else {
+                    v[j][k] = v[j][k - p.s] ^ (v[j][k - p.s] >> p.s);
+
+                    for (uint i = 1; i < p.s; i++) {
+                        if ((p.a >> (p.s - 1 - i)) & 1) {
+                            v[j][k] ^= v[j][k - i];
+                        }
+                    }
+                }
+            }
+        }
+
+        if (!scramble) {
+            return;
+        }
+
+        // scramble: multiply the digits of every direction number by a random lower triangular matrix
+        // with unit diagonal, then start from a random shift instead of 0
+        for (uint j = 0; j < dim; j++) {
+            // row r holds the bits of digit r and the (random) digits before it
+            std::vector<uint32_t> rows(SOBOL_BITS);
+
+            for (uint r = 0; r < SOBOL_BITS; r++) {
+                uint32_t before = r == 0 ? 0u : ~0u << (SOBOL_BITS - r);
+                rows[r] = (gen() & before) | (1u << (SOBOL_BITS - 1 - r));
+            }
+
+            for (uint k = 0; k < SOBOL_BITS; k++) {
+                uint32_t scrambled = 0;
+
+                for (uint r = 0; r < SOBOL_BITS; r++) {
+                    if (__builtin_parity(v[j][k] & rows[r])) {
+                        scrambled |= 1u << (SOBOL_BITS - 1 - r);
+                    }
+                }
+                v[j][k] = scrambled;
+            }
+
+            x[j] = gen();
+        }
+    }
+
+    void next(double *out) {
+        for (uint j = 0; j < dim; j++) {
+            // the extra half ulp keeps points off exactly 0
+            out[j] = (x[j] + 0.5) / 4294967296.0;
+        }
+
+        // gray code order: flip the direction number of the lowest zero bit of the index
+        uint c = __builtin_ctzll(~index);
+        index++;
+
+        if (c < SOBOL_BITS) {
+            for (uint j = 0; j < dim; j++) {
+                x[j] ^= v[j][c];
+            }
+        }
+    }
+};
+
+// halton points with an independent random digit permutation per dimension and digit position
+class Halton {
+    uint dim;
+    unsigned long long index = 0;
+    std::vector<uint> bases;
+    std::vector<std::vector<std::vector<uint>>> perms;
+
+public:
+    Halton(uint dim, std::mt19937 &gen, bool scramble = true) : dim(dim), perms(dim) {
+        for (uint p = 2; bases.size() < dim; p++) {
+            bool prime = true;
+
+            for (uint b : bases) {
+                if (p % b == 0) {
+                    prime = false;
+                    break;
+                }
+            }
+
+            if (prime) {
+                bases.push_back(p);
+            }
+        }
+
+        for (uint j = 0; j < dim; j++) {
+            // enough digits to resolve a double
+            uint digits = (uint)std::ceil(53 * std::log(2.0) / std::log((double)bases[j]));
+
+            for (uint k = 0; k < digits; k++) {
+                std::vector<uint> perm(bases[j]);
+
+                for (uint i = 0; i < bases[j]; i++) {
+                    perm[i] = i;
+                }
+
+                if (scramble) {
+                    std::shuffle(perm.begin(), perm.end(), gen);
+                }
+                perms[j].push_back(perm);
+            }
+        }
+    }
+
+    void next(double *out) {
+        for (uint j = 0; j < dim; j++) {
+            uint b = bases[j];
+            unsigned long long i = index;
+            double scale = 1.0 / b;
+            double u = 0;
+
+            // every digit position is permuted, including the leading zeros of small indices
+            for (const std::vector<uint> &perm : perms[j]) {
+                u += perm[i % b] * scale;
+                i /= b;
+                scale /= b;
+            }
+
+            out[j] = u;
+        }
+
+        index++;
+    }
+};
+
+template <typename Sequence>
+Moments sequence_moments(Sequence &seq, py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned long long n, bool vectorized, unsigned int chunk) {
+    Moments m;
     unsigned int dim = highs.size();
+    std::vector<double> u(dim);
+    chunk = (uint)std::max(std::min((unsigned long long)chunk, n), 1ull);
+
+    py::array_t<double> xs({(py::ssize_t)chunk, (py::ssize_t)dim});
+    auto buf = xs.mutable_unchecked<2>();
+
+    for (unsigned long long done = 0; done < n; done += chunk) {
+        uint rows = (uint)std::min((unsigned long long)chunk, n - done);
+
+        for (uint j = 0; j < rows; j++) {
+            seq.next(u.data());
+
+            for (uint i = 0; i < dim; i++) {
+                buf(j, i) = lows[i] + (highs[i] - lows[i]) * u[i];
+            }
+        }
+
+        add_values(m, fn, xs, rows, chunk, vectorized);
+    }
+
+    return m;
+}
+
+py::tuple _qmc_moments(py::function fn, std::vector<double> lows, std::vector<double> highs, unsigned long long n, std::string method, py::object seed, bool vectorized, unsigned int chunk) {
+    std::mt19937 gen = make_generator(seed_words(seed));
+    Moments m;
+
+    if (method == "sobol") {
+        Sobol seq(highs.size(), gen);
+        m = sequence_moments(seq, fn, lows, highs, n, vectorized, chunk);
+    } else if (method == "halton") {
+        Halton seq(highs.size(), gen);
+        m = sequence_moments(seq, fn, lows, highs, n, vectorized, chunk);
+    } else {
+        throw std::invalid_argument("unknown quasi monte carlo method " + method);
+    }
+
+    return py::make_tuple(m.n, m.total, m.total_sq);
+}
+
+py::array_t<double> _qmc_points(std::string method, unsigned int dim, unsigned int n, py::object seed, bool scramble) {
+    std::mt19937 gen = make_generator(seed_words(seed));
+    py::array_t<double> xs({(py::ssize_t)n, (py::ssize_t)dim});
+    double *out = xs.mutable_data();
+
+    if (method == "sobol") {
+        Sobol seq(dim, gen, scramble);
+        for (uint j = 0; j < n; j++) {
+            seq.next(out + (size_t)j * dim);
+        }
+    } else if (method == "halton") {
+        Halton seq(dim, gen, scramble);
+        for (uint j = 0; j < n; j++) {
+            seq.next(out + (size_t)j * dim);
+        }
+    } else {
+        throw std::invalid_argument("unknown quasi monte carlo method " + method);
+    }
+
+    return xs;
+}
+
+// integrands that run without python: a small stack bytecode or a c function pointer
+// double f(const double *x, unsigned int d), so sampling can release the gil and use threads
+
+// opcodes, keep in sync with native.py
+enum Op {
+    OP_CONST = 0, OP_VAR, OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_POW, OP_NEG,
+    OP_SIN, OP_COS, OP_TAN, OP_EXP, OP_LOG, OP_SQRT, OP_ABS, OP_TANH, OP_ATAN
+};
+
+typedef double (*native_fn)(const double *, unsigned int);
+
+class NativeIntegrand {
+    // (op, arg) pairs, arg indexes consts for OP_CONST and x for OP_VAR
+    std::vector<int> code;
+    std::vector<double> consts;
+    native_fn ptr;
+    uint depth = 0;
+    uint vars = 0;
+
+public:
+    NativeIntegrand(std::vector<int> code, std::vector<double> consts, size_t address) : code(code), consts(consts), ptr((native_fn)address) {
+        // check once up front so that running the bytecode needs no checks
+        int size = 0;
+        bool ok = code.size() % 2 == 0;
+
+        for (size_t i = 0; ok && i < code.size(); i += 2) {
+            int op = code[i], arg = code[i + 1];
 
-    for (unsigned int i = 0; i < dim; i++){
-        uniform_dists.push_back(std::uniform_real_distribution<double>(lows[i], highs[i]));
+            if (op == OP_CONST || op == OP_VAR) {
+                ok = arg >= 0 && (op == OP_VAR || arg < (int)consts.size());
+                size++;
+                if (op == OP_VAR) {
+                    vars = std::max(vars, (uint)arg + 1);
+                }
+            } else if (op >= OP_ADD && op <= OP_POW) {
+                ok = size >= 2;
+                size--;
+            } else {
+                ok = op >= OP_NEG && op <= OP_ATAN && size >= 1;
+            }
+
+            depth = std::max(depth, (uint)size);
+        }
+
+        if (ptr == NULL && (!ok || size != 1)) {
+            throw std::invalid_argument("malformed native integrand bytecode");
+        }
+    }
+
+    void check_dim(uint dim) const {
+        if (ptr == NULL && vars > dim) {
+            throw std::invalid_argument("native integrand uses x[" + std::to_string(vars - 1) + "] but points only have " + std::to_string(dim) + " dimensions");
+        }
+    }
+
+    uint stack_size() const {
+        return depth;
     }
 
-    uint CHUNK=1000;
+    double operator()(const double *x, uint dim, double *stack) const {
+        if (ptr != NULL) {
+            return ptr(x, dim);
+        }
+
+        int top = -1;
 
-    std::vector<std::vector<double>> xs(CHUNK, std::vector<double>(dim));
+        for (size_t i = 0; i < code.size(); i += 2) {
+            int arg = code[i + 1];
 
-    for (unsigned int c = 0; c < (uint)(n / CHUNK); c++) {
-        for (unsigned int j = 0; j < CHUNK; j++) {
-            for (unsigned int i = 0; i < dim; i++) {
-                xs[j][i] = uniform_dists[i](gen);
+            switch (code[i]) {
+                case OP_CONST: stack[++top] = consts[arg]; break;
+                case OP_VAR: stack[++top] = x[arg]; break;
+                case OP_ADD: top--; stack[top] += stack[top + 1]; break;
+                case OP_SUB: top--; stack[top] -= stack[top + 1]; break;
+                case OP_MUL: top--; stack[top] *= stack[top + 1]; break;
+                case OP_DIV: top--; stack[top] /= stack[top + 1]; break;
+                case OP_POW: top--; stack[top] = std::pow(stack[top], stack[top + 1]); break;
+                case OP_NEG: stack[top] = -stack[top]; break;
+                case OP_SIN: stack[top] = std::sin(stack[top]); break;
+                case OP_COS: stack[top] = std::cos(stack[top]); break;
+                case OP_TAN: stack[top] = std::tan(stack[top]); break;
+                case OP_EXP: stack[top] = std::exp(stack[top]); break;
+                case OP_LOG: stack[top] = std::log(stack[top]); break;
+                case OP_SQRT: stack[top] = std::sqrt(stack[top]); break;
+                case OP_ABS: stack[top] = std::fabs(stack[top]); break;
+                case OP_TANH: stack[top] = std::tanh(stack[top]); break;
+                case OP_ATAN: stack[top] = std::atan(stack[top]); break;
             }
-            count += fn(xs[j]).cast<double>();
+        }
+
+        return stack[0];
+    }
+};
+
+Moments native_moments_thread(const NativeIntegrand &fn, const std::vector<double> &lows, const std::vector<double> &highs, unsigned long long n, std::seed_seq &seq) {
+    std::mt19937 gen(seq);
+    std::uniform_real_distribution<double> unit(0.0, 1.0);
+    uint dim = highs.size();
+    std::vector<double> x(dim);
+    std::vector<double> stack(fn.stack_size() + 1);
+    Moments m;
+
+    for (unsigned long long j = 0; j < n; j++) {
+        for (uint i = 0; i < dim; i++) {
+            x[i] = lows[i] + (highs[i] - lows[i]) * unit(gen);
+        }
+        m.add(fn(x.data(), dim, stack.data()));
+    }
+
+    return m;
+}
+
+py::tuple _native_moments(std::vector<int> code, std::vector<double> consts, size_t address, std::vector<double> lows, std::vector<double> highs, unsigned long long n, unsigned int threads, py::object seed) {
+    NativeIntegrand fn(code, consts, address);
+    Seed words = seed_words(seed);
+    fn.check_dim(highs.size());
+    threads = std::max(threads, 1u);
+    std::vector<Moments> parts(threads);
+
+    {
+        // nothing below touches python, so let other python threads run meanwhile
+        py::gil_scoped_release release;
+        std::vector<std::thread> pool;
+
+        for (uint t = 0; t < threads; t++) {
+            // leftover samples go to the first threads
+            unsigned long long share = n / threads + (t < n % threads ? 1 : 0);
+
+            pool.emplace_back([&, t, share]() {
+                // one independent stream per thread, the thread index is one more seed word
+                Seed thread_words(words);
+                thread_words.push_back(t);
+                std::seed_seq seq(thread_words.begin(), thread_words.end());
+                parts[t] = native_moments_thread(fn, lows, highs, share, seq);
+            });
+        }
+
+        for (std::thread &th : pool) {
+            th.join();
+        }
+    }
+
+    Moments m;
+    for (const Moments &p : parts) {
+        m.n += p.n;
+        m.total += p.total;
+        m.total_sq += p.total_sq;
+    }
+
+    return py::make_tuple(m.n, m.total, m.total_sq);
+}
+
+py::array_t<double> _native_eval(std::vector<int> code, std::vector<double> consts, size_t address, py::array_t<double, py::array::c_style | py::array::forcecast> points) {
+    NativeIntegrand fn(code, consts, address);
+
+    if (points.ndim() != 2) {
+        throw std::invalid_argument("points must be a (n, d) array");
+    }
+
+    py::ssize_t rows = points.shape(0);
+    uint dim = points.shape(1);
+    fn.check_dim(dim);
+    py::array_t<double> vals(rows);
+    double *out = vals.mutable_data();
+    const double *x = points.data();
+    std::vector<double> stack(fn.stack_size() + 1);
+
+    {
+        py::gil_scoped_release release;
+
+        for (py::ssize_t j = 0; j < rows; j++) {
+            out[j] = fn(x + j * dim, dim, stack.data());
         }
     }
 
-    return count;
+    return vals;
 }
 
-std::vector<py::array> _metropolis_hastings(py::array x, py::function proposal_fn, py::function acceptance_fn, unsigned int n, unsigned int burn_in, unsigned int skip) {
-    std::random_device rd;
-    unsigned int seed = getenv("UNITTESTING") == NULL ? rd() : 0;
-    std::mt19937 gen(seed);
+std::vector<py::array> _metropolis_hastings(py::array x, py::function proposal_fn, py::function acceptance_fn, unsigned int n, unsigned int burn_in, unsigned int skip, py::object seed) {
+    std::mt19937 gen = make_generator(seed_words(seed));
     std::uniform_real_distribution<> dis(0.0, 1.0);
 
     std::vector<py::array> vals;
@@ -62,9 +566,522 @@ std::vector<py::array> _metropolis_hastings(py::array x, py::function proposal_f
     return vals; 
 }
 
+// symmetric gaussian random walk x_p = x + scale * L z with L L^T = cov, so metropolis hastings needs no proposal density.
+// while adapting (burn in only, so the kept part of the chain has a fixed kernel) the scale takes robbins monro steps
+// towards a target acceptance rate and cov follows the covariance of the states seen so far (haario et al's adaptive metropolis)
+class RandomWalk {
+    // states observed before the empirical covariance replaces the starting one, and how often it is refactored
+    static const unsigned long long WARM_UP = 200;
+    static const unsigned long long REFACTOR_EVERY = 50;
+
+    uint dim;
+    double log_scale, target;
+    std::vector<double> cov, chol, mean, m2, z;
+    unsigned long long steps = 0, seen = 0;
+    bool empirical = false;
+
+    // lower cholesky factor of c into chol, false (leaving chol alone) if c isn't positive definite
+    bool factor(const std::vector<double> &c) {
+        std::vector<double> l(dim * dim, 0.0);
+
+        for (uint i = 0; i < dim; i++) {
+            for (uint j = 0; j <= i; j++) {
+                double s = c[i * dim + j];
+                for (uint k = 0; k < j; k++) {
+                    s -= l[i * dim + k] * l[j * dim + k];
+                }
+
+                if (i == j) {
+                    if (!(s > 0)) {
+                        return false;
+                    }
+                    l[i * dim + i] = std::sqrt(s);
+                } else {
+                    l[i * dim + j] = s / l[j * dim + j];
+                }
+            }
+        }
+
+        chol = l;
+        return true;
+    }
+
+  public:
+    RandomWalk(uint dim, double scale, std::vector<double> cov, double target)
+        : dim(dim), log_scale(std::log(scale)), target(target), cov(cov), mean(dim, 0.0), m2(dim * dim, 0.0), z(dim) {
+        if (cov.size() != (size_t)dim * dim || !factor(cov)) {
+            throw std::invalid_argument("proposal covariance must be a positive definite (d, d) matrix");
+        }
+    }
+
+    void propose(const double *x, double *out, std::mt19937 &gen, std::normal_distribution<> &normal) {
+        double s = std::exp(log_scale);
+
+        for (uint i = 0; i < dim; i++) {
+            z[i] = normal(gen);
+        }
+
+        for (uint i = 0; i < dim; i++) {
+            double step = 0;
+            for (uint j = 0; j <= i; j++) {
+                step += chol[i * dim + j] * z[j];
+            }
+            out[i] = x[i] + s * step;
+        }
+    }
+
+    // robbins monro step on the log scale, a is the mean acceptance probability of one step
+    void adapt_scale(double a) {
+        steps++;
+        log_scale += std::pow((double)steps, -0.6) * (a - target);
+    }
+
+    // add a state to the running covariance, welford style
+    void observe(const double *x) {
+        seen++;
+
+        // (x - old mean), then mean moves, then m2 += (x - old mean)(x - new mean)^T
+        for (uint i = 0; i < dim; i++) {
+            z[i] = x[i] - mean[i];
+            mean[i] += z[i] / seen;
+        }
+        for (uint i = 0; i < dim; i++) {
+            for (uint j = 0; j < dim; j++) {
+                m2[i * dim + j] += z[i] * (x[j] - mean[j]);
+            }
+        }
+
+        if (seen < WARM_UP || seen % REFACTOR_EVERY != 0) {
+            return;
+        }
+
+        // small ridge so a chain stuck in a flat direction doesn't make the covariance singular
+        std::vector<double> c(dim * dim);
+        double trace = 0;
+        for (uint i = 0; i < dim; i++) {
+            trace += m2[i * dim + i] / (seen - 1);
+        }
+        for (uint i = 0; i < dim * dim; i++) {
+            c[i] = m2[i] / (seen - 1) + (i % (dim + 1) == 0 ? 1e-6 * trace / dim + 1e-12 : 0);
+        }
+
+        if (factor(c)) {
+            cov = c;
+
+            // 2.38 / sqrt(d) is optimal for gaussian targets, the robbins monro steps carry on from there
+            if (!empirical) {
+                log_scale = std::log(2.38 / std::sqrt((double)dim));
+                empirical = true;
+            }
+        }
+    }
+
+    double scale() const {
+        return std::exp(log_scale);
+    }
+
+    py::array_t<double> covariance() const {
+        py::array_t<double> out({(py::ssize_t)dim, (py::ssize_t)dim});
+        std::copy(cov.begin(), cov.end(), out.mutable_data());
+        return out;
+    }
+};
+
+// metropolis hastings over K chains at once, handing back samples a block at a time so memory doesn't grow with n.
+// proposals come from proposal_fn, or the adaptive RandomWalk if it is None (which adapts during burn in only), the
+// proposal density ratio q(x, x_p) / q(x_p, x) follows importance_sample's convention and is skipped if it is None.
+// python functions are called once per step on all (K, d) states if batched, otherwise once per chain on a (d,) state
+class MetropolisHastings {
+    py::function density_fn;
+    py::object proposal_fn, proposal_density;
+    bool batched;
+    unsigned long long n, burn_in, skip, block;
+    py::ssize_t chains, dim;
+
+    std::mt19937 gen;
+    std::uniform_real_distribution<> dis;
+    std::normal_distribution<> normal;
+    RandomWalk walk;
+
+    // current states and their densities, and the proposals of the step being taken
+    py::array_t<double> x, x_p;
+    std::vector<double> dens, dens_p, ratio;
+
+    unsigned long long step = 0, written = 0, proposed = 0, accepted = 0;
+    // chains of the last kept step already handed out, the rest go at the start of the next block
+    py::ssize_t pending;
+
+    // fresh array per call, python may hold on to its argument
+    py::array_t<double> row(const double *p) {
+        py::array_t<double> r(dim);
+        std::copy(p, p + dim, r.mutable_data());
+        return r;
+    }
+
+    void propose() {
+        const double *xs = x.data();
+        double *xp = x_p.mutable_data();
+        std::fill(ratio.begin(), ratio.end(), 1.0);
+
+        if (proposal_fn.is_none()) {
+            for (py::ssize_t k = 0; k < chains; k++) {
+                walk.propose(xs + k * dim, xp + k * dim, gen, normal);
+            }
+        } else if (batched) {
+            py::array_t<double, py::array::c_style | py::array::forcecast> p = proposal_fn(x);
+            std::copy(p.data(), p.data() + chains * dim, xp);
+
+            if (!proposal_density.is_none()) {
+                py::array_t<double, py::array::forcecast> there = proposal_density(x, x_p);
+                py::array_t<double, py::array::forcecast> back = proposal_density(x_p, x);
+
+                for (py::ssize_t k = 0; k < chains; k++) {
+                    ratio[k] = there.data()[k] / back.data()[k];
+                }
+            }
+        } else {
+            for (py::ssize_t k = 0; k < chains; k++) {
+                py::array_t<double> from = row(xs + k * dim);
+                py::array_t<double, py::array::c_style | py::array::forcecast> to = proposal_fn(from);
+                std::copy(to.data(), to.data() + dim, xp + k * dim);
+
+                if (!proposal_density.is_none()) {
+                    ratio[k] = proposal_density(from, to).cast<double>() / proposal_density(to, from).cast<double>();
+                }
+            }
+        }
+    }
+
+    void densities(const py::array_t<double> &points, std::vector<double> &out) {
+        if (batched) {
+            py::array_t<double, py::array::forcecast> d = density_fn(points);
+            std::copy(d.data(), d.data() + chains, out.begin());
+            return;
+        }
+
+        for (py::ssize_t k = 0; k < chains; k++) {
+            out[k] = density_fn(row(points.data() + k * dim)).cast<double>();
+        }
+    }
+
+    void advance() {
+        bool adapting = proposal_fn.is_none() && step < burn_in;
+        step++;
+
+        propose();
+        densities(x_p, dens_p);
+
+        double *xs = x.mutable_data();
+        const double *xp = x_p.data();
+        double total_a = 0;
+
+        for (py::ssize_t k = 0; k < chains; k++) {
+            double a = dens_p[k] / dens[k] * ratio[k];
+            total_a += a >= 0 ? std::min(1.0, a) : 0.0;
+            proposed++;
+
+            if (dis(gen) < a) {
+                std::copy(xp + k * dim, xp + (k + 1) * dim, xs + k * dim);
+                dens[k] = dens_p[k];
+                accepted++;
+            }
+
+            if (adapting) {
+                walk.observe(xs + k * dim);
+            }
+        }
+
+        if (adapting) {
+            walk.adapt_scale(total_a / chains);
+        }
+    }
+
+    static std::vector<double> identity(py::ssize_t dim) {
+        std::vector<double> eye(dim * dim, 0.0);
+        for (py::ssize_t i = 0; i < dim; i++) {
+            eye[i * dim + i] = 1.0;
+        }
+        return eye;
+    }
+
+    static std::vector<double> flatten(py::object cov) {
+        py::array_t<double, py::array::c_style | py::array::forcecast> c = cov;
+        return std::vector<double>(c.data(), c.data() + c.size());
+    }
+
+    static py::ssize_t check_dim(const py::array_t<double, py::array::c_style | py::array::forcecast> &x0) {
+        if (x0.ndim() != 2) {
+            throw std::invalid_argument("initial states must be a (chains, d) array");
+        }
+        return x0.shape(1);
+    }
+
+  public:
+    MetropolisHastings(py::array_t<double, py::array::c_style | py::array::forcecast> x0, py::function density_fn, unsigned long long n,
+                       unsigned long long burn_in, unsigned long long skip, unsigned long long block, py::object proposal_fn,
+                       py::object proposal_density, bool batched, py::object seed, double scale, py::object cov, double target)
+        : density_fn(density_fn), proposal_fn(proposal_fn), proposal_density(proposal_density), batched(batched),
+          n(n), burn_in(burn_in), skip(std::max(skip, 1ull)), block(std::max(block, 1ull)), chains(x0.shape(0)), dim(check_dim(x0)),
+          gen(make_generator(seed_words(seed))), dis(0.0, 1.0), normal(0.0, 1.0),
+          walk(dim, scale, cov.is_none() ? identity(dim) : flatten(cov), target),
+          x({chains, dim}), x_p({chains, dim}), dens(chains), dens_p(chains), ratio(chains), pending(chains) {
+        std::copy(x0.data(), x0.data() + chains * dim, x.mutable_data());
+        densities(x, dens);
+    }
+
+    // burn in if that hasn't happened yet, then the next rows kept samples, returns (samples (rows, d), densities (rows,))
+    py::tuple take(unsigned long long rows) {
+        while (step < burn_in) {
+            advance();
+        }
+
+        py::array_t<double> samples({(py::ssize_t)rows, dim});
+        py::array_t<double> sample_dens((py::ssize_t)rows);
+        double *out = samples.mutable_data();
+        double *out_dens = sample_dens.mutable_data();
+
+        for (unsigned long long filled = 0; filled < rows; filled++, written++, pending++) {
+            if (pending == chains) {
+                do {
+                    advance();
+                } while ((step - 1 - burn_in) % skip != 0);
+
+                pending = 0;
+            }
+
+            std::copy(x.data() + pending * dim, x.data() + (pending + 1) * dim, out + filled * dim);
+            out_dens[filled] = dens[pending];
+        }
+
+        return py::make_tuple(samples, sample_dens);
+    }
+
+    py::tuple next() {
+        if (written >= n) {
+            throw py::stop_iteration();
+        }
+        return take(std::min(block, n - written));
+    }
+
+    py::array_t<double> states() const {
+        py::array_t<double> out({chains, dim});
+        std::copy(x.data(), x.data() + chains * dim, out.mutable_data());
+        return out;
+    }
+
+    double acceptance() const {
+        return proposed ? (double)accepted / proposed : 0.0;
+    }
+
+    double scale() const {
+        return walk.scale();
+    }
+
+    py::array_t<double> covariance() const {
+        return walk.covariance();
+    }
+};
+
+// online per chain statistics of a stream of values (e.g. importance sampling scores) from K interleaved chains, the
+// stream being in the order MetropolisHastings hands out samples: row i belongs to chain i % K. keeps exact lagged
+// products up to max_lag for autocorrelation based effective sample sizes, and the moments of both halves of the
+// current segment of every chain for split R-hat. state() is a (K, 4 + 3 * max_lag) array the stats can be resumed
+// from, so chains continued over several rounds (and processes) keep one history
+class ChainStats {
+    py::ssize_t chains, max_lag;
+    unsigned long long segment, position = 0;
+    // per chain: shift, count, sum, products of lags 0..max_lag, first max_lag values, ring of the last max_lag values,
+    // all values shifted by the chain's first value so that the products don't cancel catastrophically
+    std::vector<double> state;
+    // per chain (first half, second half) x (count, sum, sum of squares) of this segment, unshifted
+    std::vector<double> halves;
+
+    py::ssize_t width() const {
+        return 4 + 3 * max_lag;
+    }
+
+    double *row(py::ssize_t k) {
+        return state.data() + k * width();
+    }
+
+    void push(py::ssize_t k, double value, bool first_half) {
+        double *r = row(k);
+        double &shift = r[0], &count = r[1], &sum = r[2];
+        double *products = r + 3, *head = products + max_lag + 1, *ring = head + max_lag;
+        unsigned long long t = count;
+
+        double *h = halves.data() + k * 6 + (first_half ? 0 : 3);
+        h[0] += 1;
+        h[1] += value;
+        h[2] += value * value;
+
+        if (t == 0) {
+            shift = value;
+        }
+        double x = value - shift;
+
+        products[0] += x * x;
+        for (py::ssize_t lag = 1; lag <= max_lag && (unsigned long long)lag <= t; lag++) {
+            products[lag] += x * ring[(t - lag) % max_lag];
+        }
+
+        if (max_lag > 0) {
+            ring[t % max_lag] = x;
+            if (t < (unsigned long long)max_lag) {
+                head[t] = x;
+            }
+        }
+
+        count += 1;
+        sum += x;
+    }
+
+  public:
+    ChainStats(py::ssize_t chains, py::ssize_t max_lag, unsigned long long segment, py::object resume)
+        : chains(chains), max_lag(max_lag), segment(segment), halves(chains * 6, 0.0) {
+        if (chains < 1 || max_lag < 0) {
+            throw std::invalid_argument("need at least one chain and a non-negative max lag");
+        }
+
+        if (resume.is_none()) {
+            state.assign(chains * width(), 0.0);
+            return;
+        }
+
+        py::array_t<double, py::array::c_style | py::array::forcecast> s = resume;
+        if (s.ndim() != 2 || s.shape(0) != chains || s.shape(1) != width()) {
+            throw std::invalid_argument("state to resume from doesn't match the number of chains and max lag");
+        }
+        state.assign(s.data(), s.data() + s.size());
+    }
+
+    void add(py::array_t<double, py::array::c_style | py::array::forcecast> values) {
+        const double *v = values.data();
+
+        for (py::ssize_t i = 0; i < values.size(); i++, position++) {
+            py::ssize_t k = position % chains;
+            // rows of this chain in the segment, its first half being the first (rows + 1) / 2
+            unsigned long long rows = segment / chains + ((unsigned long long)k < segment % chains ? 1 : 0);
+            push(k, v[i], 2 * (position / chains) < rows);
+        }
+    }
+
+    // effective sample size of every chain, n / (1 + 2 sum of autocorrelations) with the sum cut off by geyer's
+    // initial monotone sequence, and at max_lag, which overestimates it for chains correlated over longer lags
+    py::array_t<double> ess() {
+        py::array_t<double> out(chains);
+
+        for (py::ssize_t k = 0; k < chains; k++) {
+            double *r = row(k);
+            double n = r[1], mean = n > 0 ? r[2] / n : 0;
+            double *products = r + 3, *head = products + max_lag + 1, *ring = head + max_lag;
+            unsigned long long t = n;
+
+            std::vector<double> rho(max_lag + 1, 0.0);
+            double gamma0 = products[0] / n - mean * mean;
+
+            if (n < 4 || !(gamma0 > 1e-300 * (1 + mean * mean))) {
+                // too short, or constant so every sample counts fully
+                out.mutable_data()[k] = n;
+                continue;
+            }
+
+            // sum (x_t - mean)(x_t-lag - mean) over t >= lag, from the products and the values at either end
+            double first = 0, last = 0;
+            rho[0] = 1;
+            for (py::ssize_t lag = 1; lag <= max_lag && (unsigned long long)lag < t; lag++) {
+                first += head[lag - 1];
+                last += ring[(t - lag) % max_lag];
+                double gamma = (products[lag] - mean * (2 * r[2] - first - last) + (n - lag) * mean * mean) / n;
+                rho[lag] = gamma / gamma0;
+            }
+
+            double tau = -1, previous = 2;
+            for (py::ssize_t j = 0; 2 * j + 1 <= max_lag; j++) {
+                double pair = std::min(rho[2 * j] + rho[2 * j + 1], previous);
+                if (pair <= 0) {
+                    break;
+                }
+                tau += 2 * pair;
+                previous = pair;
+            }
+
+            out.mutable_data()[k] = n / std::max(tau, 1.0);
+        }
+
+        return out;
+    }
+
+    py::array_t<double> get_state() const {
+        py::array_t<double> out({chains, width()});
+        std::copy(state.begin(), state.end(), out.mutable_data());
+        return out;
+    }
+
+    py::array_t<double> get_halves() const {
+        py::array_t<double> out({chains, (py::ssize_t)2, (py::ssize_t)3});
+        std::copy(halves.begin(), halves.end(), out.mutable_data());
+        return out;
+    }
+};
+
+// advance K chains together, proposals and densities are computed for all chains with one python call each
+// returns (samples (n, d), their densities (n,), final states (K, d), acceptance rate)
+py::tuple _metropolis_hastings_ensemble(py::array_t<double, py::array::c_style | py::array::forcecast> x0, py::function proposal_fn, py::function density_fn, py::object proposal_density, unsigned int n, unsigned int burn_in, unsigned int skip, py::object seed) {
+    MetropolisHastings chains(x0, density_fn, n, burn_in, skip, n, proposal_fn, proposal_density, true, seed, 1.0, py::none(), 0.234);
+    py::tuple block = chains.take(n);
+
+    return py::make_tuple(block[0], block[1], chains.states(), chains.acceptance());
+}
+
+// advance K chains with the adaptive random walk, density_fn is called once per step on all (K, d) proposals if batched,
+// otherwise once per chain on a single (d,) proposal. returns (samples (n, d), their densities (n,), final states (K, d), acceptance rate, final scale, final cov (d, d))
+py::tuple _random_walk(py::array_t<double, py::array::c_style | py::array::forcecast> x0, py::function density_fn, bool batched, unsigned int n, unsigned int burn_in, unsigned int skip, double scale, py::array_t<double, py::array::c_style | py::array::forcecast> cov, double target, py::object seed) {
+    MetropolisHastings chains(x0, density_fn, n, burn_in, skip, n, py::none(), py::none(), batched, seed, scale, cov, target);
+    py::tuple block = chains.take(n);
+
+    return py::make_tuple(block[0], block[1], chains.states(), chains.acceptance(), chains.scale(), chains.covariance());
+}
+
 PYBIND11_MODULE(sampling, m) {
     m.doc() = "C++ bindings for numerical integration library"; // optional module docstring
 
-    m.def("_sample_hypercube", &_sample_hypercube, "Samples uniformly from some hypercube");
-    m.def("_metropolis_hastings", &_metropolis_hastings, "Generate samples from an arbitrary pdf");
+    m.def("_sample_hypercube", &_sample_hypercube, "Samples uniformly from some hypercube",
+          py::arg("fn"), py::arg("lows"), py::arg("highs"), py::arg("n"), py::arg("seed") = py::none());
+    m.def("_sample_hypercube_vectorized", &_sample_hypercube_vectorized, "Samples uniformly from some hypercube, calling fn on whole (chunk, d) arrays",
+          py::arg("fn"), py::arg("lows"), py::arg("highs"), py::arg("n"), py::arg("chunk"), py::arg("seed") = py::none());
+    m.def("_hypercube_moments", &_hypercube_moments, "Samples uniformly from some hypercube, returns (count, sum, sum of squares)",
+          py::arg("fn"), py::arg("lows"), py::arg("highs"), py::arg("n"), py::arg("vectorized"), py::arg("chunk"), py::arg("seed") = py::none());
+    m.def("_qmc_moments", &_qmc_moments, "Samples a randomized sobol or halton sequence over some hypercube, returns (count, sum, sum of squares)");
+    m.def("_qmc_points", &_qmc_points, "Generates n points of a (randomized) sobol or halton sequence in the unit cube",
+          py::arg("method"), py::arg("dim"), py::arg("n"), py::arg("seed") = 0, py::arg("scramble") = true);
+    m.def("_native_moments", &_native_moments, "Samples a native integrand uniformly from some hypercube on several threads without the gil, returns (count, sum, sum of squares)");
+    m.def("_native_eval", &_native_eval, "Evaluates a native integrand at every row of a (n, d) array");
+    m.def("_metropolis_hastings", &_metropolis_hastings, "Generate samples from an arbitrary pdf",
+          py::arg("x"), py::arg("proposal_fn"), py::arg("acceptance_fn"), py::arg("n"), py::arg("burn_in"), py::arg("skip"), py::arg("seed") = py::none());
+    m.def("_metropolis_hastings_ensemble", &_metropolis_hastings_ensemble, "Generate samples from an arbitrary pdf with many chains at once, using batched python calls",
+          py::arg("x0"), py::arg("proposal_fn"), py::arg("density_fn"), py::arg("proposal_density"), py::arg("n"), py::arg("burn_in"), py::arg("skip"), py::arg("seed") = py::none());
+    m.def("_random_walk", &_random_walk, "Generate samples from an arbitrary pdf with an adaptive gaussian random walk, needing only density calls");
+
+    py::class_<MetropolisHastings>(m, "_MetropolisHastings", "Iterator over (samples, densities) blocks of metropolis hastings chains, memory stays bounded by the block size")
+        .def(py::init<py::array_t<double, py::array::c_style | py::array::forcecast>, py::function, unsigned long long, unsigned long long, unsigned long long,
+                      unsigned long long, py::object, py::object, bool, py::object, double, py::object, double>(),
+             py::arg("x0"), py::arg("density_fn"), py::arg("n"), py::arg("burn_in") = 1000, py::arg("skip") = 1, py::arg("block") = 10000,
+             py::arg("proposal_fn") = py::none(), py::arg("proposal_density") = py::none(), py::arg("batched") = false, py::arg("seed") = py::none(),
+             py::arg("scale") = 1.0, py::arg("cov") = py::none(), py::arg("target") = 0.234)
+        .def("__iter__", [](MetropolisHastings &self) -> MetropolisHastings & { return self; })
+        .def("__next__", &MetropolisHastings::next)
+        .def("take", &MetropolisHastings::take, "Next rows kept samples regardless of the block size")
+        .def("states", &MetropolisHastings::states)
+        .def("acceptance", &MetropolisHastings::acceptance)
+        .def("scale", &MetropolisHastings::scale)
+        .def("covariance", &MetropolisHastings::covariance);
+
+    py::class_<ChainStats>(m, "_ChainStats", "Online chain diagnostics: autocorrelation effective sample sizes and split halves")
+        .def(py::init<py::ssize_t, py::ssize_t, unsigned long long, py::object>(),
+             py::arg("chains"), py::arg("max_lag"), py::arg("segment"), py::arg("resume") = py::none())
+        .def("add", &ChainStats::add, "Add values in stream order, row i belonging to chain i % chains")
+        .def("ess", &ChainStats::ess, "Effective sample size of every chain")
+        .def("state", &ChainStats::get_state, "(chains, 4 + 3 * max_lag) array to resume from")
+        .def("halves", &ChainStats::get_halves, "(chains, 2, 3) count, sum and sum of squares of both halves of this segment");
 }
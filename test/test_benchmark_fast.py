@@ -0,0 +1,40 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+import benchmark
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_sweep_roundtrip(self):
+        # a tiny sweep: every integrand's exact value is right, and a baseline compares against itself
+        records = benchmark.sweep(['integrate_vectorized', 'sample_hypercube'], dims=[1, 2], ns=[4000], workers=[1, 2], repeat=1)
+
+        # the serial backend isn't repeated per worker count
+        self.assertEqual(len(records), 2 * 3 * 2 + 3 * 2)
+        for r in records:
+            self.assertTrue(r['samples_per_sec'] > 0)
+            self.assertTrue(r['error'] < 5 * r['reported_error'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            benchmark.save(path, records)
+
+            with open(path) as f:
+                self.assertIn('integrate_vectorized/cheap/d=1/workers=2', json.load(f)['curves'])
+
+            baseline = benchmark.load(path)
+
+        rows = benchmark.compare(baseline, records)
+        self.assertEqual(len(rows), len(records))
+        self.assertTrue(all(ratio == 1 and not regressed for r, before, ratio, regressed in rows))
+
+        # twice the baseline's rate is a regression now
+        faster = [dict(r, samples_per_sec=2 * r['samples_per_sec']) for r in baseline]
+        self.assertTrue(all(regressed for r, before, ratio, regressed in benchmark.compare(faster, records)))
+
+if __name__ == '__main__':
+    sys.unittesting = True
+
+    unittest.main()
@@ -2,6 +2,8 @@ import unittest
 import numpy as np
 import sys
 import math
+import os
+import tempfile
 import sampling
 import integration
 
@@ -58,6 +60,121 @@ class TestSampling(unittest.TestCase):
         actual = 1 - math.exp(-1)
         self.assertTrue(abs(p - actual) < 0.01)
 
+    def test_ensemble_exp_plausible(self):
+        np.random.seed(0)
+        # same as above with 32 chains advancing together
+        n = 100000
+        init_x = np.random.rand(32, 1)
+
+        density = lambda x: np.where(x[:, 0] >= 0, np.exp(-x[:, 0]), 0)
+        proposal = lambda x: x + np.random.normal(size=x.shape)
+
+        vals, densities, states, acceptance = sampling._metropolis_hastings_ensemble(
+                init_x,
+                proposal,
+                density,
+                None,
+                n,
+                1000,
+                3)
+
+        self.assertEqual(vals.shape, (n, 1))
+        self.assertEqual(states.shape, (32, 1))
+        self.assertTrue(np.allclose(densities, density(vals)))
+        self.assertTrue(0 < acceptance < 1)
+
+        p = np.mean(vals < 1)
+        actual = 1 - math.exp(-1)
+        self.assertTrue(abs(p - actual) < 0.02)
+
+    def test_random_walk_adapts(self):
+        # strongly correlated, badly scaled gaussian that a unit gaussian proposal mixes poorly on
+        cov = np.array([[1, 9], [9, 100]])
+        precision = np.linalg.inv(cov)
+        density = lambda x: np.exp(-np.sum((x @ precision) * x, axis=1) / 2)
+
+        for batched, chains in ((False, 1), (True, 16)):
+            fn = density if batched else (lambda x: density(x[None, :])[0])
+
+            vals, densities, states, acceptance, scale, proposal_cov = sampling._random_walk(
+                    np.zeros((chains, 2)),
+                    fn,
+                    batched,
+                    50000,
+                    2000,
+                    1,
+                    1.0,
+                    np.eye(2),
+                    0.234,
+                    0)
+
+            self.assertEqual(vals.shape, (50000, 2))
+            self.assertEqual(states.shape, (chains, 2))
+            self.assertTrue(np.allclose(densities, density(vals)))
+
+            # tuned towards the target rate, and the proposal picked up the shape of the target
+            self.assertTrue(abs(acceptance - 0.234) < 0.05)
+            self.assertTrue(np.allclose(proposal_cov, cov, rtol=0.3, atol=0.3))
+            self.assertTrue(np.allclose(np.cov(vals.T), cov, rtol=0.15, atol=0.15))
+
+    def test_streamed_blocks(self):
+        np.random.seed(0)
+        n = 10007
+        density = lambda x: np.where(x[:, 0] >= 0, np.exp(-x[:, 0]), 0)
+        init_x = np.random.rand(5, 1)
+
+        # block boundaries fall in the middle of steps, the stream must not depend on them
+        whole = sampling._MetropolisHastings(init_x, density, n, burn_in=500, skip=3, block=n, batched=True, seed=1)
+        streamed = sampling._MetropolisHastings(init_x, density, n, burn_in=500, skip=3, block=7, batched=True, seed=1)
+
+        blocks = list(streamed)
+        self.assertTrue(all(len(s) == 7 for s, d in blocks[:-1]))
+        self.assertEqual(sum(len(s) for s, d in blocks), n)
+
+        vals, densities = next(whole)
+        self.assertTrue(np.array_equal(np.concatenate([s for s, d in blocks]), vals))
+        self.assertTrue(np.array_equal(np.concatenate([d for s, d in blocks]), densities))
+        self.assertTrue(np.array_equal(whole.states(), streamed.states()))
+
+        # the public generator streams the same way, one chain calling dist_fn per point
+        chain = integration.metropolis_hastings(lambda x: math.exp(-x[0]) if x[0] >= 0 else 0, lambda: np.random.rand(1), 100000, block=1000)
+        vals = np.concatenate([s for s, d in chain])
+
+        self.assertEqual(vals.shape, (100000, 1))
+        self.assertTrue(abs(np.mean(vals < 1) - (1 - math.exp(-1))) < 0.02)
+
+        # the chains run in this process without reseeding its global random state
+        np.random.seed(3)
+        expected = np.random.rand()
+        np.random.seed(3)
+        integration.metropolis_hastings(lambda x: 1.0, lambda: np.zeros(1), 10, seed=5)
+        self.assertEqual(np.random.rand(), expected)
+
+    def test_chain_stats_ess(self):
+        # ar(1) chains with coefficient 0.9 have integrated autocorrelation time (1 + 0.9) / (1 - 0.9) = 19
+        rng = np.random.default_rng(0)
+        n, chains = 100000, 3
+        x = np.zeros((n, chains))
+        for t in range(1, n):
+            x[t] = 0.9 * x[t - 1] + rng.normal(size=chains)
+        x += 50
+
+        stats = sampling._ChainStats(chains, 200, n * chains)
+        for block in np.array_split(x.ravel(), 7):
+            stats.add(block)
+
+        self.assertTrue(np.allclose(stats.ess(), n / 19, rtol=0.15))
+        self.assertTrue(np.array_equal(stats.halves()[:, :, 0], np.full((chains, 2), n / 2)))
+
+        # resuming from the state of the first half gives the same as one pass
+        first = sampling._ChainStats(chains, 200, n * chains // 2)
+        first.add(x[:n // 2].ravel())
+        second = sampling._ChainStats(chains, 200, n * chains // 2, first.state())
+        second.add(x[n // 2:].ravel())
+
+        self.assertTrue(np.allclose(second.state(), stats.state()))
+        self.assertTrue(np.allclose(second.ess(), stats.ess()))
+
 class TestIntegration(unittest.TestCase):
     def test_proportional_same(self):
         # function to integrat is literally the same
@@ -112,6 +229,105 @@ class TestIntegration(unittest.TestCase):
         # more lenient since cant 1000000 takes forever and reseeding problem with numpy
         self.assertTrue(abs((val - actual) / actual) < 0.05)
 
+    def test_multivariate_vectorized(self):
+        np.random.seed(0)
+        n = 1000000
+        d = 2
+
+        # like test_multivariate, but every call handles a whole ensemble of chains
+        val = integration.importance_sample(
+                lambda x: x[:, 0] * x[:, 1] + x[:, 0] + x[:, 1],
+                lambda x: (1 / math.pow(2 * math.pi, d/2)) * np.exp(-np.sum(x * x, axis=1) / 2),
+                lambda: np.random.rand(2),
+                [(0, 1), (0, 1)],
+                n=n,
+                burn_in=1000,
+                vectorized=True)
+
+        actual = 1.25
+        self.assertTrue(abs((val - actual) / actual) < 0.02)
+
+    def test_target_ess(self):
+        np.random.seed(0)
+
+        # start small and let the effective sample size decide how long the chains run
+        val = integration.importance_sample(
+                lambda x: 83 * math.exp(-x[0]),
+                lambda x: (1/math.sqrt(2 * math.pi)) * math.exp(-((x[0]) ** 2 / 2)),
+                lambda: np.random.rand(1),
+                [(0, 1)],
+                n=5000,
+                burn_in=1000,
+                ess=20000)
+
+        actual = 83 * (math.e - 1) / math.e
+
+        self.assertTrue(val.n_eff >= 20000)
+        # correlated samples, so more of them than effective ones
+        self.assertTrue(val.n > val.n_eff)
+        self.assertTrue(0 < val.acceptance < 1)
+        self.assertTrue(abs(val.r_hat - 1) < 0.05)
+        self.assertTrue(abs(val - actual) < 4 * val.error)
+
+    def test_checkpoint(self):
+        np.random.seed(0)
+        args = (lambda x: x[:, 0], lambda x: np.exp(-x[:, 0] ** 2 / 2) / math.sqrt(2 * math.pi), lambda: np.random.rand(1), [(0, 1)])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chains.checkpoint')
+
+            # killed half way, restarted, then extended: the chains carry on, nothing is sampled twice
+            first = integration.importance_sample(*args, n=40000, rounds=4, vectorized=True, checkpoint=path, stop=lambda r: r.n >= 20000)
+            val = integration.importance_sample(*args, n=40000, rounds=4, vectorized=True, checkpoint=path)
+            more = integration.importance_sample(*args, n=80000, rounds=4, vectorized=True, checkpoint=path)
+
+            # with a checkpoint and no rounds given, n is taken in CHECKPOINT_ROUNDS rounds
+            default = os.path.join(directory, 'default.checkpoint')
+            short = integration.importance_sample(*args, n=40000, vectorized=True, checkpoint=default, stop=lambda r: True)
+            self.assertEqual(short.n, 40000 // integration.CHECKPOINT_ROUNDS)
+
+            # a different integrand is refused rather than merged into these chains
+            self.assertRaises(ValueError, integration.importance_sample, lambda x: x[:, 0] ** 2, *args[1:], n=80000, vectorized=True, checkpoint=path)
+
+        self.assertEqual((first.n, val.n, more.n), (20000, 40000, 80000))
+        # rounds of 10000, then of 20000
+        self.assertEqual(len(more.state.segments[0]), 2 + 2 + 2)
+        self.assertTrue(more.n_eff > val.n_eff > first.n_eff)
+        self.assertTrue(abs(more - 0.5) < 4 * more.error)
+
+    def test_burn_in_until_sampled(self):
+        # chains of jobs whose first share was 0 haven't burnt in yet when they first sample
+        burn_ins = []
+
+        class RecordingPool(integration.Integrator):
+            def run(self, target, fns, jobs):
+                burn_ins.append([kwds['burn_in'] for args, kwds in jobs])
+                return super().run(target, fns, jobs)
+
+        args = (lambda x: x[0], lambda x: math.exp(-x[0]) if x[0] >= 0 else 0, lambda: np.ones(1), [(0, 5)])
+
+        with RecordingPool(num_workers=4) as pool:
+            first = integration.importance_sample(*args, n=2, burn_in=100, pool=pool, seed=1)
+            integration.importance_sample(*args, n=4002, burn_in=100, pool=pool, seed=1, resume=first)
+
+        self.assertEqual(burn_ins, [[100] * 4, [0, 0, 100, 100]])
+
+    def test_profile(self):
+        np.random.seed(0)
+        # a standard normal puts about 34% of its mass in [0, 1], the rest of the chain is masked out
+        val = integration.importance_sample(
+                lambda x: x[:, 0],
+                lambda x: np.exp(-x[:, 0] ** 2 / 2) / math.sqrt(2 * math.pi),
+                lambda: np.random.rand(1),
+                [(0, 1)],
+                n=40000,
+                vectorized=True,
+                profile=True)
+
+        self.assertEqual(val.profile.acceptance, [val.acceptance])
+        self.assertTrue(abs(val.profile.rejected - (1 - 0.3413)) < 0.03)
+        self.assertEqual(sum(j.points for j in val.profile.jobs), val.n)
+
 if __name__ == '__main__':
     sys.unittesting = True
 
@@ -1,8 +1,18 @@
 import unittest
 import numpy as np
 import sys
+import math
 import sampling
 import integration
+import utils
+import native
+import caching
+import workers
+import tempfile
+import subprocess
+import asyncio
+import time
+import os
 
 class TestSampling(unittest.TestCase):
 
@@ -24,6 +34,63 @@ class TestSampling(unittest.TestCase):
 
         self.assertTrue(abs(val - 0.5) < 0.01)
 
+    def test_vectorized_fn(self):
+        np.random.seed(0)
+        # n not a multiple of the chunk size, so the last partial chunk is used too
+        n = 100500
+        val = sampling._sample_hypercube_vectorized(lambda x: x[:, 0], [0.0], [1.0], n, 1000)
+        val /= n
+
+        self.assertTrue(abs(val - 0.5) < 0.01)
+
+    def test_partial_chunk_counted(self):
+        # fewer samples than a chunk, and a partial chunk after whole ones, are all taken
+        for n in (999, 2500):
+            count, total, total_sq = sampling._hypercube_moments(lambda x: x[0], [0.0], [1.0], n, False, 1000, 0)
+            self.assertEqual(count, n)
+            self.assertTrue(abs(total / n - 0.5) < 0.05)
+
+        self.assertEqual(sampling._hypercube_moments(lambda x: x[:, 0], [0.0], [1.0], 2500, True, 1000, 0)[0], 2500)
+
+    def test_qmc_points(self):
+        # unscrambled sobol starts 0, 1/2, 3/4, 1/4 in every dimension (up to the half ulp offset)
+        points = sampling._qmc_points('sobol', 3, 4, scramble=False)
+        self.assertTrue(np.allclose(points[:, 0], [0, 0.5, 0.75, 0.25]))
+
+        # scrambled points still fill the unit cube evenly
+        for method in ['sobol', 'halton']:
+            points = sampling._qmc_points(method, 5, 4096, seed=1)
+            self.assertTrue(points.min() >= 0 and points.max() < 1)
+            self.assertTrue(np.allclose(points.mean(axis=0), 0.5, atol=0.001))
+
+    def test_qmc_moments_rows(self):
+        # fn sees the same rows whatever the method, and a vectorized fn must return one value per point
+        seen = set()
+        fn = lambda x: seen.add(type(x)) or x[0]
+
+        self.assertEqual(sampling._qmc_moments(fn, [0.0], [1.0], 1001, 'sobol', 1, False, 1000)[0], 1001)
+        sampling._hypercube_moments(fn, [0.0], [1.0], 10, False, 1000, 1)
+        self.assertEqual(seen, {np.ndarray})
+        self.assertRaises(ValueError, sampling._qmc_moments, lambda x: x[:3, 0], [0.0], [1.0], 100, 'halton', 1, True, 1000)
+
+    def test_native_threads(self):
+        # threads each get their own stream, and together take exactly n samples
+        fn = native.expression('x[0]')
+        count, total, total_sq = fn.moments([0.0], [1.0], 100001, 4, 0)
+
+        self.assertEqual(count, 100001)
+        self.assertTrue(abs(total / count - 0.5) < 0.01)
+        self.assertTrue(abs(total_sq / count - 1/3) < 0.01)
+
+    def test_native_expression(self):
+        fn = native.expression('exp(-x[0] ** 2) * sin(pi * x[1]) - abs(x[0]) / 2')
+        points = np.random.rand(10, 2)
+        expected = np.exp(-points[:, 0] ** 2) * np.sin(math.pi * points[:, 1]) - abs(points[:, 0]) / 2
+
+        self.assertTrue(np.allclose(fn(points), expected))
+        self.assertTrue(np.isclose(fn(points[0]), expected[0]))
+        self.assertRaises(ValueError, native.expression, 'x[0] > 1')
+
 class TestIntegration(unittest.TestCase):
     
     def test_single_dimension(self):
@@ -51,6 +118,296 @@ class TestIntegration(unittest.TestCase):
 
         self.assertTrue(abs((val - actual) / actual) < 0.01)
 
+    def test_multiple_dimensions_vectorized(self):
+        np.random.seed(0)
+        n = 1000000
+        # same as above, but fn gets a whole chunk of points at once
+        actual = 2425 / 6
+        val = integration.integrate(
+                lambda x: x[:, 0] * x[:, 1] * x[:, 1] + x[:, 0] + x[:, 1],
+                [(-2, 3), (2, 7)],
+                n=n,
+                vectorized=True,
+                chunk_size=4096)
+
+        self.assertTrue(abs((val - actual) / actual) < 0.01)
+
+    def test_standard_error(self):
+        np.random.seed(0)
+        actual = 2/3
+        val = integration.integrate(lambda x: x[0] * x[0], [(-1, 1)], n=100000)
+
+        # estimate should be within a few standard errors, and the error of the right size
+        self.assertEqual(val.n, 100000)
+        self.assertTrue(abs(val - actual) < 4 * val.error)
+        self.assertTrue(0.001 < val.error < 0.01)
+
+    def test_adaptive_tolerance(self):
+        np.random.seed(0)
+        val = integration.integrate(
+                lambda x: x[:, 0] * x[:, 0],
+                [(-1, 1)],
+                n=10000,
+                vectorized=True,
+                rtol=0.002)
+
+        # keeps going past the first batch until the error target is met, but within budget
+        self.assertTrue(val.error <= 0.002 * abs(val))
+        self.assertTrue(10000 < val.n <= 100 * 10000)
+
+    def test_quasi_monte_carlo(self):
+        np.random.seed(0)
+        # x + y^2 + x + y with much fewer samples than plain monte carlo needs
+        actual = 2425 / 6
+
+        for method in ['sobol', 'halton']:
+            val = integration.integrate(lambda x: x[0] * x[1] * x[1] + x[0] + x[1], [(-2, 3), (2, 7)], n=16384, method=method)
+
+            self.assertTrue(abs((val - actual) / actual) < 0.001)
+            self.assertTrue(abs(val - actual) < 5 * val.error)
+
+    def test_vegas_peaked(self):
+        np.random.seed(0)
+        # narrow gaussian bump in the middle of the unit square, almost all uniform samples miss it
+        a = 0.05
+        actual = (math.sqrt(math.pi) * a * math.erf(0.5 / a)) ** 2
+        fn = lambda x: np.exp(-((x[:, 0] - 0.5) ** 2 + (x[:, 1] - 0.5) ** 2) / a ** 2)
+
+        val = integration.integrate(fn, [(0, 1), (0, 1)], n=100000, vectorized=True, method='vegas')
+        plain = integration.integrate(fn, [(0, 1), (0, 1)], n=100000, vectorized=True)
+
+        self.assertTrue(abs((val - actual) / actual) < 0.005)
+        self.assertTrue(val.error < plain.error / 10)
+
+    def test_row_type(self):
+        # scalar fns get every point as a 1d np.array whichever method samples them
+        fn = lambda x: x.sum() if isinstance(x, np.ndarray) and x.shape == (2,) else math.nan
+        actual = 1.0
+
+        with integration.Integrator(num_workers=2) as integrator:
+            for method in integration.METHODS:
+                val = integrator.integrate(fn, [(0, 1), (0, 1)], n=4000, method=method, seed=1)
+                self.assertTrue(abs(val - actual) < max(5 * val.error, 1e-9), method)
+
+            for kwargs in (dict(antithetic=True), dict(control_variates=[(lambda x: x[0], 0.5)])):
+                self.assertTrue(abs(integrator.integrate(fn, [(0, 1), (0, 1)], n=4000, seed=1, **kwargs) - actual) < 0.05)
+
+            # masked by function limits, and sampled through them, over the triangle below the diagonal
+            for direct in (False, True):
+                val = integrator.integrate(fn, [(0, 1), (0, lambda x: x[0])], cube=None if direct else [(0, 1), (0, 1)], n=4000, seed=1, direct=direct)
+                self.assertTrue(abs(val - 0.5) < 5 * val.error)
+
+            self.assertTrue(abs(integrator.integrate_many([fn], [(0, 1), (0, 1)], n=4000, seed=1)[0] - actual) < 0.05)
+
+            val = integrator.importance_sample(fn, lambda x: 1.0 if 0 <= x[0] <= 1 and 0 <= x[1] <= 1 else 0.0, lambda: np.full(2, 0.5),
+                                               [(0, 1), (0, 1)], n=4000, seed=1)
+            self.assertTrue(abs(val - actual) < 0.1)
+
+    def test_vegas_small_n(self):
+        # too few samples per iteration to refine the grid from is refused rather than silently wrong
+        for n in (5, 300):
+            self.assertRaises(ValueError, integration.integrate, lambda x: x[0], [(0, 1)], n=n, method='vegas')
+
+        val = integration.integrate(lambda x: x[0], [(0, 1)], n=1000, method='vegas', seed=1)
+        self.assertTrue(abs(val - 0.5) < 4 * val.error)
+
+        # single samples have no error to go by and are left out, not taken as exact
+        combined = utils.combine_results([utils.IntegrationResult(1.0, 0.0, 1, 1, 0), utils.IntegrationResult(0.5, 0.1, 10, 10, 0)], time.time())
+        self.assertEqual((float(combined), combined.error, combined.n), (0.5, 0.1, 11))
+
+    def test_miser_stratified(self):
+        np.random.seed(0)
+        # bump off center of the unit cube, stratification should beat even uniform sampling
+        a = 0.1
+        actual = (math.sqrt(math.pi) * a / 2 * (math.erf(0.7 / a) + math.erf(0.3 / a))) ** 3
+        fn = lambda x: np.exp(-np.sum((x - 0.3) ** 2, axis=1) / a ** 2)
+
+        with integration.Integrator(num_workers=2) as integrator:
+            val = integrator.integrate(fn, [(0, 1)] * 3, n=100000, vectorized=True, method='miser')
+            plain = integrator.integrate(fn, [(0, 1)] * 3, n=100000, vectorized=True)
+
+        self.assertEqual(val.n, 100000)
+        self.assertTrue(abs((val - actual) / actual) < 0.01)
+        self.assertTrue(val.error < plain.error / 3)
+
+    def test_cubature(self):
+        # smooth low dimensional integrands to near machine precision with a few thousand evaluations at most
+        gaussian = (math.sqrt(math.pi) / 2 * math.erf(1))
+        val = integration.integrate(lambda x: math.exp(-x[0] ** 2), [(0, 1)], method='cubature')
+        self.assertTrue(abs(val - gaussian) < 1e-12 and val.n == 15)
+
+        for d in (2, 3):
+            val = integration.integrate(lambda x: np.exp(-np.sum(x * x, axis=1)), [(0, 1)] * d, method='cubature', vectorized=True, rtol=1e-7)
+            self.assertTrue(abs(val - gaussian ** d) < max(val.error, 1e-12))
+            self.assertTrue(val.error < 1e-7 * val and val.n < 20000)
+
+        # function limits are integrated iteratively, here over the unit disk
+        circle = lambda x: math.sqrt(max(1 - x[0] ** 2, 0))
+        val = integration.integrate(lambda x: 1, [(-1, 1), (lambda x: -circle(x), circle)], method='cubature', rtol=1e-6)
+        self.assertTrue(abs(val - math.pi) < 1e-5)
+
+        # reversed limits flip the sign as in every other method
+        val = integration.integrate(lambda x: x[0] + x[1], [(1, 0), (lambda x: 1 - x[0], lambda x: x[0])], method='cubature')
+        self.assertTrue(abs(val + 1/6) < 1e-12)
+
+        # max_n is never overshot, a budget below a single rule can't give an estimate
+        for max_n in (40, 100, 1000):
+            val = integration.integrate(lambda x: math.exp(-x[0] * x[1]), [(0, 1)] * 2, method='cubature', max_n=max_n, rtol=1e-15)
+            self.assertTrue(17 <= val.n <= max_n)
+        self.assertRaises(ValueError, integration.integrate, lambda x: x[0], [(0, 1)] * 2, method='cubature', max_n=10)
+
+    def test_cubature_pool(self):
+        # big batches of scalar nodes go to the workers, and give the same answer as evaluating them here
+        fn = lambda x: math.exp(-x[0] ** 2 - x[1] ** 2 - x[2] ** 2)
+        local = integration.integrate(fn, [(0, 1)] * 3, method='cubature', rtol=1e-9)
+
+        with integration.Integrator(num_workers=2) as integrator:
+            limit = integration.cubature.POOL_MIN_POINTS
+            integration.cubature.POOL_MIN_POINTS = 100
+            try:
+                val = integrator.integrate(fn, [(0, 1)] * 3, method='cubature', rtol=1e-9, profile=True)
+            finally:
+                integration.cubature.POOL_MIN_POINTS = limit
+
+        self.assertTrue(len(val.profile.jobs) > 0)
+        self.assertEqual(val.n, local.n)
+        self.assertTrue(abs(val - local) < 1e-14)
+
+    def test_native_integrand(self):
+        np.random.seed(0)
+        # x + y^2 + x + y without calling back into python
+        actual = 2425 / 6
+        val = integration.integrate(native.expression('x[0] * x[1] * x[1] + x[0] + x[1]'), [(-2, 3), (2, 7)], n=1000000, threads=2)
+
+        self.assertEqual(val.n, 1000000)
+        self.assertTrue(abs((val - actual) / actual) < 0.01)
+
+    def test_integrator_reuse(self):
+        np.random.seed(0)
+        # one long lived pool serving several calls
+        actual = 2/3
+        fn = lambda x: x[0] * x[0]
+
+        with integration.Integrator(num_workers=2) as integrator:
+            self.assertEqual(integrator.num_workers, 2)
+
+            for i in range(3):
+                val = integrator.integrate(fn, [(-1, 1)], n=200000)
+                self.assertTrue(abs(val - actual) < 0.01)
+
+    def test_changed_globals(self):
+        global POWER
+        # the workers see globals as they are at every call, not as they were at the first one
+        fn = lambda x: (POWER + 1) * x[0] ** POWER
+
+        with workers.WorkerPool(2) as pool:
+            for power in (1, 9):
+                POWER = power
+                val = integration.integrate(fn, [(0, 1)], n=20000, pool=pool, seed=1)
+                self.assertTrue(abs(val - 1) < 4 * val.error)
+                self.assertTrue(abs(val.error - power / math.sqrt(20000 * (2 * power + 1))) < 0.1 * val.error)
+
+            # sent once, later jobs go without the payload and a worker that lacks it is sent it again
+            key, payload = workers.serialize((fn,))
+            self.assertIsNone(pool._ship(key, payload))
+            self.assertIsInstance(workers._run_registered(workers._ready, key + '-unknown', None, (), {}), workers._Missing)
+            self.assertEqual(pool.run(callable, (fn,), [((), None)] * 8), [True] * 8)
+
+    def test_seed_reproducible(self):
+        # same seed, same answer whichever worker picks up which job, and a new seed gives new samples
+        fn = lambda x: math.exp(x[0] * x[1])
+
+        with integration.Integrator(num_workers=2) as integrator:
+            for method in ('uniform', 'vegas', 'miser', 'sobol'):
+                first = integrator.integrate(fn, [(0, 1), (0, 1)], n=20000, method=method, seed=7)
+                again = integrator.integrate(fn, [(0, 1), (0, 1)], n=20000, method=method, seed=7)
+                other = integrator.integrate(fn, [(0, 1), (0, 1)], n=20000, method=method, seed=8)
+
+                self.assertEqual(float(first), float(again))
+                self.assertNotEqual(float(first), float(other))
+
+            first = integrator.importance_sample(lambda x: x[0], lambda x: math.exp(-x[0] ** 2), lambda: np.ones(1), [(0, 1)], n=20000, seed=7)
+            again = integrator.importance_sample(lambda x: x[0], lambda x: math.exp(-x[0] ** 2), lambda: np.ones(1), [(0, 1)], n=20000, seed=7)
+            self.assertEqual(float(first), float(again))
+
+            # a SeedSequence is used as it is, not spawned from, so it seeds every run the same way
+            seed = np.random.SeedSequence(7)
+            first = integrator.integrate(fn, [(0, 1), (0, 1)], n=20000, seed=seed)
+            self.assertEqual(seed.n_children_spawned, 0)
+            self.assertEqual(float(first), float(integrator.integrate(fn, [(0, 1), (0, 1)], n=20000, seed=seed)))
+
+    def test_worker_streams_independent(self):
+        # jobs spawned from one seed must not repeat each other's samples, even on forked workers
+        jobs = np.random.SeedSequence(0).spawn(2)
+        fn = lambda x: x[0]
+        a, b = [integration._hypercube_process_wrapper(fn, [0], [1], 1000, seed=s) for s in jobs]
+        c, d = [integration._hypercube_process_wrapper(lambda x: x[:, 0], [0], [1], 1000, vectorized=True, seed=s) for s in jobs]
+
+        self.assertNotEqual(a.total, b.total)
+        self.assertNotEqual(c.total, d.total)
+        self.assertEqual(a, integration._hypercube_process_wrapper(fn, [0], [1], 1000, seed=jobs[0]))
+
+    def test_uneven_split(self):
+        np.random.seed(0)
+        # n smaller than a chunk and not a multiple of the workers, none of it is dropped
+        with integration.Integrator(num_workers=3) as integrator:
+            val = integrator.integrate(lambda x: x[0], [(0, 1)], n=500)
+            self.assertEqual(val.n, 500)
+            self.assertTrue(abs(val - 0.5) < 4 * val.error)
+
+            vals = integrator.integrate_many([lambda x: x[0], lambda x: 1], [(0, 1)], n=1001)
+            self.assertEqual(vals[1].n, 1001)
+            self.assertEqual(float(vals[1]), 1)
+
+    def test_profile(self):
+        np.random.seed(0)
+        # triangle in its bounding square, so about half of the samples are rejected by the limits
+        rounds = []
+
+        with integration.Integrator(num_workers=2) as integrator:
+            val = integrator.integrate(lambda x: x[0], [(0, 1), (0, lambda x: 1 - x[0])], cube=[(0, 1), (0, 1)], n=10000,
+                                       rtol=0.01, profile=rounds.append)
+
+        profile = val.profile
+        self.assertEqual(profile.rounds, len(rounds))
+        self.assertTrue(rounds[-1] is val)
+        self.assertTrue(abs(profile.rejected - 0.5) < 0.02)
+
+        # every sample is accounted for by some worker
+        self.assertEqual(sum(w['points'] for w in profile.workers.values()), val.n)
+        self.assertTrue(all(w['rate'] > 0 for w in profile.workers.values()))
+        self.assertTrue(all(t >= 0 for t in profile.breakdown.values()))
+        self.assertTrue(sum(profile.phases.values()) <= val.time + 0.01)
+
+        # and nothing changes without it
+        self.assertFalse(hasattr(integration.integrate(lambda x: x[0], [(0, 1)], n=1000), 'profile'))
+
+    def test_integrate_many(self):
+        np.random.seed(0)
+        # nearly equal integrands: shared points make their difference far better known than either of them
+        fns = [lambda x: x[0] * x[0], lambda x: x[0] * x[0] + 0.01 * x[0], lambda x: math.sin(x[0])]
+        vals = integration.integrate_many(fns, [(0, 1)], n=100000)
+
+        self.assertEqual(len(vals), 3)
+        self.assertTrue(np.allclose(vals.estimates, [1/3, 1/3 + 0.005, 1 - math.cos(1)], atol=4 * vals.errors))
+        self.assertTrue(vals.difference_error(0, 1) < vals.errors[0] / 50)
+        self.assertTrue(abs(vals[1] - vals[0] - 0.005) < 4 * vals.difference_error(0, 1))
+
+    def test_integrate_many_params(self):
+        np.random.seed(0)
+        # one function over a parameter sweep, on a domain with a function limit
+        powers = [0, 1, 2, 3]
+        vals = integration.integrate_many(
+                lambda x, p: x[:, 0] ** p,
+                [(0, 1), (0, lambda x: 1 - x[:, 0])],
+                n=200000,
+                params=powers,
+                vectorized=True)
+
+        # integral of x^p (1 - x) over [0, 1]
+        actual = [1 / ((p + 1) * (p + 2)) for p in powers]
+        self.assertTrue(np.allclose(vals.estimates, actual, atol=4 * vals.errors))
+
     def test_function_as_limit(self):
         np.random.seed(0)
         # integrate x + y from x=0 to 1 and y = x to 1-x
@@ -88,6 +445,201 @@ class TestIntegration(unittest.TestCase):
                 n = 2000000)
 
         self.assertTrue(abs((val - actual) / actual) < 0.01)
+
+    def test_function_as_limit_vectorized(self):
+        np.random.seed(0)
+        # same as above, limits get the whole chunk of points too
+        actual = -1/6
+        val = integration.integrate(
+                lambda x: x[:, 0] + x[:, 1],
+                [(1, 0), (lambda x: 1 - x[:, 0], lambda x: x[:, 0])],
+                cube = [(0, 1), (1, 0)],
+                n = 2000000,
+                vectorized = True)
+
+        self.assertTrue(abs((val - actual) / actual) < 0.01)
+
+    def test_function_as_limit_direct(self):
+        np.random.seed(0)
+        # no cube, so the domain is sampled directly and every sample counts
+        actual = -1/6
+        val = integration.integrate(
+                lambda x: x[0] + x[1],
+                [(1, 0), (lambda x: 1 - x[0], lambda x: x[0])],
+                n = 200000)
+
+        self.assertTrue(abs((val - actual) / actual) < 0.01)
+
+    def test_simplex_direct(self):
+        np.random.seed(0)
+        # volume of the 5 dimensional unit simplex, a bounding cube would waste all but 1/120 of the samples
+        d = 5
+        limits = [(0, 1)] + [(0, lambda x, i=i: 1 - np.sum(x[:, :i], axis=1)) for i in range(1, d)]
+        actual = 1 / math.factorial(d)
+
+        val = integration.integrate(lambda x: np.ones(len(x)), limits, n=100000, vectorized=True)
+
+        self.assertTrue(abs((val - actual) / actual) < 0.03)
+
+    def test_variance_reduction(self):
+        # e^x is monotone and close to 1 + x, both cut the error of plain sampling several fold
+        actual = math.e - 1
+        plain = integration.integrate(lambda x: math.exp(x[0]), [(0, 1)], n=20000, seed=2)
+
+        antithetic = integration.integrate(lambda x: math.exp(x[0]), [(0, 1)], n=20000, seed=2, antithetic=True)
+        controlled = integration.integrate(lambda x: math.exp(x[0]), [(0, 1)], n=20000, seed=2, control_variates=[(lambda x: 1 + x[0], 1.5)])
+
+        for val in (antithetic, controlled):
+            self.assertEqual(val.n, 20000)
+            self.assertTrue(val.error < plain.error / 5)
+            self.assertTrue(abs(val - actual) < 4 * val.error)
+
+        # both together, vectorized, over the simplex sampled directly
+        limits = [(0, 1), (0, lambda x: 1 - x[:, 0])]
+        val = integration.integrate(lambda x: np.exp(x[:, 0] + x[:, 1]), limits, n=20000, vectorized=True, seed=2,
+                                    antithetic=True, control_variates=[(lambda x: x[:, 0] + x[:, 1], 1 / 3)])
+        self.assertTrue(abs(val - 1) < 4 * val.error)
+
+    def test_async(self):
+        def slow(x):
+            time.sleep(0.0002)
+            return x[0]
+
+        async def ticking(awaitable):
+            # the event loop keeps running while the integration is awaited
+            ticks = []
+            async def tick():
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks.append(1)
+
+            ticker = asyncio.ensure_future(tick())
+            try:
+                return await awaitable, len(ticks)
+            finally:
+                ticker.cancel()
+
+        # past the deadline, the rounds finished so far are what there is
+        start = time.time()
+        val, ticks = asyncio.run(ticking(integration.integrate_async(slow, [(0, 1)], n=20000, deadline=1, seed=1)))
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(0 < val.n < 20000 and val.n % 2000 == 0)
+        self.assertTrue(abs(val - 0.5) < 4 * val.error)
+        self.assertTrue(ticks > 10)
+
+        # cancelling doesn't wait for the rest of the samples
+        async def cancelled():
+            task = asyncio.ensure_future(integration.integrate_async(slow, [(0, 1)], n=20000, seed=1))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await task
+
+        start = time.time()
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(cancelled())
+        self.assertTrue(time.time() - start < 1)
+
+        # without a deadline it's the same as integrate
+        val = asyncio.run(integration.integrate_async(lambda x: x[0], [(0, 1)], n=10000, seed=1, rounds=1))
+        self.assertEqual(val, integration.integrate(lambda x: x[0], [(0, 1)], n=10000, seed=1))
+
+    def test_checkpoint(self):
+        fn = lambda x: x[0] ** 2
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.checkpoint')
+
+            # killed after 3 of its 10 rounds, restarted and finished, is the same as one uninterrupted run
+            integration.integrate(fn, [(0, 1)], n=100000, rounds=10, seed=4, checkpoint=path, stop=lambda r: r.n >= 30000)
+            self.assertEqual(utils.load_checkpoint(path).moments.n, 30000)
+
+            val = integration.integrate(fn, [(0, 1)], n=100000, rounds=10, seed=4, checkpoint=path)
+            self.assertEqual((val, val.n), (integration.integrate(fn, [(0, 1)], n=100000, rounds=10, seed=4), 100000))
+
+            # with a checkpoint n is taken in CHECKPOINT_ROUNDS rounds by default, a process killed part way through
+            # has left its last round's state behind
+            killed = os.path.join(directory, 'killed.checkpoint')
+            script = ('import os, sys, integration\n'
+                      'val = integration.integrate(lambda x: x[0] ** 2, [(0, 1)], n=100000, seed=4, checkpoint={!r},\n'
+                      '                            stop=lambda r: "kill" in sys.argv and r.n >= 30000 and os._exit(1))\n'
+                      'print(repr(float(val)), val.n)').format(killed)
+            package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(subprocess.run([sys.executable, '-c', script, 'kill'], cwd=package).returncode, 1)
+            self.assertEqual(utils.load_checkpoint(killed).moments.n, 30000)
+
+            # restarted, it finishes the remaining rounds as if it had never been killed
+            val, n = subprocess.check_output([sys.executable, '-c', script], cwd=package).split()
+            self.assertEqual((float(val), int(n)), (integration.integrate(fn, [(0, 1)], n=100000, rounds=10, seed=4), 100000))
+
+            # extended to a tighter error target later on, the samples taken so far count
+            val = integration.integrate(fn, [(0, 1)], n=100000, rtol=0.002, seed=4, checkpoint=path)
+            self.assertTrue(val.error <= 0.002 * val and val.n % 100000 == 0)
+            self.assertEqual(utils.load_checkpoint(path).moments.n, val.n)
+
+            # someone else's checkpoint, or another seed, is refused rather than merged
+            self.assertRaises(ValueError, integration.integrate, lambda x: x[0] ** 3, [(0, 1)], n=100000, seed=4, checkpoint=path)
+            self.assertRaises(ValueError, integration.integrate, fn, [(0, 2)], n=100000, seed=4, checkpoint=path)
+            self.assertRaises(ValueError, integration.integrate, fn, [(0, 1)], n=100000, seed=4, antithetic=True, checkpoint=path)
+            self.assertRaises(ValueError, integration.integrate, fn, [(0, 1)], n=100000, seed=5, checkpoint=path)
+            self.assertEqual(integration.integrate(fn, [(0, 1.0)], n=100000, checkpoint=path).n, val.n)
+
+    def test_cache(self):
+        cache = caching.ResultCache(max_entries=2)
+        fn = lambda x: x[0] ** 2
+
+        first = cache.integrate(fn, [(0, 1)], n=10000, seed=1)
+        # an identical lambda with the same (normalized) limits hits, as does any request for fewer samples
+        hit = cache.integrate(lambda x: x[0] ** 2, [(0, 1.0)], n=5000, seed=1)
+        self.assertEqual((hit, hit.error, hit.n), (first, first.error, first.n))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # more samples resume the cached run, only the missing ones are taken
+        more = cache.integrate(fn, [(0, 1)], n=30000, seed=1)
+        self.assertEqual((more.n, cache.resumed), (30000, 1))
+        self.assertTrue(abs(more - 1 / 3) < 4 * more.error)
+
+        # an error target the cached result meets is a hit too
+        cache.integrate(fn, [(0, 1)], rtol=1.01 * more.error / more, seed=1)
+        self.assertEqual(cache.hits, 2)
+
+        # a run a stop ended early only answers for the samples it took, the same request without stop resumes it
+        short = cache.integrate(fn, [(0, 4)], n=40000, rounds=4, seed=1, stop=lambda result: True)
+        full = cache.integrate(fn, [(0, 4)], n=40000, rounds=4, seed=1)
+        self.assertEqual((short.n, full.n, cache.hits, cache.resumed), (10000, 40000, 2, 2))
+
+        # least recently used keys are evicted
+        cache.integrate(fn, [(0, 2)], n=1000, seed=1)
+        cache.integrate(fn, [(0, 3)], n=1000, seed=1)
+        cache.integrate(fn, [(0, 1)], n=1000, seed=1)
+        self.assertEqual(cache.misses, 5)
+
+    def test_cache_on_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fn = lambda x: np.sin(x[:, 0])
+            first = caching.ResultCache(path=directory).integrate(fn, [(0, math.pi)], n=20000, vectorized=True, seed=3)
+
+            # another cache (as after a restart) reads it back
+            cache = caching.ResultCache(path=directory)
+            again = cache.integrate(fn, [(0, math.pi)], n=20000, vectorized=True, seed=3)
+            self.assertEqual((again, again.error, again.n, cache.hits), (first, first.error, first.n, 1))
+
+        # fingerprints don't depend on the process (hash randomization, object ids)
+        code = 'import math, caching; print(caching.fingerprint((lambda x: math.sin(x[0]), {"b", "a"}, {"k": [1.0]})))'
+        prints = {subprocess.check_output([sys.executable, '-c', code]) for i in range(2)}
+        self.assertEqual(len(prints), 1)
+        self.assertNotEqual(caching.fingerprint(lambda x: x[0]), caching.fingerprint(lambda x: x[1]))
+
+    def test_batch_limit_wrapper_matches(self):
+        np.random.seed(0)
+        # masking a whole chunk at once gives the same values and signs as masking point by point
+        points = np.random.uniform(-0.5, 1.5, size=(1000, 3))
+        limits = [(1, 0), (lambda x: 1 - x[0], lambda x: x[0]), (0, lambda x: x[0] + x[1])]
+        batch_limits = [(1, 0), (lambda x: 1 - x[:, 0], lambda x: x[:, 0]), (0, lambda x: x[:, 0] + x[:, 1])]
+
+        single = utils.limit_wrapper(lambda x: x[0] * x[1] + x[2], limits)
+        batch = utils.limit_wrapper(lambda x: x[:, 0] * x[:, 1] + x[:, 2], batch_limits, vectorized=True)
+
+        self.assertTrue(np.allclose([single(x) for x in points], batch(points)))
         
 if __name__ == '__main__':
     sys.unittesting = True
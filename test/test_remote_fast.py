@@ -0,0 +1,92 @@
+import unittest
+import numpy as np
+import sys
+import os
+import math
+import subprocess
+import tempfile
+import ast
+import operator
+import types
+import integration
+import workers
+import remote
+
+class TestRemote(unittest.TestCase):
+
+    def setUp(self):
+        # three workers on unix sockets and one on tcp, all on this host
+        self.directory = tempfile.TemporaryDirectory()
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        listen = [os.path.join(self.directory.name, 'worker{}'.format(i)) for i in range(3)] + ['127.0.0.1:0']
+
+        self.workers = [subprocess.Popen([sys.executable, '-m', 'remote', a], cwd=package, stdout=subprocess.PIPE) for a in listen]
+        self.addresses = listen[:3]
+        self.addresses.append(ast.literal_eval(self.workers[-1].stdout.readline().decode()))
+
+        for w in self.workers[:3]:
+            w.stdout.readline()
+
+    def tearDown(self):
+        for w in self.workers:
+            w.kill()
+            w.wait()
+            w.stdout.close()
+
+        self.directory.cleanup()
+
+    def test_remote_pool(self):
+        flag = os.path.join(self.directory.name, 'die')
+
+        def worker_only():
+            # an instance of a class from a module that only exists on the worker
+            module = types.ModuleType('worker_only')
+            exec('class Thing(object):\n    pass', module.__dict__)
+            sys.modules['worker_only'] = module
+            return module.Thing()
+
+        def fn(x):
+            # the first worker to get here dies half way through its job
+            try:
+                os.remove(flag)
+            except FileNotFoundError:
+                return x[0] ** 2
+            os._exit(1)
+
+        with workers.WorkerPool(4) as pool:
+            local = integration.integrate(fn, [(0, 1)], n=100000, pool=pool, seed=1)
+
+        with remote.RemotePool(self.addresses) as pool:
+            self.assertEqual(integration.integrate(fn, [(0, 1)], n=100000, pool=pool, seed=1), local)
+
+            # the lost worker's job is sampled by another one, with the same seed
+            open(flag, 'w').close()
+            val = integration.integrate(fn, [(0, 1)], n=100000, pool=pool, seed=1)
+            self.assertEqual((val, val.n, pool.num_workers), (local, 100000, 3))
+
+            val = integration.importance_sample(lambda x: 83 * math.exp(-x[0]), lambda x: math.exp(-x[0]) if x[0] >= 0 else 0,
+                                                lambda: np.random.rand(1), [(0, 1)], n=30000, pool=pool, seed=2)
+            actual = 83 * (math.e - 1) / math.e
+            self.assertTrue(abs(val - actual) < 4 * val.error)
+
+            # exceptions of a job are raised, not taken for a lost worker
+            with self.assertRaises(ZeroDivisionError):
+                integration.integrate(lambda x: 1 / 0, [(0, 1)], n=100, pool=pool)
+            self.assertEqual(pool.num_workers, 3)
+
+            # as is a result this side can't unpickle, the worker's connection is still good
+            with self.assertRaisesRegex(ImportError, 'worker_only'):
+                pool.run(operator.call, (worker_only,), [((), None)])
+            self.assertEqual(pool.run(operator.call, (lambda: 7,), [((), None)] * 3), [7] * 3)
+            self.assertEqual(pool.num_workers, 3)
+
+    def test_authkey_required(self):
+        # anyone reaching a tcp worker could run code on it, so only loopback ones may go without a key
+        self.assertRaises(ValueError, remote.serve, ('0.0.0.0', 0))
+        self.assertTrue(remote._loopback('localhost') and remote._loopback('::1'))
+        self.assertFalse(remote._loopback('8.8.8.8'))
+
+if __name__ == '__main__':
+    sys.unittesting = True
+
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import sys
+import os
+import json
+import time
+import subprocess
+import tempfile
+import integration
+import workers
+
+# imports the package needn't pay for until a pool is started or an async run awaited
+HEAVY = ['pathos', 'dill', 'multiprocess', 'ppft', 'asyncio', 'concurrent.futures']
+
+COLD_START = '''
+import json, sys, time
+start = time.perf_counter()
+import numpy
+numpy_done = time.perf_counter()
+import integration
+done = time.perf_counter()
+print(json.dumps(dict(total=done - start, own=done - numpy_done, loaded=[m for m in {} if m in sys.modules])))
+'''.format(HEAVY)
+
+class TestStartup(unittest.TestCase):
+
+    def test_cold_import(self):
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        with tempfile.TemporaryDirectory() as cache:
+            # a fresh interpreter with bytecode cached as in an installed package, the first run compiles it
+            env = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+            env['PYTHONPYCACHEPREFIX'] = cache
+            runs = [json.loads(subprocess.check_output([sys.executable, '-c', COLD_START], cwd=package, env=env)) for i in range(4)]
+
+        self.assertEqual(runs[-1]['loaded'], [])
+        # numpy's own import is out of our hands, what the package adds on top of it is a fraction of that, measured
+        # against numpy in the same runs so a loaded machine slows both down alike
+        self.assertTrue(min(r['own'] for r in runs[1:]) < min(r['total'] - r['own'] for r in runs[1:]))
+        print('cold import {:.1f} ms, {:.1f} ms of it on top of numpy'.format(1000 * min(r['total'] for r in runs[1:]), 1000 * min(r['own'] for r in runs[1:])))
+
+    def test_warm_first_call(self):
+        # a warmed up pool's workers are forked and have their imports done, the first call only samples
+        with workers.WorkerPool(2) as pool:
+            start = time.perf_counter()
+            pids = pool.warm()
+            warmup = time.perf_counter() - start
+
+            start = time.perf_counter()
+            val = integration.integrate(lambda x: x[0], [(0, 1)], n=1000, pool=pool)
+            first = time.perf_counter() - start
+
+        self.assertEqual(val.n, 1000)
+        self.assertTrue(all(isinstance(p, int) for p in pids))
+        # wall clock is only reported, shared ci machines are too noisy to hold it to a bound
+        print('warmup {:.1f} ms, first call {:.1f} ms'.format(1000 * warmup, 1000 * first))
+
+    def test_native_no_pool(self):
+        # native integrands are sampled on threads in this process, no worker processes are started for them
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ('import integration, native, workers, sys\n'
+                  'val = integration.integrate(native.expression("x[0]"), [(0, 1)], n=10000, threads=2, seed=1)\n'
+                  'print(val.n, workers._default_pool is None, "pathos" in sys.modules)')
+
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', script], cwd=package).split(), [b'10000', b'True', b'False'])
+
+    def test_batched_cubature_no_pool(self):
+        # cubature evaluates vectorized and native integrands in this process, the pool is never started for them
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ('import integration, native, workers, sys\n'
+                  'a = integration.integrate(lambda x: x[:, 0], [(0, 1)], vectorized=True, method="cubature")\n'
+                  'b = integration.integrate(native.expression("x[0]"), [(0, 1)], method="cubature")\n'
+                  'print(round(a, 6), round(b, 6), workers._default_pool is None, "pathos" in sys.modules)')
+
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', script], cwd=package).split(), [b'0.5', b'0.5', b'True', b'False'])
+
+if __name__ == '__main__':
+    sys.unittesting = True
+
+    unittest.main()
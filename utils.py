@@ -3,6 +3,9 @@ import math
 import sys
 import os
 import numbers
+import time
+import collections
+import pickle
 
 def fn_limit_wrapper(fn, limits):
     def altered_fn(x):
@@ -24,6 +27,106 @@ def fn_limit_wrapper(fn, limits):
 
     return altered_fn
 
+def batch_fn_limit_wrapper(fn, limits):
+    ''' Vectorized fn_limit_wrapper: the returned fn takes a (chunk, d) np.array and returns a (chunk,) np.array
+
+    limits are the raw [a(x), b(x)] tuples, function limits take the same (chunk, d) array and return (chunk,) arrays.
+    Constant dimensions are checked with one array comparison, function limits are then only evaluated
+    on the rows still inside, and fn only ever sees the rows inside the domain. '''
+    const = [i for i, l in enumerate(limits) if not callable(l[0]) and not callable(l[1])]
+    varying = [i for i, l in enumerate(limits) if callable(l[0]) or callable(l[1])]
+
+    const_lows = np.array([min(limits[i]) for i in const], dtype=float)
+    const_highs = np.array([max(limits[i]) for i in const], dtype=float)
+    # an odd number of reversed intervals flips the sign, see fn_limit_wrapper
+    const_sign = (-1) ** sum(limits[i][0] > limits[i][1] for i in const)
+
+    def limit_values(limit, x):
+        return limit(x) if callable(limit) else np.full(len(x), limit, dtype=float)
+
+    def altered_fn(x):
+        x = np.asarray(x, dtype=float)
+        rows = np.nonzero(np.all((x[:, const] >= const_lows) & (x[:, const] <= const_highs), axis=1))[0]
+        signs = np.full(len(rows), const_sign, dtype=float)
+
+        for i in varying:
+            inside = x[rows]
+            a, b = limit_values(limits[i][0], inside), limit_values(limits[i][1], inside)
+
+            keep = (inside[:, i] >= np.minimum(a, b)) & (inside[:, i] <= np.maximum(a, b))
+            signs = np.where(a > b, -signs, signs)[keep]
+            rows = rows[keep]
+
+        vals = np.zeros(len(x))
+
+        if len(rows):
+            vals[rows] = fn(x[rows]) * signs
+
+        return vals
+
+    return altered_fn
+
+def direct_wrapper(fn, limits, vectorized=False):
+    ''' Turn fn over the iterated limits domain into a fn over the unit cube, so that no samples are wasted
+
+    Applies x_i = a_i(x) + u_i * (b_i - a_i(x)) in the order of the limits, so a_i and b_i may only use x[:i],
+    and multiplies by the (signed, so reversed intervals integrate negatively) jacobian prod(b_i - a_i).
+    In vectorized mode u, x and the limits work on (chunk, d) arrays. '''
+    if vectorized:
+        def altered_fn(u):
+            u = np.asarray(u, dtype=float)
+            x = np.zeros_like(u)
+            jac = np.ones(len(u))
+
+            for i, (a, b) in enumerate(limits):
+                a = a(x) if callable(a) else a
+                b = b(x) if callable(b) else b
+                x[:, i] = a + u[:, i] * (b - a)
+                jac *= b - a
+
+            return fn(x) * jac
+
+        return altered_fn
+
+    limits = build_limit_fns(limits)
+
+    def altered_fn(u):
+        x = np.zeros(len(u))
+        jac = 1
+
+        for i in range(len(limits)):
+            a, b = limits[i][0](x), limits[i][1](x)
+            x[i] = a + u[i] * (b - a)
+            jac *= b - a
+
+        return fn(x) * jac
+
+    return altered_fn
+
+def has_limit_fns(limits):
+    return any(callable(a) or callable(b) for a, b in limits)
+
+def limit_wrapper(fn, limits, vectorized=False, direct=False):
+    ''' Mask fn by the raw limits, with batch_fn_limit_wrapper in vectorized mode, otherwise fn_limit_wrapper
+    if direct, fn is instead sampled through the limits with direct_wrapper '''
+    if direct:
+        return direct_wrapper(fn, limits, vectorized)
+
+    if vectorized:
+        return batch_fn_limit_wrapper(fn, limits)
+
+    return fn_limit_wrapper(fn, build_limit_fns(limits))
+
+def antithetic_wrapper(fn, lows, highs, vectorized=False):
+    ''' fn averaged with its value at the mirror image lows + highs - x of every point of the [lows, highs] cube,
+    uniform samples of the pair averages have the same mean and a lot less variance for near monotone fns '''
+    mirror = np.asarray(lows, dtype=float) + np.asarray(highs, dtype=float)
+
+    if vectorized:
+        return lambda x: (fn(x) + fn(mirror - x)) / 2
+
+    return lambda x: (fn(x) + fn(mirror - np.asarray(x))) / 2
+
 def build_limit_fns(limits):
     new_limits = []
     for l in limits:
@@ -45,3 +148,354 @@ def get_cube_info(cube):
     
     return lows, highs, volume
 
+
+def split_samples(n, parts):
+    ''' Split n samples into parts counts as even as possible that add up to exactly n,
+    the first n % parts of them taking one more sample '''
+    share, extra = divmod(int(n), parts)
+    return [share + (i < extra) for i in range(parts)]
+
+def seed_sequence(seed=None):
+    ''' np.random.SeedSequence a run spawns its per job streams from
+
+    seed may be an int, a SeedSequence or None for fresh entropy. When unittesting, None draws the seed from
+    numpy's global state instead, which the tests seed. A SeedSequence is copied, so spawning from the
+    returned one leaves the caller's as it was and the same SeedSequence always seeds a run the same way '''
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key, pool_size=seed.pool_size,
+                                      n_children_spawned=seed.n_children_spawned)
+
+    if seed is None and 'UNITTESTING' in os.environ:
+        seed = int(np.random.randint(2 ** 32, dtype=np.uint64))
+
+    return np.random.SeedSequence(seed)
+
+def seed_job(seed):
+    ''' Seed a job (on whichever worker it runs) from its spawned SeedSequence: numpy's global state, which the python
+    samplers and user functions draw from, gets half of its state and the returned seed words for the extension's
+    generators come from the rest, so that every stream is independent of every other job's. Doesn't spawn, so the
+    same SeedSequence always seeds a job the same way '''
+    words = seed_sequence(seed).generate_state(8)
+    np.random.seed(words[:4])
+    return words[4:].tolist()
+
+def seed_words(seed):
+    ''' The extension's seed words seed_job would return, without seeding numpy's global state, for what runs in the
+    caller's process '''
+    return seed_sequence(seed).generate_state(8)[4:].tolist()
+
+def target_acceptance(d):
+    ''' Acceptance rate the default random walk proposal tunes its step size towards in d dimensions,
+    the optimal rates for gaussian targets '''
+    return 0.44 if d == 1 else 0.234
+
+# count, sum and sum of squares of sampled values, workers return these so they can be merged
+Moments = collections.namedtuple('Moments', ['n', 'total', 'total_sq'])
+
+# what an mcmc worker hands back after a round: Moments of its scores, final chain states, (scale, cov) of the
+# random walk (None for other proposals), sampling._ChainStats state to resume from, (chains, 2, 3) halves of
+# this round, acceptance rate and per chain effective sample sizes
+ChainReport = collections.namedtuple('ChainReport', ['moments', 'states', 'walk', 'stats', 'halves', 'acceptance', 'ess'])
+
+# where a uniform run stands, enough to carry on with it: Moments of all its samples so far (or with control variates
+# the (n, sums, sums of products) of shared_results), the np.random.SeedSequence (entropy, spawn key, children
+# spawned) its jobs' streams are spawned from and the run_fingerprint of what it integrates (None in states saved
+# before there was one, which therefore can't be resumed)
+RunState = collections.namedtuple('RunState', ['moments', 'entropy', 'spawn_key', 'spawned', 'run'], defaults=[None])
+
+# where an importance sampling run stands: as RunState, and per job (worker) of every round the final chain states,
+# random walk, sampling._ChainStats state, list of the halves of every round, effective sample sizes and acceptance
+MCMCState = collections.namedtuple('MCMCState', ['moments', 'entropy', 'spawn_key', 'spawned', 'states', 'walks', 'stats', 'segments', 'ess', 'acceptance', 'run'],
+                                   defaults=[None])
+
+def run_state(moments, seed, run):
+    return RunState(moments, seed.entropy, seed.spawn_key, seed.n_children_spawned, run)
+
+def run_fingerprint(fns, limits, cube, *options):
+    ''' Digest of what a run integrates: its functions, limits and cube (1 and 1.0 being the same bound) and whatever
+    options change the samples it takes (method and the like), kept in its state so that only the same run resumes
+    from it. Functions go by caching.fingerprint, those that can't be fingerprinted by their qualified names '''
+    import caching
+
+    def feed(obj):
+        try:
+            return caching.fingerprint(obj)
+        except ValueError:
+            return caching.fingerprint('{}.{}'.format(getattr(obj, '__module__', None), getattr(obj, '__qualname__', type(obj).__qualname__)))
+
+    bounds = [tuple(float(v) if isinstance(v, numbers.Real) else v for v in lim) for lim in list(limits) + list(cube or [])]
+    return caching.fingerprint([feed(f) for f in fns] + [feed(b) for b in bounds] + [cube is None] + [feed(o) for o in options])
+
+def check_resumable(state, run, seed):
+    ''' Raise ValueError unless state (a RunState or MCMCState) was saved by a run with the same run_fingerprint and,
+    if seed isn't None, seeded with seed '''
+    if state.run != run:
+        raise ValueError('can\'t resume from the state of a different run (its integrand, limits or method differ)')
+
+    if seed is not None:
+        seed = seed_sequence(seed)
+        if (seed.entropy, tuple(seed.spawn_key)) != (state.entropy, tuple(state.spawn_key)):
+            raise ValueError('can\'t resume with seed {} a run seeded with {}'.format(seed.entropy, state.entropy))
+
+def resumed_seed(state):
+    ''' The SeedSequence of a RunState (or MCMCState), spawning on from where the run stopped so no stream is used twice '''
+    return np.random.SeedSequence(state.entropy, spawn_key=state.spawn_key, n_children_spawned=state.spawned)
+
+def dump_atomic(path, obj):
+    ''' Pickle obj to path, written aside and renamed into place so that readers (in other processes too) and
+    runs killed half way never see half a file '''
+    import tempfile
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def load_checkpoint(path):
+    ''' RunState or MCMCState saved to path by a run's checkpoint, None if there is none yet '''
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+def merge_moments(moments):
+    ''' Add up a list of Moments '''
+    return Moments(*[sum(m) for m in zip(*moments)]) if moments else Moments(0, 0, 0)
+
+def array_moments(values):
+    ''' Moments of an np.array of sampled values '''
+    values = np.asarray(values, dtype=float)
+    return Moments(len(values), float(np.sum(values)), float(np.sum(values * values)))
+
+class IntegrationResult(float):
+    ''' Integral estimate, behaves as a plain float but also carries
+
+    error - standard error of the estimate
+    n - number of samples taken
+    n_eff - effective number of samples behind it (same as n for independent sampling)
+    time - wall time in seconds '''
+
+    def __new__(cls, estimate, error, n, n_eff, time):
+        self = float.__new__(cls, estimate)
+        self.error = error
+        self.n = n
+        self.n_eff = n_eff
+        self.time = time
+        return self
+
+    @property
+    def estimate(self):
+        return float(self)
+
+    def __reduce__(self):
+        # float's own pickling would call __new__ with the value alone, profiles may hold unpicklable callbacks
+        state = {k: v for k, v in self.__dict__.items() if k != 'profile'}
+        return (_rebuild_result, (self.__class__, float(self), state))
+
+    def __repr__(self):
+        return 'IntegrationResult(estimate={}, error={}, n={}, n_eff={}, time={})'.format(float(self), self.error, self.n, self.n_eff, self.time)
+
+def _rebuild_result(cls, estimate, state):
+    self = float.__new__(cls, estimate)
+    self.__dict__.update(state)
+    return self
+
+class MCMCResult(IntegrationResult):
+    ''' IntegrationResult of importance sampling, n_eff being the autocorrelation based effective sample size
+    of the chains, and also carrying
+
+    acceptance - fraction of proposals accepted in the last round of sampling
+    r_hat - split R-hat of the scores over all chains, close to 1 once they agree (see split_r_hat) '''
+
+    def __new__(cls, estimate, error, n, n_eff, time, acceptance, r_hat):
+        self = IntegrationResult.__new__(cls, estimate, error, n, n_eff, time)
+        self.acceptance = acceptance
+        self.r_hat = r_hat
+        return self
+
+    def __repr__(self):
+        return 'MCMCResult(estimate={}, error={}, n={}, n_eff={}, time={}, acceptance={}, r_hat={})'.format(
+            float(self), self.error, self.n, self.n_eff, self.time, self.acceptance, self.r_hat)
+
+class IntegrationResults(list):
+    ''' IntegrationResults of several integrals estimated from the same samples, also carrying
+
+    covariance - (m, m) covariance of the estimates, shared samples make differences between them far
+                 less noisy than their errors alone suggest (see difference_error) '''
+
+    def __init__(self, results, covariance):
+        list.__init__(self, results)
+        self.covariance = covariance
+
+    @property
+    def estimates(self):
+        return np.array(self, dtype=float)
+
+    @property
+    def errors(self):
+        return np.array([r.error for r in self])
+
+    def difference_error(self, i, j):
+        ''' Standard error of self[i] - self[j] '''
+        return math.sqrt(max(self.covariance[i, i] + self.covariance[j, j] - 2 * self.covariance[i, j], 0))
+
+def moments_result(moments, scale, start, n_eff=None):
+    ''' Turn merged Moments into an IntegrationResult of scale * mean
+
+    Arguments:
+    moments - merged Moments of the sampled values
+    scale - constant the mean is multiplied by (e.g. volume of the cube)
+    start - time.time() when the integration started
+    n_eff - effective sample count if not moments.n (e.g. correlated mcmc samples) '''
+    n = moments.n
+    n_eff = n if n_eff is None else n_eff
+
+    if n == 0:
+        return IntegrationResult(0.0, math.inf, 0, 0, time.time() - start)
+
+    mean = moments.total / n
+    # unbiased sample variance, clamped since the sum of squares form can dip below 0 from rounding
+    var = max(moments.total_sq / n - mean * mean, 0) * n / max(n - 1, 1)
+    error = abs(scale) * math.sqrt(var / n_eff) if n_eff > 0 else math.inf
+
+    return IntegrationResult(scale * mean, error, n, n_eff, time.time() - start)
+
+def shared_results(n, total, cross, scale, start):
+    ''' IntegrationResults of scale * mean of several integrands sampled at the same n points
+
+    Arguments:
+    n - number of points
+    total - (m,) sums of every integrand's values
+    cross - (m, m) sums of products of the integrands' values, point by point
+    scale, start - as in moments_result '''
+    elapsed = time.time() - start
+
+    if n == 0:
+        return IntegrationResults([IntegrationResult(0.0, math.inf, 0, 0, elapsed) for t in total], np.full((len(total), len(total)), math.inf))
+
+    means = total / n
+    # unbiased covariance of the values, then of the means
+    cov = (cross / n - np.outer(means, means)) * n / max(n - 1, 1) * scale * scale / n
+    errors = np.sqrt(np.maximum(np.diag(cov), 0))
+
+    return IntegrationResults([IntegrationResult(scale * m, e, n, n, elapsed) for m, e in zip(means, errors)], cov)
+
+def control_variate_result(n, total, cross, exacts, scale, start):
+    ''' IntegrationResult of scale * mean of the first integrand sampled at the same n points as control variates with
+    known integrals, which the regression optimal multiple of their deviation from those is taken off of. n_eff is
+    the number of plain samples that would give the same error
+
+    Arguments:
+    n, total, cross - as in shared_results, the integrand first and then the control variates
+    exacts - (m - 1,) exact integrals of the control variates
+    scale, start - as in moments_result '''
+    if n == 0:
+        return IntegrationResult(0.0, math.inf, 0, 0, time.time() - start)
+
+    means = total / n
+    cov = (cross / n - np.outer(means, means)) * n / max(n - 1, 1)
+
+    # least squares, so that linearly dependent (or constant) control variates get no say instead of failing
+    beta = np.linalg.lstsq(cov[1:, 1:], cov[1:, 0], rcond=None)[0]
+    mean = means[0] - beta @ (means[1:] - np.asarray(exacts, dtype=float) / scale)
+
+    # residual variance, with the degrees of freedom the fitted coefficients took
+    var = max(cov[0, 0] - cov[1:, 0] @ beta, 0) * (n - 1) / max(n - 1 - len(beta), 1)
+    n_eff = n * cov[0, 0] / var if var > 0 else math.inf
+
+    return IntegrationResult(scale * mean, abs(scale) * math.sqrt(var / n), n, n_eff, time.time() - start)
+
+def replicates_result(moments, scale, start):
+    ''' IntegrationResult from independent replicates (e.g. randomized quasi monte carlo) whose
+    points are not iid, so the error comes from the spread of the replicate means
+
+    Arguments:
+    moments - list of Moments, one per replicate
+    scale, start - as in moments_result '''
+    merged = merge_moments(moments)
+    means = np.array([m.total / m.n for m in moments if m.n > 0])
+
+    if len(means) < 2:
+        return moments_result(merged, scale, start)
+
+    error = abs(scale) * np.std(means, ddof=1) / math.sqrt(len(means))
+    pointwise = moments_result(merged, scale, start)
+
+    # number of iid samples that would give the same error
+    n_eff = (pointwise.error / error) ** 2 * merged.n if error > 0 else math.inf
+
+    return IntegrationResult(scale * np.mean(means), error, merged.n, n_eff, time.time() - start)
+
+def combine_results(results, start):
+    ''' Inverse variance weighted combination of independent IntegrationResults of the same integral '''
+    n = sum(r.n for r in results)
+
+    # a single sample has no variance to go by, its zero error says nothing, so it is left out
+    results = [r for r in results if r.n >= 2]
+    if not results:
+        return IntegrationResult(0.0, math.inf, n, 0, time.time() - start)
+
+    # constant integrands have no variance, so there is nothing to weight
+    exact = [r for r in results if r.error == 0]
+    if exact:
+        return IntegrationResult(float(np.mean(exact)), 0.0, n, n, time.time() - start)
+
+    weights = np.array([1 / r.error ** 2 for r in results])
+    estimate = np.sum(weights * np.array(results, dtype=float)) / np.sum(weights)
+    error = 1 / math.sqrt(np.sum(weights))
+    n_eff = sum(r.n_eff for r in results)
+
+    return IntegrationResult(estimate, error, n, n_eff, time.time() - start)
+
+def split_r_hat(segments):
+    ''' Split R-hat (Gelman et al.) of some chains, every chain split into its first and second half
+
+    Arguments:
+    segments - per chain, an (rounds, 2, 3) array of the (count, sum, sum of squares) of both halves of each of its
+               rounds, in order
+
+    returns nan if there is too little to compare '''
+    halves = []
+    for s in segments:
+        parts = np.asarray(s, dtype=float).reshape(-1, 3)
+        # split where the count is closest to half way, rounds of different lengths can't be split exactly
+        cumulative = np.cumsum(parts[:, 0])
+        k = int(np.argmin(np.abs(cumulative - cumulative[-1] / 2))) + 1 if len(parts) else 0
+        halves += [parts[:k].sum(axis=0), parts[k:].sum(axis=0)]
+
+    halves = np.array([h for h in halves if h[0] >= 2])
+    if len(halves) < 2:
+        return math.nan
+
+    n, means = halves[:, 0], halves[:, 1] / halves[:, 0]
+    variances = np.maximum(halves[:, 2] / n - means * means, 0) * n / (n - 1)
+
+    length = np.mean(n)
+    within = np.mean(variances)
+    between = length * np.var(means, ddof=1)
+
+    if within <= 0:
+        return 1.0 if between <= 0 else math.inf
+
+    return math.sqrt(((length - 1) / length * within + between / length) / within)
+
+def should_stop(result, rtol=None, atol=None, max_n=None, max_time=None, ess=None):
+    ''' Adaptive stopping rule: true once the error target (and effective sample size target, if ess is
+    given) is met or the sample/time budget is spent
+
+    Without rtol, atol and ess sampling isn't adaptive, so always stop. '''
+    if rtol is None and atol is None and ess is None:
+        return True
+
+    if (max_n is not None and result.n >= max_n) or (max_time is not None and result.time >= max_time):
+        return True
+
+    tol = max(atol or 0, (rtol or 0) * abs(result))
+    tol_met = (rtol is None and atol is None) or result.error <= tol
+
+    return tol_met and (ess is None or result.n_eff >= ess)
@@ -0,0 +1,104 @@
+import numpy as np
+import utils
+import profiling
+
+# bins per dimension of the separable grid
+BINS = 50
+
+# grid damping, lower adapts more cautiously
+ALPHA = 1.5
+
+def uniform_grid(d, bins=BINS):
+    ''' Starting grid: evenly spaced bin edges over the unit cube, shape (d, bins + 1) '''
+    return np.tile(np.linspace(0, 1, bins + 1), (d, 1))
+
+def _map(grid, y):
+    ''' Map uniform points y in the unit cube through the grid, returns (points in the unit cube, jacobians) '''
+    bins = grid.shape[1] - 1
+    scaled = y * bins
+    idx = np.minimum(scaled.astype(int), bins - 1)
+
+    rows = np.arange(grid.shape[0])
+    left = grid[rows, idx]
+    width = grid[rows, idx + 1] - left
+
+    return left + (scaled - idx) * width, np.prod(width * bins, axis=1), idx
+
+def iteration(fn, grid, lows, highs, n, vectorized=False, chunk_size=1000, limits=None, direct=False, seed=None, profile=False):
+    ''' One vegas iteration on a worker: sample n points through the grid
+
+    Arguments:
+    fn, lows, highs, n, vectorized, chunk_size, limits, direct, seed, profile - as in integration._hypercube_process_wrapper
+    grid - (d, bins + 1) bin edges over the unit cube
+
+    returns utils.Moments of f * jacobian and the (d, bins) sum of (f * jacobian)^2 per bin, used to refine the grid '''
+    utils.seed_job(seed)
+    fn, probe = profiling.probe(fn, limits, vectorized, direct, profile)
+
+    lows = np.asarray(lows, dtype=float)
+    highs = np.asarray(highs, dtype=float)
+    d, bins = grid.shape[0], grid.shape[1] - 1
+
+    moments = []
+    weights = np.zeros((d, bins))
+
+    for done in range(0, n, chunk_size):
+        rows = min(chunk_size, n - done)
+        u, jac, idx = _map(grid, np.random.uniform(size=(rows, d)))
+        points = lows + (highs - lows) * u
+
+        vals = fn(points) if vectorized else np.array([fn(p) for p in points])
+        vals = vals * jac
+
+        moments.append(utils.array_moments(vals))
+        for i in range(d):
+            weights[i] += np.bincount(idx[:, i], weights=vals * vals, minlength=bins)
+
+    return profiling.report((utils.merge_moments(moments), weights), probe)
+
+def refine_grid(grid, weights, alpha=ALPHA):
+    ''' Move the bin edges so that every bin holds about the same share of the (smoothed, damped) weights '''
+    new_grid = grid.copy()
+    bins = grid.shape[1] - 1
+
+    for i in range(grid.shape[0]):
+        w = weights[i]
+
+        # smooth with neighbours so that a few lucky samples don't take over
+        smoothed = np.empty(bins)
+        smoothed[0] = (w[0] + w[1]) / 2
+        smoothed[-1] = (w[-2] + w[-1]) / 2
+        smoothed[1:-1] = (w[:-2] + w[1:-1] + w[2:]) / 3
+
+        total = smoothed.sum()
+        if total <= 0:
+            continue
+
+        smoothed /= total
+
+        # damp, ((1 - d) / log(1 / d)) ^ alpha
+        damped = np.zeros(bins)
+        nonzero = (smoothed > 0) & (smoothed < 1)
+        damped[nonzero] = ((1 - smoothed[nonzero]) / -np.log(smoothed[nonzero])) ** alpha
+        damped[smoothed >= 1] = 1
+
+        # new edges at equal steps of the cumulative damped weight
+        cumulative = np.concatenate(([0], np.cumsum(damped)))
+        new_grid[i] = np.interp(np.linspace(0, cumulative[-1], bins + 1), cumulative, grid[i])
+        new_grid[i, 0], new_grid[i, -1] = 0, 1
+
+    return new_grid
+
+def combine_iterations(moments, scale, start, skip=1):
+    ''' Inverse variance weighted IntegrationResult over iterations
+
+    Arguments:
+    moments - list of utils.Moments, one per iteration
+    scale, start - as in utils.moments_result
+    skip - number of early iterations (sampled from a still poor grid) left out of the estimate '''
+    results = [utils.moments_result(m, scale, start) for m in moments]
+    used = results[skip:] if len(results) > skip else results
+    combined = utils.combine_results(used, start)
+
+    # the skipped iterations were still paid for
+    return utils.IntegrationResult(combined, combined.error, sum(m.n for m in moments), combined.n_eff, combined.time)
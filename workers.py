@@ -0,0 +1,205 @@
+import atexit
+import collections
+import hashlib
+import os
+import threading
+
+# pathos (pulling in dill, multiprocess and ppft) is most of what importing the package costs beyond numpy, so it
+# is only imported once a pool is started or fns are serialized, which most short lived processes never get to
+
+# how many distinct integrands each side remembers before forgetting the oldest
+MAX_REGISTERED = 64
+
+# integrands already deserialized in this (worker) process, keyed by registration key
+_registered = collections.OrderedDict()
+
+class _Missing(object):
+    ''' What a worker returns for a job whose fns it doesn't have and wasn't sent, the job is sent again with them '''
+
+def serialize(fns):
+    ''' (key, payload) of a tuple of fns: dill serialized by value, with the globals they use as they are now,
+    keyed by a digest of the payload so that fns which changed (or whose globals did) get a key of their own '''
+    import dill
+    payload = dill.dumps(fns, recurse=True)
+    return hashlib.sha256(payload).hexdigest(), payload
+
+def _run_registered(target, key, payload, args, kwds):
+    ''' Runs inside a worker: look up (or unpickle once) the registered fns and call target with them
+
+    Arguments:
+    target - module level function, called as target(*fns, *args, **kwds)
+    key - registration key of the fns (see serialize)
+    payload - dill serialized tuple of fns, None if the worker is expected to have them already
+    args, kwds - per job arguments '''
+    if key in _registered:
+        _registered.move_to_end(key)
+        fns = _registered[key]
+    elif payload is None:
+        return _Missing()
+    else:
+        import dill
+        fns = dill.loads(payload)
+        _registered[key] = fns
+
+        if len(_registered) > MAX_REGISTERED:
+            _registered.popitem(last=False)
+
+    return target(*fns, *args, **kwds)
+
+def _warm_worker():
+    # runs in every worker as it starts, so that its first job doesn't pay for these imports
+    # (numpy only loads its random module on first use)
+    import dill
+    import numpy.random
+    import sampling
+
+def _ready():
+    return os.getpid()
+
+class _Result(object):
+    ''' Pending result of WorkerPool.submit, get() sends the job again with its fns if its worker didn't have them '''
+
+    def __init__(self, pool, call, result):
+        self._pool = pool
+        self._call = call
+        self._result = result
+
+    def get(self, timeout=None):
+        value = self._result.get(timeout)
+
+        if isinstance(value, _Missing):
+            target, key, payload, args, kwds = self._call
+            value = self._pool._pool.apply(_run_registered, args=(target, key, payload, args, kwds))
+
+        return value
+
+class WorkerPool(object):
+    ''' Long lived pool of worker processes
+
+    Integrands are serialized once per run in the parent and deserialized once per worker: jobs of fns the
+    workers were sent before go out without them, and only a worker that doesn't have them (e.g. one that didn't
+    get a job the first time) is sent them again. Fns that changed since, or whose globals did, serialize to
+    a new key and are sent anew. Usable as a context manager. '''
+
+    def __init__(self, num_workers=None):
+        ''' Arguments:
+        num_workers - number of worker processes, defaults to cpu count '''
+        from pathos import multiprocessing
+
+        self.num_workers = num_workers or os.cpu_count()
+        self._pool = multiprocessing.Pool(self.num_workers, initializer=_warm_worker)
+        # keys sent out to the workers before, whose jobs go out without their payload
+        self._shipped = collections.OrderedDict()
+        # fns serialized by register for the next run of them
+        self._next = None
+        # runs may be driven from several threads at once (see default_executor)
+        self._lock = threading.Lock()
+
+    def _register(self, fns):
+        with self._lock:
+            if self._next is not None and len(self._next[0]) == len(fns) and all(a is b for a, b in zip(self._next[0], fns)):
+                fns, key, payload = self._next
+                self._next = None
+                return key, payload
+
+        return serialize(fns)
+
+    def _ship(self, key, payload):
+        # the payload if the workers may not have been sent it yet, else None
+        with self._lock:
+            if key in self._shipped:
+                self._shipped.move_to_end(key)
+                return None
+
+            self._shipped[key] = True
+            if len(self._shipped) > MAX_REGISTERED:
+                self._shipped.popitem(last=False)
+
+            return payload
+
+    def _submit(self, target, key, payload, shipped, args, kwds):
+        kwds = kwds or {}
+        return _Result(self, (target, key, payload, args, kwds), self._pool.apply_async(_run_registered, args=(target, key, shipped, args, kwds)))
+
+    def register(self, fns):
+        ''' Serialize fns for the workers now rather than in the next run of them '''
+        fns = tuple(fns)
+        key, payload = serialize(fns)
+
+        with self._lock:
+            self._next = (fns, key, payload)
+
+    def warm(self):
+        ''' Wait until the workers are up and have run a first job, returns their pids. The imports they warm up
+        with are done here too, the parent seeds and serializes every run '''
+        _warm_worker()
+        return self.run(_ready, (), [((), None)] * self.num_workers)
+
+    def submit(self, target, fns, args=(), kwds=None):
+        ''' Run target(*fns, *args, **kwds) on some worker, returns a pending result whose get() waits for it
+
+        Arguments:
+        target - module level function to run
+        fns - tuple of (possibly unpicklable by pickle) functions, shipped to a worker only if it doesn't have them
+        args, kwds - arguments for this particular job '''
+        key, payload = self._register(tuple(fns))
+        return self._submit(target, key, payload, self._ship(key, payload), args, kwds)
+
+    def run(self, target, fns, jobs):
+        ''' Run one job per (args, kwds) in jobs and wait for all of them, returns list of results '''
+        key, payload = self._register(tuple(fns))
+        shipped = self._ship(key, payload)
+        results = [self._submit(target, key, payload, shipped, args, kwds) for args, kwds in jobs]
+        return [r.get() for r in results]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+_default_pool = None
+_default_executor = None
+_default_lock = threading.Lock()
+
+def default_pool(num_workers=None):
+    ''' Shared pool used when callers don't pass one, created on first use with num_workers workers '''
+    global _default_pool
+
+    with _default_lock:
+        if _default_pool is None:
+            _default_pool = WorkerPool(num_workers)
+            # stopped before the interpreter tears down the modules it needs, pathos being imported late
+            atexit.register(_default_pool.terminate)
+
+    return _default_pool
+
+def warmup(num_workers=None):
+    ''' Start the shared pool ahead of the first integration (e.g. while a service or cli starts up, possibly on a
+    thread of its own) and wait until its workers are up with the sampling extension and serialization imported,
+    so the first call only pays for sampling. Returns the pool
+
+    Arguments:
+    num_workers - size of the pool if it isn't running yet, defaults to cpu count '''
+    pool = default_pool(num_workers)
+    pool.warm()
+    return pool
+
+def default_executor():
+    ''' Shared threads the async api drives its runs' rounds from, created on first use '''
+    global _default_executor
+    from concurrent import futures
+
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = futures.ThreadPoolExecutor(thread_name_prefix='integration')
+
+    return _default_executor